@@ -41,6 +41,7 @@ from . import dvid_overlay
 from . import dvid_splitter
 from . import gearbox
 from . import gfxdemo
+from . import matmul
 from . import pll
 from . import radio_tx
 from . import socdemo
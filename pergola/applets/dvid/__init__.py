@@ -14,7 +14,7 @@ from ...util.ecp5pll import ECP5PLL, ECP5PLLConfig
 
 
 class DVIDSignalGeneratorXDR(Elaboratable):
-    def __init__(self, dvid_out_clk, dvid_out, vga_parameters, pll1_freq_mhz, pixel_freq_mhz, xdr=1, skip_pll_checks=False, invert_outputs=[0, 0, 0, 0]):
+    def __init__(self, dvid_out_clk, dvid_out, vga_parameters, pll1_freq_mhz, pixel_freq_mhz, xdr=1, skip_pll_checks=False, invert_outputs=[0, 0, 0, 0], hdmi=False):
         self.dvid_out_clk = dvid_out_clk
         self.dvid_out = dvid_out
         self.vga_parameters = vga_parameters
@@ -23,6 +23,7 @@ class DVIDSignalGeneratorXDR(Elaboratable):
         self.xdr = xdr
         self.skip_pll_checks = skip_pll_checks
         self.invert_outputs = invert_outputs
+        self.hdmi = hdmi
 
     def elaborate(self, platform):
         m = Module()
@@ -125,7 +126,8 @@ class DVIDSignalGeneratorXDR(Elaboratable):
             out_g = pixel_g,
             out_b = pixel_b,
             out_clock = pixel_clk,
-            xdr=xdr
+            xdr=xdr,
+            hdmi=self.hdmi,
         )
 
         m.submodules += TestImageGenerator(
@@ -368,10 +370,15 @@ class DVIDApplet(Applet, applet_name="dvid"):
             "--skip-pll-checks", default=0, action="count",
             help="Allow PLL to be configured out of spec")
 
+        parser.add_argument(
+            "--hdmi", default=0, action="count",
+            help="Send HDMI with an AVI InfoFrame instead of plain DVI")
+
     def __init__(self, args):
         self.xdr = args.xdr
         self.dvid_config = args.config
         self.skip_pll_checks = args.skip_pll_checks
+        self.hdmi = args.hdmi
 
     def elaborate(self, platform):
 
@@ -404,7 +411,8 @@ class DVIDApplet(Applet, applet_name="dvid"):
             pixel_freq_mhz=dvid_config.pixel_freq_mhz,
             xdr=xdr,
             skip_pll_checks=self.skip_pll_checks,
-            invert_outputs=[0, 0, 1, 1])
+            invert_outputs=[0, 0, 1, 1],
+            hdmi=self.hdmi)
 
         return m
 
@@ -7,10 +7,16 @@ from ...util.test import FHDLTestCase
 from ...gateware.dvid2vga import DVID2VGA
 from ...gateware.vga2dvid import VGA2DVID
 from ...gateware.vga import *
-from ...gateware.vga_testimage import *
+from ...gateware.vga_analyzer import VGATimingAnalyzer
+from ...gateware.compositor import Compositor
+from ...gateware.uart import UART
+from ...gateware.bus.uartbridge import UARTBridge
+from ...gateware.bus.wb import get_layout
+from ...gateware.capture import FrameCapture
 
 class DVIDOverlay(Elaboratable):
-    def __init__(self, dvid_in_d0, dvid_in_d1, dvid_in_d2, dvid_out_d0, dvid_out_d1, dvid_out_d2, dvid_clk_out, xdr, debug):
+    def __init__(self, dvid_in_d0, dvid_in_d1, dvid_in_d2, dvid_out_d0, dvid_out_d1, dvid_out_d2, dvid_clk_out, xdr, debug,
+                 uart_rx=None, uart_tx=None, uart_divisor=None):
         self.dvid_in_d0 = dvid_in_d0
         self.dvid_in_d1 = dvid_in_d1
         self.dvid_in_d2 = dvid_in_d2
@@ -20,6 +26,9 @@ class DVIDOverlay(Elaboratable):
         self.dvid_clk_out = dvid_clk_out
         self.xdr = xdr
         self.debug = debug
+        self.uart_rx = uart_rx
+        self.uart_tx = uart_tx
+        self.uart_divisor = uart_divisor
 
     def elaborate(self, platform):
         dvid_in_d0 = self.dvid_in_d0
@@ -128,92 +137,92 @@ class DVIDOverlay(Elaboratable):
                 ),
         }
 
-        # m.submodules.vga = vga = DynamicVGAOutputSubtarget(
-        #     output=vga_output,
-        # )
-
-        m.submodules.vga = vga = VGAOutputSubtarget(
-            # vga_parameters=vga_configs["640x480p60"],
-            # vga_parameters=vga_configs["1280x720p60"],
-            vga_parameters=vga_configs["1920x1080p60"],
+        # Measure the input timing and lock the local timing generator to it, so any
+        # input resolution works without a rebuild. The reset values only matter
+        # until the analyzer has locked.
+        m.submodules.vga = vga = DynamicVGAOutputSubtarget(
             output=vga_output,
+            vga_parameters=vga_configs["1920x1080p60"],
         )
 
-        # m.d.sync += vga.h_front.eq(0)
-        # m.d.sync += vga.h_sync.eq(96)
-        # m.d.sync += vga.h_back.eq(48+16)
-        # m.d.sync += vga.h_sync.eq(371)
-        # m.d.sync += vga.h_active.eq(1280)
-        # m.d.sync += vga.v_front.eq(10)
-        # m.d.sync += vga.v_sync.eq(2)
-        # m.d.sync += vga.v_back.eq(33)
-        # m.d.sync += vga.v_sync.eq(30)
-        # m.d.sync += vga.v_active.eq(720)
-
-        # Count and detect h_sync and v_sync lengths
-        ctr = Signal(18, reset=0)
-        with m.If(~decoded_de0):
-            m.d.sync += ctr.eq(ctr + 1)
-        with m.Else():
-            m.d.sync += ctr.eq(0)
-            with m.If(ctr > 10000):
-                # First data enabled after vsync
-                m.d.sync += m.submodules.vga.reset.eq(1)
-                # m.d.sync += m.submodules.vga.reset.eq(0)
-
-        # Generate vga test image
-        secondary_r = Signal(8)
-        secondary_g = Signal(8)
-        secondary_b = Signal(8)
-
-        m.submodules.imagegen = TestImageGenerator(
-        # m.submodules.imagegen = StaticTestImageGenerator(
-            vsync=vga_output.vs,
-            h_ctr=m.submodules.vga.h_ctr,
-            v_ctr=m.submodules.vga.v_ctr,
-            r=secondary_r,
-            g=secondary_g,
-            b=secondary_b,
-            speed=0
+        m.submodules.timing = timing = VGATimingAnalyzer(
+            de=decoded_de0,
+            hsync=decoded_hsync,
+            vsync=decoded_vsync,
+            bus=vga.bus,
         )
+        m.d.comb += vga.reset.eq(timing.frame_end)
 
+        # Draw text and sprites on top of the input
         overlay_r = Signal(8)
         overlay_g = Signal(8)
         overlay_b = Signal(8)
-        # m.d.comb += [
-        #     overlay_r.eq(decoded_r),
-        #     overlay_g.eq(decoded_g),
-        #     overlay_b.eq(decoded_b),
-        # ]
 
-        m.d.comb += [
-            overlay_r.eq((decoded_r >> 1) + (secondary_r >> 1)),
-            overlay_g.eq((decoded_g >> 1) + (secondary_g >> 1)),
-            overlay_b.eq((decoded_b >> 1) + (secondary_b >> 1)),
-        ]
+        m.submodules.compositor = compositor = Compositor(
+            h_ctr=vga.h_ctr,
+            v_ctr=vga.v_ctr,
+            in_r=decoded_r,
+            in_g=decoded_g,
+            in_b=decoded_b,
+            out_r=overlay_r,
+            out_g=overlay_g,
+            out_b=overlay_b,
+        )
 
-        # m.d.comb += [
-        #     overlay_r.eq(secondary_r),
-        #     overlay_g.eq(secondary_g),
-        #     overlay_b.eq(secondary_b),
-        # ]
+        # Grab a region of the input frame for the host
+        m.submodules.capture = capture = FrameCapture(
+            h_ctr=vga.h_ctr,
+            v_ctr=vga.v_ctr,
+            r=decoded_r,
+            g=decoded_g,
+            b=decoded_b,
+        )
 
-        # m.d.comb += [
-        #     overlay_r.eq((decoded_r >> 1) + Mux(decoded_de0, 127, 0)),
-        #     overlay_g.eq((decoded_g >> 1) + Mux(decoded_hsync, 127, 0)),
-        #     overlay_b.eq((decoded_b >> 1) + Mux(decoded_vsync, 127, 0)),
-        # ]
+        if self.uart_rx is not None:
+            m.submodules.uart = uart = UART(divisor=self.uart_divisor)
+            m.submodules.bridge = bridge = UARTBridge(uart, Record(get_layout()))
+            m.d.comb += [
+                uart.rx_i.eq(self.uart_rx),
+                self.uart_tx.eq(uart.tx_o),
 
-        # m.d.comb += [
-        #     overlay_r.eq(Mux(decoded_de0, 255, 0)),
-        #     overlay_g.eq(Mux(decoded_hsync, 255, 0)),
-        #     overlay_b.eq(Mux(decoded_vsync, 255, 0)),
-        # ]
+                bridge.stream_data.eq(capture.stream_data),
+                bridge.stream_valid.eq(capture.stream_valid),
+                capture.stream_ready.eq(bridge.stream_ready),
+            ]
 
+            # Wishbone address decoder, selects a peripheral by bits 24 to 31
+            # 0x0000_0000: Compositor
+            # 0x0100_0000: FrameCapture
+            bus = bridge.bus
+            for i, wb in enumerate([compositor.wb, capture.wb]):
+                selected = bus.adr[24:] == i
+                m.d.comb += [
+                    wb.adr.eq(bus.adr[:24]),
+                    wb.dat_w.eq(bus.dat_w),
+                    wb.sel.eq(bus.sel),
+                    wb.we.eq(bus.we),
+                    wb.cyc.eq(bus.cyc & selected),
+                    wb.stb.eq(bus.stb & selected),
+                ]
+                with m.If(selected):
+                    m.d.comb += [
+                        bus.dat_r.eq(wb.dat_r),
+                        bus.ack.eq(wb.ack),
+                    ]
+
+        # Delay the control signals by the compositor latency
+        decoded_ctl = Cat(decoded_de0, decoded_hsync, decoded_vsync,
+                          decoded_ctl0, decoded_ctl1, decoded_ctl2, decoded_ctl3)
+        for i in range(compositor.latency):
+            decoded_ctl_r = Signal(len(decoded_ctl), name=f"decoded_ctl_r{i}")
+            m.d.sync += decoded_ctl_r.eq(decoded_ctl)
+            decoded_ctl = decoded_ctl_r
+
+        delayed_de0, delayed_hsync, delayed_vsync, delayed_ctl0, delayed_ctl1, delayed_ctl2, delayed_ctl3 = decoded_ctl
 
         # Delay the blanking signal 1
         blank_r = Signal()
-        m.d.sync += blank_r.eq(~decoded_de0)
+        m.d.sync += blank_r.eq(~delayed_de0)
 
         m.submodules.vga2dvid = vga2dvid = VGA2DVID(
             # in_r=Const(127, 8),
@@ -223,16 +232,16 @@ class DVIDOverlay(Elaboratable):
             in_g=overlay_g,
             in_b=overlay_b,
             in_blank=blank_r,
-            in_hsync=decoded_hsync,
-            in_vsync=decoded_vsync,
+            in_hsync=delayed_hsync,
+            in_vsync=delayed_vsync,
             # in_blank = ~(decoded_hsync | decoded_vsync),
             # in_blank = vga_output.blank,
             # in_hsync = vga_output.hs,
             # in_vsync = vga_output.vs,
             # in_hsync = 0,
             # in_vsync = 0,
-            in_c1=Cat(decoded_ctl0, decoded_ctl1),
-            in_c2=Cat(decoded_ctl2, decoded_ctl3),
+            in_c1=Cat(delayed_ctl0, delayed_ctl1),
+            in_c2=Cat(delayed_ctl2, delayed_ctl3),
 
             out_r=tmds_d2,
             out_g=tmds_d1,
@@ -299,10 +308,21 @@ class DVIDOverlayApplet(Applet, applet_name="dvid-overlay"):
 
     PMOD1 is input
     PMOD2 is output
+
+    The text and sprite layers are updated over the UART, see UARTBridge and
+    Compositor for the protocol and the address map. Frames of the input can be
+    captured with pergola/host/capture.py.
     """
 
+    @classmethod
+    def add_run_arguments(cls, parser):
+        parser.add_argument(
+            "--baudrate", default=115200, type=int,
+            help="Baudrate of the UART")
+
     def __init__(self, args):
         self.blink = Signal()
+        self.baudrate = args.baudrate
 
     def elaborate(self, platform):
         # PMOD1 pinout:
@@ -389,6 +409,7 @@ class DVIDOverlayApplet(Applet, applet_name="dvid-overlay"):
             clock_signal_freq=pixel_freq_mhz * 1e6)
 
         leds = Cat([platform.request("led", i) for i in range(8)])
+        uart_pins = platform.request("uart", 0)
 
         dvid_in_d0 = Signal(xdr)
         dvid_in_d1 = Signal(xdr)
@@ -459,6 +480,9 @@ class DVIDOverlayApplet(Applet, applet_name="dvid-overlay"):
             dvid_out_d2,
             dvid_out_clk_d,
             xdr,
-            leds)
+            leds,
+            uart_rx=uart_pins.rx,
+            uart_tx=uart_pins.tx.o,
+            uart_divisor=round(pixel_freq_mhz * 1e6 / self.baudrate))
 
         return m
@@ -62,7 +62,6 @@ class GearboxExampleApplet(Applet, applet_name="gearbox"):
             width_out=width_out,
             domain_in="gb_in",
             domain_out="gb_out",
-            depth=3,
         )
 
         m.d.comb += gearbox.data_in.eq(data_in)
@@ -14,12 +14,16 @@ from colorsys import hsv_to_rgb
 from .. import Applet
 from ...gateware.bus.buswrapper import BusWrapper
 from ...gateware.bus.wb import get_layout
+from ...gateware.bus.arbiter import WishboneArbiter
 from ...gateware.vga import VGAOutputSubtarget, VGAParameters
 from ...gateware.vga2dvid import VGA2DVID
 from ...gateware.vga_testimage import RotozoomImageGenerator
+from ...gateware.scanline import ScanlineRenderer
+from ...gateware.blitter import Blitter, BlitterRop
 from ...util.ecp5pll import ECP5PLL, ECP5PLLConfig
 
-from ...gateware.bus.buscontroller import Asm, BusController
+from ...gateware.bus.buscontroller import Asm, BusController, PipelinedBusController
+from ...gateware.bus.asm import assemble
 
 
 class DVIDSignalGeneratorXDR(Elaboratable):
@@ -155,53 +159,14 @@ dvid_configs = {
 
 }
 
-class RowBufferRenderer(Elaboratable):
-    def __init__(self, vga, readport):
-        self.vga = vga
-        self.readport = readport
-        self.pixel_on = Signal()
-
-    def elaborate(self, platform):
-        m = Module()
-
-        vga = self.vga
-        readport = self.readport
-        h_en = vga.h_en
-
-        # Delay signals to match other renderers in the design
-        addr_r = Signal(range(640))
-        addr_r_r = Signal(range(640))
-        h_en_r = Signal()
-        h_en_r_r = Signal()
-        m.d.sync += [
-            addr_r.eq(vga.h_ctr),
-            addr_r_r.eq(addr_r),
-            h_en_r.eq(h_en),
-            h_en_r_r.eq(h_en_r),
-        ]
-
-        shiftreg = Signal(32)
-        m.d.comb += self.pixel_on.eq(shiftreg[0]),
-
-        with m.If(h_en):
-            m.d.comb += readport.addr.eq(addr_r[6:])
-
-        with m.If(addr_r_r[:6] == 0):
-            m.d.sync += shiftreg.eq(readport.data)
-        with m.Elif(~addr_r_r[0]):
-            # Shift every second cycle to stretch the buffer (320 -> 640)
-            m.d.sync += shiftreg.eq(shiftreg[1:])
-
-
-        return m
-
 class GFXDemo(Elaboratable):
     '''
     Clock domains:
     sync:   25 MHz
     shift: 125 MHz
     '''
-    def __init__(self, dvid_out, dvid_out_clk, pdm_out, vga_parameters, xdr, emulate_ddr, base_addr=0x3000_0000):
+    def __init__(self, dvid_out, dvid_out_clk, pdm_out, vga_parameters, xdr, emulate_ddr, base_addr=0x3000_0000,
+                 blitter_init=None):
         self.dvid_out = dvid_out
         self.dvid_out_clk = dvid_out_clk
         self.pdm_out = pdm_out
@@ -209,6 +174,7 @@ class GFXDemo(Elaboratable):
         self.xdr = xdr
         self.emulate_ddr = emulate_ddr
         self.base_addr = base_addr
+        self.blitter_init = blitter_init
 
         self.irq = Signal(3)
         self.pdm_in = Signal(16)
@@ -231,11 +197,21 @@ class GFXDemo(Elaboratable):
 
     def elaborate(self, platform):
 
-        wb = self.wb
         base_addr = self.base_addr
 
         m = Module()
 
+        # blitter = 0x3000_4000, source RAM at 0x3000_6000
+        m.submodules.blitter = blitter = Blitter(
+            depth=2048,
+            init=self.blitter_init,
+            base_addr=base_addr + 0x4000,
+        )
+
+        # The blitter shares the bus with the bus master of self.wb
+        wb = Record(layout=get_layout())
+        m.submodules.arbiter = WishboneArbiter(wb, [self.wb, blitter.bus])
+
         # First order "sigma-delta" DAC
         pdm = Signal(len(self.pdm_in) + 1)
         m.d.sync += pdm.eq(pdm[:-1] + self.pdm_in)
@@ -244,27 +220,20 @@ class GFXDemo(Elaboratable):
         # Graphics
         m.submodules.dvid_signal_generator = dvid = self.dvid
 
-        rowbuf = Memory(width=32, depth=640//32//2)
-        m.submodules.mem_rd = mem_rd = rowbuf.read_port()
-        m.submodules.mem_wr = mem_wr = rowbuf.write_port()
+        # rowbuffer = 0x3000_0100, followed by the palette and the mode register
+        rowbuf_addr = base_addr + 0x100
 
-        m.submodules.rbrenderer = rbrenderer = RowBufferRenderer(
-            readport=mem_rd,
-            vga=dvid.vga,
+        m.submodules.renderer = renderer = ScanlineRenderer(
+            h_ctr=dvid.vga.h_ctr,
+            width=self.vga_parameters.h_active,
+            base_addr=rowbuf_addr,
         )
 
-        rgb_on = Signal(24, reset=0xFFFFFF)
-        rgb_off = Signal(24)
-
-        # dummy signal
-        effect_mode = Signal()
-
-        pixel_on = Signal()
-        m.d.comb += pixel_on.eq(rbrenderer.pixel_on)
-
-        m.d.comb += self.r.eq(Mux(pixel_on, rgb_on[ 0: 8], rgb_off[ 0: 8]))
-        m.d.comb += self.g.eq(Mux(pixel_on, rgb_on[ 8:16], rgb_off[ 8:16]))
-        m.d.comb += self.b.eq(Mux(pixel_on, rgb_on[16:24], rgb_off[16:24]))
+        m.d.comb += [
+            self.r.eq(renderer.r),
+            self.g.eq(renderer.g),
+            self.b.eq(renderer.b),
+        ]
 
         # Create a strobe signal for when vsync goes high
         v_sync_risen = Signal()
@@ -281,7 +250,7 @@ class GFXDemo(Elaboratable):
         m.d.comb += self.irq.eq(Cat(
             dvid.vga.v_en & (dvid.vga.h_ctr == 640),
             v_sync_strobe,
-            0,
+            ~blitter.busy,
         ))
 
         m.submodules.wrapper = wrapper = BusWrapper(
@@ -289,8 +258,6 @@ class GFXDemo(Elaboratable):
             signals_w=[
                 self.pdm_in,            # 0x3000_0000
                 dvid.vga.reset,         # 0x3000_0004
-                rgb_on,                 # 0x3000_0008
-                rgb_off,                # 0x3000_000C
             ],
         )
 
@@ -300,24 +267,41 @@ class GFXDemo(Elaboratable):
         m.d.comb += wrapper.addr.eq(wb.adr[2:5])
         m.d.comb += wrapper.write_data.eq(wb.dat_w)
 
-        # Connect writeport of rowbuffer
-        m.d.comb += mem_wr.addr.eq(wb.adr[2:8])
-        m.d.comb += mem_wr.data.eq(wb.dat_w)
+        # Connect renderer and blitter
+        for slave in [renderer.wb, blitter.wb]:
+            m.d.comb += [
+                slave.adr.eq(wb.adr),
+                slave.dat_w.eq(wb.dat_w),
+                slave.we.eq(wb.we),
+                slave.sel.eq(wb.sel),
+            ]
+        m.d.comb += wb.dat_r.eq(renderer.wb.dat_r | blitter.wb.dat_r)
 
-        ack_r = Signal()
+        # The colors of the 1 bpp mode are palette entries 1 and 0
+        rgb_on_off = Signal()
+        m.d.comb += rgb_on_off.eq((wb.adr[5:] == (base_addr >> 5)) & (wb.adr[3:5] == 1))
+        with m.If(rgb_on_off):
+            m.d.comb += renderer.wb.adr.eq(renderer.memory_map["palette"] + Mux(wb.adr[2], 0, 4))
 
-        # rowbuffer = 0x3000_0100 - 0x3000_0128 (10 words)
-        rowbuf_addr = base_addr + 0x100 
+        ack_r = Signal()
+        wrapper_ack = Signal()
+        m.d.comb += wb.ack.eq(wrapper_ack | renderer.wb.ack | blitter.wb.ack)
 
         # Wishbone address decoder
         with m.If(wb.stb & wb.cyc):
-            with m.If(wb.adr[5:] == (base_addr >> 5)):
+            with m.If(rgb_on_off | ((wb.adr >= rowbuf_addr) & (wb.adr < rowbuf_addr + renderer.size))):
+                m.d.comb += [
+                    renderer.wb.cyc.eq(1),
+                    renderer.wb.stb.eq(1),
+                ]
+            with m.Elif(wb.adr[blitter.region_bits + 1:] == (blitter.base_addr >> (blitter.region_bits + 1))):
+                m.d.comb += [
+                    blitter.wb.cyc.eq(1),
+                    blitter.wb.stb.eq(1),
+                ]
+            with m.Elif(wb.adr[5:] == (base_addr >> 5)):
                 m.d.comb += wrapper.cs.eq(1)
-                m.d.sync += wb.ack.eq(ack_r)
-                m.d.sync += ack_r.eq(0)
-            with m.Elif(wb.adr[8:] == (rowbuf_addr >> 8)):
-                m.d.comb += mem_wr.en.eq(wb.we)
-                m.d.sync += wb.ack.eq(ack_r)
+                m.d.sync += wrapper_ack.eq(ack_r)
                 m.d.sync += ack_r.eq(0)
         with m.Else():
             m.d.sync += ack_r.eq(1)
@@ -331,40 +315,78 @@ class GFXDemo(Elaboratable):
 def rgb_to_uint32(rgb):
     return ((int(255 * rgb[0]) << 16) | (int(255 * rgb[1]) << 8) | int(255 * rgb[2]))
 
-gfxdemo_program = [
-                # Set DAC value
-                Asm.MOV_R0(0x1234),
-                Asm.WRITE_R0(0x3000_0000),
-
-                # Wait for VSync
-                Asm.WFI(0b10),
-
-                # Palette magic, rainbow for rbrenderer
-                *chain(*[[
-                    Asm.MOV_R0(0x3000_0104),
-                    Asm.WRITE_IMM(i * 0x08040201),
-                    Asm.MOV_R0(0x3000_0108),
-                    Asm.WRITE_IMM(1 << (i % 32)),
-                    Asm.MOV_R0(0x3000_010c),
-                    Asm.WRITE_IMM(1 << (i % 32)),
-                    Asm.MOV_R0(0x3000_0110),
-                    Asm.WRITE_IMM(0b01010101_01010101_01010101_01010101 << (i % 2)),
-                    Asm.MOV_R0(0x3000_0114),
-                    Asm.WRITE_IMM(0b01010101_01010101_01010101_01010101 << (i % 2)),
-                    Asm.MOV_R0(0x3000_0008),
-                    Asm.WRITE_IMM(rgb_to_uint32(hsv_to_rgb(i / 255, 1.0, 0.5))),
-                    Asm.MOV_R0(0x3000_000C),
-                    Asm.WRITE_IMM(rgb_to_uint32(hsv_to_rgb(i / 255, 1.0, 1.0))),
-                    Asm.WFI(0b01),
-                ] for i in range(255)]),
-
-                # Patterns
-                *chain(*[[
-                    Asm.MOV_R0(0x3000_0100 + 4 * i), Asm.WRITE_IMM((1 << (i+1)) - 1),
-                ] for i in range(10)]),
-
-                Asm.JMP(0),
-            ]
+# Blitter registers, see Blitter
+blitter_ctrl = 0x3000_4000
+blitter_src  = 0x3000_4004
+blitter_dst  = 0x3000_4008
+
+# Palette entries 0 and 1, i.e. rgb_off and rgb_on
+palette_addr = 0x3000_0500
+
+gfxdemo_source = """
+    .macro blit
+        MOV_R0 BLITTER_CTRL
+        WRITE_IMM SRC
+    .endm
+
+    start:
+        ; Set DAC value
+        MOV_R0 0x1234
+        WRITE_R0 0x3000_0000
+
+        ; Wait for VSync
+        WFI 0b10
+
+        ; Palette magic, rainbow for the renderer. For every line the blitter
+        ; copies the next 5 words of the row buffer and the 2 colors from the
+        ; line table in its source RAM.
+        MOV_R0 BLITTER_SRC
+        WRITE_IMM 10
+        MOV_R1 255
+    line:
+        MOV_R0 BLITTER_DST
+        BURST 0x3000_0104, 5
+        blit
+        WFI 0b100
+        MOV_R0 BLITTER_DST
+        BURST PALETTE, 2
+        blit
+        ; Wait for the blitter and the end of the line
+        WFI 0b101
+        LOOP line
+
+        ; Patterns, copied by the blitter to both banks of the line buffer
+        MOV_R1 2
+    pattern:
+        MOV_R0 BLITTER_SRC
+        BURST 0, 0x3000_0100, 10
+        blit
+        WFI 0b101
+        LOOP pattern
+
+        JMP start
+"""
+
+gfxdemo_program = assemble(gfxdemo_source, constants={
+    "BLITTER_CTRL": blitter_ctrl,
+    "BLITTER_SRC": blitter_src,
+    "BLITTER_DST": blitter_dst,
+    "PALETTE": palette_addr,
+    "SRC": BlitterRop.SRC,
+}).rom
+
+# Source RAM of the blitter, the patterns and then the line table
+gfxdemo_blitter_init = [(1 << (i+1)) - 1 for i in range(10)] + [
+    (v & 0xffffffff) for i in range(255) for v in [
+        i * 0x08040201,
+        1 << (i % 32),
+        1 << (i % 32),
+        0b01010101_01010101_01010101_01010101 << (i % 2),
+        0b01010101_01010101_01010101_01010101 << (i % 2),
+        rgb_to_uint32(hsv_to_rgb(i / 255, 1.0, 1.0)),
+        rgb_to_uint32(hsv_to_rgb(i / 255, 1.0, 0.5)),
+    ]
+]
 
 class GFXDemoApplet(Applet, applet_name="gfxdemo"):
     help = "Graphics demo"
@@ -459,9 +481,10 @@ class GFXDemoApplet(Applet, applet_name="gfxdemo"):
             pdm_out=pmod1,
             vga_parameters=dvid_config.vga_parameters,
             xdr=xdr,
-            emulate_ddr=True)
+            emulate_ddr=True,
+            blitter_init=gfxdemo_blitter_init)
 
-        m.submodules.buscontroller = buscontroller = BusController(
+        m.submodules.buscontroller = buscontroller = PipelinedBusController(
             bus=gfxdemo.wb,
             irq=gfxdemo.irq,
             program=gfxdemo_program,
@@ -597,7 +620,8 @@ class DVIDSim(FHDLTestCase):
             pdm_out=Signal(),
             vga_parameters=dvid_configs["640x480p60"].vga_parameters,
             xdr=1,
-            emulate_ddr=False)
+            emulate_ddr=False,
+            blitter_init=gfxdemo_blitter_init)
 
         m.submodules.buscontroller = buscontroller = BusController(
             bus=gfxdemo.wb,
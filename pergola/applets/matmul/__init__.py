@@ -0,0 +1,83 @@
+from nmigen import *
+from nmigen.build import *
+
+from .. import Applet
+from ...gateware.math.accelerator import MatMulAccelerator
+from ...gateware.uart import UART
+
+
+class MatMulApplet(Applet, applet_name="matmul"):
+    help = "Systolic int8 matrix multiplier over UART"
+    description = """
+    Multiplies int8 matrices of up to max-size x max-size on a rows x cols systolic array.
+
+    Send MATMUL_MAGIC (0x4d), m, k, n, A and B over the UART and read back C as int32.
+    See pergola/gateware/math/accelerator.py for the protocol and pergola/host/matmul.py
+    for a client that benchmarks the array.
+    """
+
+    @classmethod
+    def add_run_arguments(cls, parser):
+        parser.add_argument(
+            "--baudrate", default=115200, type=int,
+            help="Baudrate")
+
+        parser.add_argument(
+            "--rows", default=4, type=int,
+            help="Rows of the array")
+
+        parser.add_argument(
+            "--cols", default=4, type=int,
+            help="Columns of the array")
+
+        parser.add_argument(
+            "--max-size", default=32, type=int,
+            help="Largest m, k and n")
+
+    def __init__(self, args):
+        self.baudrate = args.baudrate
+        self.rows = args.rows
+        self.cols = args.cols
+        self.max_size = args.max_size
+
+    def elaborate(self, platform):
+        leds = [platform.request("led", i) for i in range(8)]
+        uart_pins = platform.request("uart", 0)
+
+        m = Module()
+
+        m.submodules.uart = uart = UART(
+            divisor=round(platform.default_clk_frequency / self.baudrate),
+        )
+        m.d.comb += uart.rx_i.eq(uart_pins.rx)
+        m.d.comb += uart_pins.tx.o.eq(uart.tx_o)
+
+        m.submodules.accel = accel = MatMulAccelerator(
+            rows=self.rows, cols=self.cols, max_size=self.max_size)
+
+        # The received byte is taken right away, it is dropped if the FIFO is full
+        rx_taken = Signal()
+        rx_strobe = Signal()
+        m.d.comb += [
+            uart.rx_ack.eq(1),
+            rx_strobe.eq(uart.rx_rdy & ~rx_taken & ~uart.rx_err),
+            accel.rx_data.eq(uart.rx_data),
+            accel.rx_valid.eq(rx_strobe),
+        ]
+        with m.If(~uart.rx_rdy):
+            m.d.sync += rx_taken.eq(0)
+        with m.Elif(rx_strobe):
+            m.d.sync += rx_taken.eq(1)
+
+        m.d.comb += [
+            uart.tx_data.eq(accel.tx_data),
+            uart.tx_rdy.eq(accel.tx_valid),
+            accel.tx_ready.eq(uart.tx_ack),
+        ]
+
+        m.d.comb += [
+            leds[0].o.eq(accel.busy),
+            leds[1].o.eq(uart.rx_err),
+        ]
+
+        return m
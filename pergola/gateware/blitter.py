@@ -0,0 +1,325 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+from nmigen.utils import bits_for
+
+from enum import IntEnum
+
+from .bus.buswrapper import BusWrapper
+from .bus.wb import get_layout
+from ..util.test import FHDLTestCase, wb_write
+
+
+class BlitterRop(IntEnum):
+    """
+    Raster operations, the truth table of a result bit indexed by
+    (source bit << 1) | pattern bit.
+    """
+    ZERO    = 0b0000
+    AND     = 0b1000
+    SRC     = 0b1100
+    PATTERN = 0b1010
+    XOR     = 0b0110
+    OR      = 0b1110
+    NOT_SRC = 0b0011
+    ONE     = 0b1111
+
+
+def rop(op, src, pattern, width=32):
+    """
+    Reference model of a raster operation.
+    """
+    result = 0
+    for i in range(width):
+        s = (src >> i) & 1
+        p = (pattern >> i) & 1
+        result |= ((op >> ((s << 1) | p)) & 1) << i
+    return result
+
+
+class Blitter(Elaboratable):
+    """
+    Copies and fills blocks of words, e.g. into a line buffer or framebuffer, as a
+    Wishbone bus master.
+
+    A blit of `rows` rows of `count` words is started by writing the raster
+    operation to the control register. Every word is the raster operation of the
+    next word of the source RAM and the pattern register, so SRC copies, PATTERN
+    fills and the others combine both. The destination address is incremented by 4
+    for every word and by `stride` for every row. The source RAM can be written
+    through `wb` and initialised like a ROM with `init`.
+
+    Between the words the bus is released for a cycle, so slaves that need an idle
+    cycle between transfers work and other masters behind a WishboneArbiter get a
+    turn. A transfer that is not acked within bus_timeout cycles is skipped.
+
+    depth:      Words of source RAM
+    init:       Initial contents of the source RAM
+    base_addr:  Base address of `wb`
+
+    busy:       High while a blit is running
+    bus:        Wishbone master
+    wb:         Wishbone slave with byte addresses. Offsets from base_addr:
+                0x00: Control, write a BlitterRop to start. Reads 1 while busy.
+                0x04: src, first word in the source RAM. If it has not been
+                      written since the last blit, the blit continues after the
+                      last word of the previous one.
+                0x08: dst, first byte address on `bus`
+                0x0C: count, words per row
+                0x10: pattern
+                0x14: rows, 1 after reset
+                0x18: stride, bytes from row to row on `bus`
+    memory_map: Base address of the memories:
+        "source": Source RAM
+    """
+
+    def __init__(self, depth=256, init=None, base_addr=0, bus_timeout=100):
+        self.depth = depth
+        self.base_addr = base_addr
+        self.bus_timeout = bus_timeout
+
+        self.region_bits = max(5, 2 + bits_for(depth - 1))
+        self.memory_map = {"source": base_addr + (1 << self.region_bits)}
+        self.size = 2 << self.region_bits
+
+        self.busy = Signal()
+        self.rop = Signal(4)
+        self.src = Signal(range(depth))
+        self.dst = Signal(32)
+        self.count = Signal(16)
+        self.pattern = Signal(32)
+        self.rows = Signal(16, reset=1)
+        self.stride = Signal(32)
+
+        self.source = Memory(width=32, depth=depth, init=init)
+
+        self.bus = Record(get_layout())
+        self.wb = Record(get_layout())
+
+    def elaborate(self, platform):
+        m = Module()
+
+        wb = self.wb
+        bus = self.bus
+        regs_list = [self.src, self.dst, self.count, self.pattern, self.rows, self.stride]
+
+        # Registers
+        m.submodules.regs = regs = BusWrapper(
+            address_width=3,
+            signals_r=[self.busy, *regs_list],
+            signals_w=[self.rop, *regs_list],
+        )
+
+        region = Signal()
+        ack_r = Signal()
+        m.d.comb += [
+            region.eq(wb.adr[self.region_bits:] != (self.base_addr >> self.region_bits)),
+            regs.we.eq(wb.we),
+            regs.addr.eq(wb.adr[2:5]),
+            regs.write_data.eq(wb.dat_w),
+            wb.dat_r.eq(regs.read_data),
+        ]
+        with m.If(wb.cyc & wb.stb):
+            m.d.sync += wb.ack.eq(ack_r)
+            m.d.sync += ack_r.eq(0)
+            with m.If(region == 0):
+                m.d.comb += regs.cs.eq(~ack_r)
+        with m.Else():
+            m.d.sync += ack_r.eq(1)
+
+        m.submodules.source_wr = source_wr = self.source.write_port()
+        m.d.comb += [
+            source_wr.addr.eq(wb.adr[2:]),
+            source_wr.data.eq(wb.dat_w),
+            source_wr.en.eq(wb.cyc & wb.stb & wb.we & ~ack_r & (region == 1)),
+        ]
+
+        start = Signal()
+        m.d.comb += start.eq(regs.cs & regs.we & (regs.addr == 0))
+
+        src_written = Signal()
+        with m.If(regs.cs & regs.we & (regs.addr == 1)):
+            m.d.sync += src_written.eq(1)
+
+        # Blit
+        m.submodules.source_rd = source_rd = self.source.read_port()
+
+        src_ptr = Signal(range(self.depth))
+        src_next = Signal(range(self.depth))
+        dst_ptr = Signal(32)
+        row_ptr = Signal(32)
+        x = Signal(16)
+        y = Signal(16)
+        tmo_ctr = Signal(range(self.bus_timeout + 1), reset=self.bus_timeout)
+
+        result = Signal(32)
+        s = source_rd.data
+        p = self.pattern
+        m.d.comb += [
+            source_rd.addr.eq(src_ptr),
+            result.eq((Repl(self.rop[0], 32) & ~s & ~p) |
+                      (Repl(self.rop[1], 32) & ~s &  p) |
+                      (Repl(self.rop[2], 32) &  s & ~p) |
+                      (Repl(self.rop[3], 32) &  s &  p)),
+        ]
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(start):
+                    m.d.sync += [
+                        self.busy.eq(1),
+                        src_ptr.eq(Mux(src_written, self.src, src_next)),
+                        src_written.eq(0),
+                        x.eq(0),
+                        y.eq(0),
+                    ]
+                    m.next = "START"
+
+            with m.State("START"):
+                # The registers have been written in the previous cycle
+                m.d.sync += [
+                    dst_ptr.eq(self.dst),
+                    row_ptr.eq(self.dst),
+                ]
+                with m.If((self.count == 0) | (self.rows == 0)):
+                    m.d.sync += self.busy.eq(0)
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "FETCH"
+
+            with m.State("FETCH"):
+                # One cycle with deasserted bus signals while the source word is read
+                m.next = "WRITE"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    bus.cyc.eq(1),
+                    bus.stb.eq(1),
+                    bus.adr.eq(dst_ptr),
+                    bus.dat_w.eq(result),
+                    bus.sel.eq(0b1111),
+                    bus.we.eq(1),
+                ]
+                m.d.sync += tmo_ctr.eq(tmo_ctr - 1)
+                with m.If(bus.ack | (tmo_ctr == 0)):
+                    m.d.sync += [
+                        tmo_ctr.eq(self.bus_timeout),
+                        src_ptr.eq(src_ptr + 1),
+                        src_next.eq(src_ptr + 1),
+                    ]
+                    m.next = "FETCH"
+                    with m.If(x == self.count - 1):
+                        m.d.sync += [
+                            x.eq(0),
+                            y.eq(y + 1),
+                            row_ptr.eq(row_ptr + self.stride),
+                            dst_ptr.eq(row_ptr + self.stride),
+                        ]
+                        with m.If(y == self.rows - 1):
+                            m.d.sync += self.busy.eq(0)
+                            m.next = "IDLE"
+                    with m.Else():
+                        m.d.sync += [
+                            x.eq(x + 1),
+                            dst_ptr.eq(dst_ptr + 4),
+                        ]
+
+        return m
+
+
+class BlitterTest(FHDLTestCase):
+
+    def test_blit(self):
+        m = Module()
+
+        source = [(0x9e3779b9 * (i + 1)) & 0xffffffff for i in range(64)]
+        m.submodules.blitter = blitter = Blitter(depth=64, init=source)
+        wb = blitter.wb
+        bus = blitter.bus
+
+        # Target memory, acks like BusWrapper users and needs an idle cycle between transfers
+        target = Memory(width=32, depth=256)
+        m.submodules.target_wr = target_wr = target.write_port()
+        ack_r = Signal()
+        m.d.comb += [
+            target_wr.addr.eq(bus.adr[2:]),
+            target_wr.data.eq(bus.dat_w),
+        ]
+        with m.If(bus.cyc & bus.stb):
+            m.d.comb += target_wr.en.eq(bus.we & ~ack_r)
+            m.d.sync += bus.ack.eq(ack_r)
+            m.d.sync += ack_r.eq(0)
+        with m.Else():
+            m.d.sync += ack_r.eq(1)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def read(addr):
+            yield wb.cyc.eq(1)
+            yield wb.stb.eq(1)
+            yield wb.we.eq(0)
+            yield wb.adr.eq(addr)
+            yield
+            while not (yield wb.ack):
+                yield
+            data = yield wb.dat_r
+            yield wb.cyc.eq(0)
+            yield wb.stb.eq(0)
+            yield
+            return data
+
+        def blit(op, src, dst, count, pattern=0, rows=1, stride=0):
+            for addr, value in [(0x04, src), (0x08, dst), (0x0c, count), (0x10, pattern),
+                                (0x14, rows), (0x18, stride)]:
+                yield from wb_write(wb, addr, value)
+            yield from wb_write(wb, 0x00, op)
+            self.assertEqual((yield blitter.busy), 1)
+            cycles = 0
+            while (yield blitter.busy):
+                cycles += 1
+                yield
+            return cycles
+
+        def process():
+            expected = [0] * 256
+
+            # Copy, a word every 3 cycles
+            cycles = yield from blit(BlitterRop.SRC, 3, 0x40, 10)
+            expected[0x10:0x1a] = source[3:13]
+            self.assertLessEqual(cycles, 10 * 3 + 2)
+
+            # Fill a 3 x 4 block in a 16 word wide framebuffer
+            yield from blit(BlitterRop.PATTERN, 0, 0x100 + 8, 3, pattern=0x12345678, rows=4, stride=64)
+            for y in range(4):
+                expected[0x40 + 16 * y + 2:0x40 + 16 * y + 5] = [0x12345678] * 3
+
+            # Raster operations
+            for i, op in enumerate([BlitterRop.XOR, BlitterRop.AND, BlitterRop.NOT_SRC]):
+                yield from blit(op, 20, 0x200 + 0x40 * i, 2, pattern=0xff00ff00, rows=2, stride=32)
+                for y in range(2):
+                    for j in range(2):
+                        expected[0x80 + 0x10 * i + 8 * y + j] = rop(op, source[20 + 2 * y + j], 0xff00ff00)
+
+            # Continue after the previous blit, with the same size
+            yield from wb_write(wb, 0x08, 0x300)
+            yield from wb_write(wb, 0x00, BlitterRop.SRC)
+            while (yield blitter.busy):
+                yield
+            expected[0xc0:0xc2] = source[24:26]
+            expected[0xc8:0xca] = source[26:28]
+
+            # Update the source RAM
+            yield from wb_write(wb, blitter.memory_map["source"] + 4 * 5, 0xcafef00d)
+            yield from blit(BlitterRop.SRC, 5, 0x3fc, 1)
+            expected[0xff] = 0xcafef00d
+
+            self.assertEqual((yield from read(0x00)), 0)
+            self.assertEqual((yield from read(0x0c)), 1)
+
+            yield
+            for i in range(256):
+                self.assertEqual((yield target[i]), expected[i], hex(i))
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("blitter.vcd"):
+            sim.run()
@@ -0,0 +1,117 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+
+from ...util.test import FHDLTestCase
+from .wb import get_layout
+
+
+class WishboneArbiter(Elaboratable):
+    """
+    Shares a Wishbone bus between several masters, round robin.
+
+    The granted master keeps the bus as long as it asserts cyc. When it deasserts
+    cyc, the bus goes to the next master that asserts cyc, so a master that drops
+    cyc between transfers lets the others in between.
+
+    bus:        Wishbone bus to the slaves
+    masters:    Wishbone buses of the masters, with the same layout as `bus`
+    """
+
+    def __init__(self, bus, masters):
+        self.bus = bus
+        self.masters = masters
+
+        self.grant = Signal(range(len(masters)))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        masters = self.masters
+        grant = self.grant
+
+        with m.Switch(grant):
+            for i, master in enumerate(masters):
+                with m.Case(i):
+                    m.d.comb += [
+                        bus.adr.eq(master.adr),
+                        bus.dat_w.eq(master.dat_w),
+                        bus.sel.eq(master.sel),
+                        bus.cyc.eq(master.cyc),
+                        bus.stb.eq(master.stb),
+                        bus.we.eq(master.we),
+                    ]
+
+        for i, master in enumerate(masters):
+            m.d.comb += [
+                master.dat_r.eq(bus.dat_r),
+                master.ack.eq(bus.ack & (grant == i)),
+            ]
+
+        # The first requesting master after the granted one, in order
+        with m.If(~bus.cyc):
+            with m.Switch(grant):
+                for i in range(len(masters)):
+                    with m.Case(i):
+                        order = [(i + j) % len(masters) for j in range(1, len(masters) + 1)]
+                        for j in reversed(order):
+                            with m.If(masters[j].cyc):
+                                m.d.sync += grant.eq(j)
+
+        return m
+
+
+class WishboneArbiterTest(FHDLTestCase):
+
+    def test_round_robin(self):
+        m = Module()
+
+        bus = Record(get_layout())
+        masters = [Record(get_layout()) for _ in range(3)]
+        m.submodules.arbiter = arbiter = WishboneArbiter(bus, masters)
+
+        # Slave that needs an idle cycle between transfers, like BusWrapper users
+        written = []
+        ack_r = Signal()
+        with m.If(bus.cyc & bus.stb):
+            m.d.sync += bus.ack.eq(ack_r)
+            m.d.sync += ack_r.eq(0)
+        with m.Else():
+            m.d.sync += ack_r.eq(1)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def master_process(i):
+            def process():
+                master = masters[i]
+                for n in range(4):
+                    yield master.cyc.eq(1)
+                    yield master.stb.eq(1)
+                    yield master.we.eq(1)
+                    yield master.adr.eq(i)
+                    yield master.dat_w.eq(n)
+                    yield
+                    while not (yield master.ack):
+                        yield
+                    yield master.cyc.eq(0)
+                    yield master.stb.eq(0)
+                    yield
+            return process
+
+        def process():
+            for _ in range(200):
+                yield
+                if (yield bus.ack):
+                    written.append(((yield bus.adr), (yield bus.dat_w)))
+
+            # All writes arrive in order, and the masters take turns
+            for i in range(3):
+                self.assertEqual([d for a, d in written if a == i], list(range(4)))
+            self.assertEqual([a for a, d in written[:6]], [0, 1, 2, 0, 1, 2])
+
+        for i in range(3):
+            sim.add_sync_process(master_process(i))
+        sim.add_sync_process(process)
+        with sim.write_vcd("arbiter.vcd"):
+            sim.run()
@@ -0,0 +1,380 @@
+"""
+Assembler for BusController and PipelinedBusController programs.
+
+    ; Comments start with ; or #
+    .const DAC 0x3000_0000          ; Constants, evaluated where they are defined
+
+    .macro write addr, value        ; Macros, arguments are used as \\addr
+        MOV_R0 \\addr
+        WRITE_IMM \\value
+    .endm
+
+    start:                          ; Labels
+        write DAC, 0x1234
+    .repeat 2                       ; Repeated blocks, can be nested
+        WFI 0b10
+    .endr
+        BURST 1, 2, 3               ; BURST takes its data words as operands
+        JMP start
+
+Instructions are the names of Opcodes and take one operand, an integer expression
+with constants and labels, except for BURST.
+
+    python -m pergola.gateware.bus.asm program.s
+"""
+
+import argparse
+import ast
+import operator
+import re
+
+from nmigen.utils import bits_for
+
+from ...util.test import FHDLTestCase
+from .buscontroller import Asm, Opcodes, BUS_OPCODES, instruction_cycles
+
+
+class AsmError(Exception):
+    pass
+
+
+# Configurations of the ECP5 DP16KD block RAM, depth x width
+EBR_CONFIGS = [(16384, 1), (8192, 2), (4096, 4), (2048, 9), (1024, 18), (512, 36)]
+
+
+def ebr_count(depth, width):
+    """
+    Number of ECP5 block RAMs for a memory of depth x width bits.
+    """
+    return min(-(-depth // d) * -(-width // w) for d, w in EBR_CONFIGS)
+
+
+_BINARY = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.LShift: operator.lshift,
+    ast.RShift: operator.rshift,
+    ast.BitOr: operator.or_,
+    ast.BitAnd: operator.and_,
+    ast.BitXor: operator.xor,
+}
+
+_UNARY = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+    ast.Invert: operator.invert,
+}
+
+
+def _evaluate(expr, names, lineno):
+    def visit(node):
+        if isinstance(node, ast.Expression):
+            return visit(node.body)
+        if isinstance(node, ast.Constant) and isinstance(node.value, int):
+            return node.value
+        if isinstance(node, ast.Name):
+            if node.id not in names:
+                raise AsmError(f"line {lineno}: Unknown name '{node.id}'")
+            return names[node.id]
+        if isinstance(node, ast.BinOp) and type(node.op) in _BINARY:
+            return _BINARY[type(node.op)](visit(node.left), visit(node.right))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in _UNARY:
+            return _UNARY[type(node.op)](visit(node.operand))
+        raise AsmError(f"line {lineno}: Unsupported expression '{expr}'")
+
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError:
+        raise AsmError(f"line {lineno}: Invalid expression '{expr}'")
+    return visit(tree)
+
+
+def _split_operands(text):
+    return [op.strip() for op in text.split(",")] if text.strip() else []
+
+
+def _split_word(text):
+    # First word and the rest, separated by any whitespace
+    word, *rest = re.split(r"\s+", text.strip(), 1)
+    return word, rest[0] if rest else ""
+
+
+class Program:
+    """
+    An assembled program.
+
+    rom:        ROM contents for BusController(program=...)
+    labels:     ROM address of every label
+    blocks:     (name, start, end) of the straight parts of the program, split at labels
+    """
+
+    def __init__(self, rom, labels, opcodes):
+        self.rom = rom
+        self.labels = labels
+        # Opcode of every ROM word, None for data words of a BURST
+        self.opcodes = opcodes
+
+        self.instruction_width = bits_for(max(Opcodes).value) + 32
+
+        starts = sorted(set([0] + list(labels.values())))
+        names = {addr: name for name, addr in reversed(list(labels.items()))}
+        self.blocks = [(names.get(start, "(start)"), start, end)
+                       for start, end in zip(starts, starts[1:] + [len(rom)]) if start < end]
+
+    @property
+    def depth(self):
+        return len(self.rom)
+
+    @property
+    def ebr(self):
+        return ebr_count(self.depth, self.instruction_width)
+
+    def cycles(self, start, end, pipelined=True, back_to_back=False):
+        """
+        Cycles to run from start to end once without branching, with WFI returning
+        right away.
+        """
+        total = 0
+        prev_bus = False
+        for opcode in self.opcodes[start:end]:
+            is_bus = opcode is None or opcode in BUS_OPCODES
+            total += instruction_cycles(is_bus, prev_bus, pipelined, back_to_back)
+            prev_bus = is_bus
+        return total
+
+    def report(self, pipelined=True, back_to_back=False):
+        lines = [
+            f"ROM: {self.depth} words of {self.instruction_width} bits, {self.ebr} EBR",
+            f"{'Block':<20}{'Start':>6}{'Words':>6}{'Cycles':>8}{'Bus':>5}{'WFI':>5}",
+        ]
+        for name, start, end in self.blocks:
+            opcodes = self.opcodes[start:end]
+            bus = sum(1 for op in opcodes if op is None or op in BUS_OPCODES)
+            wfi = opcodes.count(Opcodes.WFI)
+            cycles = self.cycles(start, end, pipelined, back_to_back)
+            lines.append(f"{name:<20}{start:>6}{end - start:>6}{cycles:>8}{bus:>5}{wfi:>5}")
+        return "\n".join(lines)
+
+
+def assemble(source, constants={}):
+    """
+    Assembles `source`, returns a Program. `constants` are predefined constants.
+    """
+    constants = dict(constants)
+    macros = {}
+
+    # Pass 1: Expand macros and repeats, collect labels and sizes
+    statements = []
+    labels = {}
+    addr = 0
+
+    def expand(lines, depth=0):
+        nonlocal addr
+        if depth > 32:
+            raise AsmError("Macros nested too deep")
+
+        i = 0
+        while i < len(lines):
+            lineno, line = lines[i]
+            i += 1
+
+            line = re.split(r"[;#]", line, 1)[0].strip()
+            if not line:
+                continue
+
+            match = re.match(r"^([A-Za-z_]\w*):\s*(.*)$", line)
+            if match:
+                name, line = match.groups()
+                if name in labels:
+                    raise AsmError(f"line {lineno}: Label '{name}' defined twice")
+                labels[name] = addr
+                if not line:
+                    continue
+
+            word, rest = _split_word(line)
+
+            if word in [".const", ".equ"]:
+                name, expr = _split_word(rest)
+                constants[name] = _evaluate(expr, constants, lineno)
+
+            elif word in [".macro", ".repeat"]:
+                block_ends = {".macro": ".endm", ".repeat": ".endr"}
+                # The end expected for every nesting level
+                ends = [block_ends[word]]
+                body = []
+                while True:
+                    if i == len(lines):
+                        raise AsmError(f"line {lineno}: Missing {ends[0]}")
+                    body_lineno, body_line = lines[i]
+                    i += 1
+                    first, _ = _split_word(re.split(r"[;#]", body_line, 1)[0])
+                    if first in block_ends:
+                        ends.append(block_ends[first])
+                    elif first in block_ends.values():
+                        if first != ends[-1]:
+                            raise AsmError(f"line {body_lineno}: Expected {ends[-1]}")
+                        ends.pop()
+                        if not ends:
+                            break
+                    body.append((body_lineno, body_line))
+
+                if word == ".macro":
+                    name, params = _split_word(rest)
+                    macros[name] = (_split_operands(params), body)
+                else:
+                    for _ in range(_evaluate(rest, constants, lineno)):
+                        expand(body, depth + 1)
+
+            elif word in macros:
+                params, body = macros[word]
+                args = _split_operands(rest)
+                if len(args) != len(params):
+                    raise AsmError(f"line {lineno}: Macro '{word}' takes {len(params)} arguments")
+                # Longest names first, so \a does not replace the start of \ab
+                pairs = sorted(zip(params, args), key=lambda p: -len(p[0]))
+                substituted = []
+                for body_lineno, body_line in body:
+                    for param, arg in pairs:
+                        body_line = body_line.replace("\\" + param, arg)
+                    substituted.append((body_lineno, body_line))
+                expand(substituted, depth + 1)
+
+            else:
+                name = word.upper()
+                if name not in Opcodes.__members__:
+                    raise AsmError(f"line {lineno}: Unknown instruction '{word}'")
+                operands = _split_operands(rest)
+                if name == "BURST":
+                    if not operands:
+                        raise AsmError(f"line {lineno}: BURST needs at least one word")
+                elif len(operands) != 1:
+                    raise AsmError(f"line {lineno}: {name} takes one operand")
+                statements.append((lineno, name, operands))
+                addr += 1 + (len(operands) if name == "BURST" else 0)
+
+    expand(list(enumerate(source.splitlines(), start=1)))
+
+    # Pass 2: Evaluate the operands
+    names = {**constants, **labels}
+    rom = []
+    opcodes = []
+    for lineno, name, operands in statements:
+        values = [_evaluate(op, names, lineno) for op in operands]
+        if name == "BURST":
+            rom += Asm.BURST(values)
+            opcodes += [Opcodes.BURST] + [None] * len(values)
+        else:
+            rom.append(getattr(Asm, name)(values[0]))
+            opcodes.append(Opcodes[name])
+
+    return Program(rom, labels, opcodes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Assembles a BusController program")
+    parser.add_argument("source", help="Source file")
+    parser.add_argument("--unpipelined", action="store_true",
+                        help="Estimate the cycles of BusController instead of PipelinedBusController")
+    parser.add_argument("--back-to-back", action="store_true",
+                        help="The slaves do not need an idle cycle between transfers")
+    parser.add_argument("--hex", action="store_true", help="Print the ROM contents")
+    args = parser.parse_args()
+
+    with open(args.source) as f:
+        program = assemble(f.read())
+
+    print(program.report(pipelined=not args.unpipelined, back_to_back=args.back_to_back))
+    if args.hex:
+        for addr, word in enumerate(program.rom):
+            print(f"{addr:04x}: {word:0{(program.instruction_width + 3) // 4}x}")
+
+
+class AsmTest(FHDLTestCase):
+
+    def test_assemble(self):
+        program = assemble("""
+            .const BASE 0x3000_0000
+            .const COUNT 2 + 1
+
+            .macro store addr, value
+                MOV_R0 \\addr       ; Set the address
+                WRITE_IMM \\value
+            .endm
+
+            start:
+                store BASE + 4, 0x1234
+                MOV_R1 COUNT
+            loop:   WRITE_R1 BASE
+            .repeat 2
+                .repeat COUNT - 1
+                    WFI 0b01
+                .endr
+                ADD_R0 4
+            .endr
+                LOOP loop
+                burst 1, 2, BASE >> 28  # Lower case works as well
+                JMP start
+        """, constants={"UNUSED": 1})
+
+        self.assertEqual(program.rom, [
+            Asm.MOV_R0(0x3000_0004),
+            Asm.WRITE_IMM(0x1234),
+            Asm.MOV_R1(3),
+            Asm.WRITE_R1(0x3000_0000),
+            Asm.WFI(0b01),
+            Asm.WFI(0b01),
+            Asm.ADD_R0(4),
+            Asm.WFI(0b01),
+            Asm.WFI(0b01),
+            Asm.ADD_R0(4),
+            Asm.LOOP(3),
+            *Asm.BURST([1, 2, 3]),
+            Asm.JMP(0),
+        ])
+        self.assertEqual(program.labels, {"start": 0, "loop": 3})
+        self.assertEqual([(name, start, end) for name, start, end in program.blocks],
+                         [("start", 0, 3), ("loop", 3, 16)])
+
+        # MOV, bus, MOV, then bus, LOOP and 6 others, BURST and three data words, JMP
+        self.assertEqual(program.cycles(0, 3), 1 + 2 + 1)
+        self.assertEqual(program.cycles(3, 16), 2 + 7 + 1 + 2 + 3 + 3 + 1)
+        self.assertEqual(program.cycles(3, 16, back_to_back=True), 2 + 7 + 1 + 2 * 3 + 1)
+        self.assertEqual(program.cycles(0, 3, pipelined=False), 2 + 4 + 2)
+
+        self.assertEqual(program.depth, 16)
+        self.assertEqual(program.ebr, 1)
+        self.assertIn("ROM: 16 words of 36 bits, 1 EBR", program.report())
+
+    def test_whitespace(self):
+        program = assemble(".const\tX  5\n.macro\tm\ta\nMOV_R0\t\\a\n.endm\nm\tX\nWFI  1")
+        self.assertEqual(program.rom, [Asm.MOV_R0(5), Asm.WFI(1)])
+
+    def test_ebr_count(self):
+        self.assertEqual(ebr_count(512, 36), 1)
+        self.assertEqual(ebr_count(513, 36), 2)
+        self.assertEqual(ebr_count(3800, 36), 8)
+        self.assertEqual(ebr_count(2048, 32), 4)
+
+    def test_errors(self):
+        for source, message in [
+                ("FOO 1", "line 1: Unknown instruction 'FOO'"),
+                ("\nJMP nowhere", "line 2: Unknown name 'nowhere'"),
+                ("a:\na:", "line 2: Label 'a' defined twice"),
+                ("MOV_R0 1, 2", "line 1: MOV_R0 takes one operand"),
+                (".repeat 2\nWFI 1", "line 1: Missing .endr"),
+                (".repeat 2\nWFI 1\n.endm", "line 3: Expected .endr"),
+                (".macro m\nWFI 1\n.endr", "line 3: Expected .endm"),
+                (".macro m\n.repeat 2\nWFI 1\n.endm\n.endm", "line 4: Expected .endr"),
+                (".macro m x\nMOV_R0 \\x\n.endm\nm 1, 2", "line 4: Macro 'm' takes 1 arguments"),
+                ("MOV_R0 print(1)", "line 1: Unsupported expression 'print(1)'"),
+            ]:
+            with self.subTest(source=source):
+                with self.assertRaisesRegex(AsmError, "^" + re.escape(message) + "$"):
+                    assemble(source)
+
+
+if __name__ == "__main__":
+    main()
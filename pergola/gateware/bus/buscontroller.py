@@ -15,6 +15,13 @@ class Opcodes(IntEnum):
     WRITE_IMM = 4
     WFI       = 5
     JMP       = 6
+    MOV_R1    = 7
+    ADD_R1    = 8
+    WRITE_R1  = 9
+    LOOP      = 10
+    JNZ       = 11
+    WRITE_INC = 12
+    BURST     = 13
 
 class Asm():
     # R0 <- value
@@ -45,6 +52,51 @@ class Asm():
     def JMP(rom_addr):
         return (Opcodes.JMP << 32) | (rom_addr & 0xffffffff)
 
+    # R1 <- value
+    def MOV_R1(value):
+        return (Opcodes.MOV_R1 << 32) | (value & 0xffffffff)
+
+    # R1 <- R1 + value
+    def ADD_R1(value):
+        return (Opcodes.ADD_R1 << 32) | (value & 0xffffffff)
+
+    # *addr <- R1
+    def WRITE_R1(addr):
+        return (Opcodes.WRITE_R1 << 32) | (addr & 0xffffffff)
+
+    # R1 <- R1 - 1, pc <- rom_addr if R1 != 0
+    def LOOP(rom_addr):
+        return (Opcodes.LOOP << 32) | (rom_addr & 0xffffffff)
+
+    # pc <- rom_addr if R0 != 0
+    def JNZ(rom_addr):
+        return (Opcodes.JNZ << 32) | (rom_addr & 0xffffffff)
+
+    # *R0 <- value, R0 <- R0 + 4
+    def WRITE_INC(value):
+        return (Opcodes.WRITE_INC << 32) | (value & 0xffffffff)
+
+    # *R0 <- values[i], R0 <- R0 + 4 for all values, which follow in the ROM
+    def BURST(values):
+        return [(Opcodes.BURST << 32) | len(values)] + [v & 0xffffffff for v in values]
+
+# Opcodes that do a bus transfer. Every data word of a BURST does one as well.
+BUS_OPCODES = [Opcodes.READ, Opcodes.WRITE_R0, Opcodes.WRITE_R1, Opcodes.WRITE_IMM, Opcodes.WRITE_INC]
+
+
+def instruction_cycles(is_bus, prev_bus, pipelined=True, back_to_back=False):
+    """
+    Cycles of one ROM word with WFI returning right away. `is_bus` is set if the word
+    does a bus transfer, `prev_bus` if the previous one did.
+    """
+    if not pipelined:
+        # Fetch, then an idle bus cycle before every transfer
+        return 1 + (3 if is_bus else 1)
+    if is_bus:
+        return 2 + (prev_bus and not back_to_back)
+    return 1
+
+
 class BusController(Elaboratable):
     def __init__(self, bus, irq, program, immediate_width=32, bus_timeout=100):
         self.bus = bus
@@ -59,6 +111,8 @@ class BusController(Elaboratable):
         self.rom = Memory(width=self.instruction_width, depth=len(self.program), init=self.program)
         self.pc = Signal(range(len(self.program)))
         self.r0 = Signal(immediate_width)
+        self.r1 = Signal(immediate_width)
+        self.burst = Signal(immediate_width)
         self.tmo_ctr = Signal(range(bus_timeout + 1), reset=bus_timeout)
 
     def elaborate(self, platform):
@@ -68,6 +122,8 @@ class BusController(Elaboratable):
         rom = self.rom
         pc = self.pc
         r0 = self.r0
+        r1 = self.r1
+        burst = self.burst
         tmo_ctr = self.tmo_ctr
 
         m = Module()
@@ -83,10 +139,38 @@ class BusController(Elaboratable):
             value      .eq(mem_rd.data[:self.immediate_width]),
         ]
 
-        # Decode, Execute, Bus/Memory, Write-back
         fetching = Signal(reset=1)
+
+        def write(name, adr, dat_w, done=[]):
+            with m.FSM(name=name):
+                with m.State("INIT"):
+                    # One clock cycle with deasserted bus signals
+                    m.next = "WRITE"
+                with m.State("WRITE"):
+                    m.d.comb += [
+                        bus.cyc.eq(1),
+                        bus.stb.eq(1),
+                        bus.adr.eq(adr),
+                        bus.dat_w.eq(dat_w),
+                        bus.sel.eq(0b1111),
+                        bus.we.eq(0b1),
+                    ]
+                    m.d.sync += tmo_ctr.eq(tmo_ctr - 1)
+                    with m.If(bus.ack | (tmo_ctr == 0)):
+                        m.next = "INIT"
+                        m.d.sync += [
+                            tmo_ctr.eq(self.bus_timeout),
+                            pc.eq(pc + 1),
+                            fetching.eq(1),
+                            *done,
+                        ]
+
+        # Decode, Execute, Bus/Memory, Write-back
         with m.If(fetching == 1):
             m.d.sync += fetching.eq(0)
+        with m.Elif(burst != 0):
+            # The instruction is a data word of a BURST
+            write("burst", r0, value, done=[r0.eq(r0 + 4), burst.eq(burst - 1)])
         with m.Else():
             with m.Switch(opcode):
                 with m.Case(Opcodes.MOV_R0):
@@ -97,6 +181,14 @@ class BusController(Elaboratable):
                     m.d.sync += r0.eq(r0 + value)
                     m.d.sync += [pc.eq(pc + 1), fetching.eq(1)]
 
+                with m.Case(Opcodes.MOV_R1):
+                    m.d.sync += r1.eq(value)
+                    m.d.sync += [pc.eq(pc + 1), fetching.eq(1)]
+
+                with m.Case(Opcodes.ADD_R1):
+                    m.d.sync += r1.eq(r1 + value)
+                    m.d.sync += [pc.eq(pc + 1), fetching.eq(1)]
+
                 with m.Case(Opcodes.READ):
                     with m.FSM(name="read"):
                         with m.State("INIT"):
@@ -114,49 +206,37 @@ class BusController(Elaboratable):
                                 m.next = "INIT"
 
                 with m.Case(Opcodes.WRITE_R0):
-                    with m.FSM(name="write_r0"):
-                        with m.State("INIT"):
-                            # One clock cycle with deasserted bus signals
-                            m.next = "WRITE"
-                        with m.State("WRITE"):
-                            m.d.comb += [
-                                bus.cyc.eq(1),
-                                bus.stb.eq(1),
-                                bus.adr.eq(value),
-                                bus.dat_w.eq(r0),
-                                bus.sel.eq(0b1111),
-                                bus.we.eq(0b1),
-                            ]
-                            m.d.sync += tmo_ctr.eq(tmo_ctr - 1)
-                            with m.If(bus.ack | (tmo_ctr == 0)):
-                                m.next = "INIT"
-                                m.d.sync += [
-                                    tmo_ctr.eq(self.bus_timeout),
-                                    pc.eq(pc + 1),
-                                    fetching.eq(1)
-                                ]
+                    write("write_r0", value, r0)
+
+                with m.Case(Opcodes.WRITE_R1):
+                    write("write_r1", value, r1)
 
                 with m.Case(Opcodes.WRITE_IMM):
-                    with m.FSM(name="write_imm"):
-                        with m.State("INIT"):
-                            # One clock cycle with deasserted bus signals
-                            m.next = "WRITE"
-                        with m.State("WRITE"):
-                            m.d.comb += [
-                                bus.cyc.eq(1),
-                                bus.stb.eq(1),
-                                bus.adr.eq(r0),
-                                bus.dat_w.eq(value),
-                                bus.sel.eq(0b1111),
-                                bus.we.eq(0b1),
-                            ]
-                            with m.If(bus.ack):
-                                m.next = "INIT"
-                                m.d.sync += [pc.eq(pc + 1), fetching.eq(1)]
+                    write("write_imm", r0, value)
+
+                with m.Case(Opcodes.WRITE_INC):
+                    write("write_inc", r0, value, done=[r0.eq(r0 + 4)])
+
+                with m.Case(Opcodes.BURST):
+                    m.d.sync += burst.eq(value)
+                    m.d.sync += [pc.eq(pc + 1), fetching.eq(1)]
 
                 with m.Case(Opcodes.JMP):
                     m.d.sync += [pc.eq(value), fetching.eq(1)]
 
+                with m.Case(Opcodes.LOOP):
+                    m.d.sync += r1.eq(r1 - 1)
+                    with m.If(r1 != 1):
+                        m.d.sync += [pc.eq(value), fetching.eq(1)]
+                    with m.Else():
+                        m.d.sync += [pc.eq(pc + 1), fetching.eq(1)]
+
+                with m.Case(Opcodes.JNZ):
+                    with m.If(r0 != 0):
+                        m.d.sync += [pc.eq(value), fetching.eq(1)]
+                    with m.Else():
+                        m.d.sync += [pc.eq(pc + 1), fetching.eq(1)]
+
                 with m.Case(Opcodes.WFI):
                     with m.If((irq & value[:8]) == value[:8]):
                         m.d.sync += [pc.eq(pc + 1), fetching.eq(1)]
@@ -166,6 +246,168 @@ class BusController(Elaboratable):
 
         return m
 
+class PipelinedBusController(Elaboratable):
+    """
+    BusController that fetches the next instruction while executing the current one.
+
+    The ROM address is the pc of the next instruction, so every instruction that
+    does not touch the bus or wait takes one cycle, including JMP. A bus transfer
+    starts in the cycle its instruction is executed and ends with the ack, so it
+    takes two cycles with a registered ack. Slaves that need a cycle with
+    deasserted cyc/stb between two transfers get it only if the previous
+    instruction was a transfer too, unless back_to_back is set.
+
+    Transfers that are not acked within bus_timeout cycles are skipped, a timed
+    out READ leaves r0 as it is.
+    """
+
+    def __init__(self, bus, irq, program, immediate_width=32, bus_timeout=100, back_to_back=False):
+        self.bus = bus
+        self.irq = irq
+        self.program = program
+        self.immediate_width = immediate_width
+        self.bus_timeout = bus_timeout
+        self.back_to_back = back_to_back
+
+        self.opcode_width = bits_for(max(Opcodes).value)
+        self.instruction_width = self.opcode_width + self.immediate_width
+
+        self.rom = Memory(width=self.instruction_width, depth=len(self.program), init=self.program)
+        self.pc = Signal(range(len(self.program)))
+        self.r0 = Signal(immediate_width)
+        self.r1 = Signal(immediate_width)
+        self.burst = Signal(immediate_width)
+        self.tmo_ctr = Signal(range(bus_timeout + 1), reset=bus_timeout)
+
+    def elaborate(self, platform):
+        bus = self.bus
+        irq = self.irq
+
+        rom = self.rom
+        pc = self.pc
+        r0 = self.r0
+        r1 = self.r1
+        burst = self.burst
+        tmo_ctr = self.tmo_ctr
+
+        m = Module()
+
+        m.submodules.mem_rd = mem_rd = rom.read_port()
+
+        # Fetch, the ROM output is invalid in the first cycle after reset
+        valid = Signal()
+        pc_next = Signal.like(pc)
+        opcode = Signal(self.opcode_width)
+        value = Signal(self.immediate_width)
+        m.d.sync += [
+            valid.eq(1),
+            pc.eq(pc_next),
+        ]
+        m.d.comb += [
+            mem_rd.addr.eq(pc_next),
+            opcode     .eq(mem_rd.data[self.immediate_width:]),
+            value      .eq(mem_rd.data[:self.immediate_width]),
+        ]
+
+        done = Signal()
+        with m.If(done):
+            m.d.comb += pc_next.eq(pc + 1)
+        with m.Else():
+            m.d.comb += pc_next.eq(pc)
+
+        # One cycle with deasserted bus signals after a transfer
+        bus_done = Signal()
+        idle = Signal()
+        m.d.sync += bus_done.eq(bus.cyc & done)
+        m.d.comb += idle.eq(bus_done & (not self.back_to_back))
+
+        def transfer(adr, we, dat_w=None, done_stmts=[]):
+            with m.If(~idle):
+                m.d.comb += [
+                    bus.cyc.eq(1),
+                    bus.stb.eq(1),
+                    bus.adr.eq(adr),
+                ]
+                if we:
+                    m.d.comb += [
+                        bus.dat_w.eq(dat_w),
+                        bus.sel.eq(0b1111),
+                        bus.we.eq(0b1),
+                    ]
+                m.d.sync += tmo_ctr.eq(tmo_ctr - 1)
+                with m.If(bus.ack | (tmo_ctr == 0)):
+                    m.d.sync += [tmo_ctr.eq(self.bus_timeout), *done_stmts]
+                    m.d.comb += done.eq(1)
+                    if not we:
+                        with m.If(bus.ack):
+                            m.d.sync += r0.eq(bus.dat_r)
+
+        # Decode, Execute, Bus/Memory, Write-back
+        with m.If(valid & (burst != 0)):
+            # The instruction is a data word of a BURST
+            transfer(r0, we=True, dat_w=value, done_stmts=[r0.eq(r0 + 4), burst.eq(burst - 1)])
+        with m.Elif(valid):
+            with m.Switch(opcode):
+                with m.Case(Opcodes.MOV_R0):
+                    m.d.sync += r0.eq(value)
+                    m.d.comb += done.eq(1)
+
+                with m.Case(Opcodes.ADD_R0):
+                    m.d.sync += r0.eq(r0 + value)
+                    m.d.comb += done.eq(1)
+
+                with m.Case(Opcodes.MOV_R1):
+                    m.d.sync += r1.eq(value)
+                    m.d.comb += done.eq(1)
+
+                with m.Case(Opcodes.ADD_R1):
+                    m.d.sync += r1.eq(r1 + value)
+                    m.d.comb += done.eq(1)
+
+                with m.Case(Opcodes.READ):
+                    transfer(value, we=False)
+
+                with m.Case(Opcodes.WRITE_R0):
+                    transfer(value, we=True, dat_w=r0)
+
+                with m.Case(Opcodes.WRITE_R1):
+                    transfer(value, we=True, dat_w=r1)
+
+                with m.Case(Opcodes.WRITE_IMM):
+                    transfer(r0, we=True, dat_w=value)
+
+                with m.Case(Opcodes.WRITE_INC):
+                    transfer(r0, we=True, dat_w=value, done_stmts=[r0.eq(r0 + 4)])
+
+                with m.Case(Opcodes.BURST):
+                    m.d.sync += burst.eq(value)
+                    m.d.comb += done.eq(1)
+
+                with m.Case(Opcodes.JMP):
+                    m.d.comb += pc_next.eq(value)
+
+                with m.Case(Opcodes.LOOP):
+                    m.d.sync += r1.eq(r1 - 1)
+                    with m.If(r1 != 1):
+                        m.d.comb += pc_next.eq(value)
+                    with m.Else():
+                        m.d.comb += done.eq(1)
+
+                with m.Case(Opcodes.JNZ):
+                    with m.If(r0 != 0):
+                        m.d.comb += pc_next.eq(value)
+                    with m.Else():
+                        m.d.comb += done.eq(1)
+
+                with m.Case(Opcodes.WFI):
+                    with m.If((irq & value[:8]) == value[:8]):
+                        m.d.comb += done.eq(1)
+
+                with m.Case():
+                    m.d.comb += done.eq(1)
+
+        return m
+
 class BusControllerTest(FHDLTestCase):
 
     def test_basic(self):
@@ -195,3 +437,210 @@ class BusControllerTest(FHDLTestCase):
         sim.add_sync_process(process)
         with sim.write_vcd("test.vcd"):
             sim.run()
+
+class BusControllerProgramTest(FHDLTestCase):
+
+    controllers = [
+        ("BusController", BusController, {}),
+        ("PipelinedBusController", PipelinedBusController, {}),
+        ("PipelinedBusController, back_to_back", PipelinedBusController, {"back_to_back": True}),
+    ]
+
+    def slave(self, m, bus, back_to_back):
+        mem = Memory(width=32, depth=64)
+        m.submodules.mem_rd = mem_rd = mem.read_port()
+        m.submodules.mem_wr = mem_wr = mem.write_port()
+        m.d.comb += [
+            mem_rd.addr.eq(bus.adr[2:]),
+            mem_wr.addr.eq(bus.adr[2:]),
+            mem_wr.data.eq(bus.dat_w),
+            bus.dat_r.eq(mem_rd.data),
+        ]
+
+        if back_to_back:
+            with m.If(bus.cyc & bus.stb):
+                m.d.comb += mem_wr.en.eq(bus.we & ~bus.ack)
+                m.d.sync += bus.ack.eq(~bus.ack)
+        else:
+            # Needs a cycle with deasserted cyc/stb between transfers, like BusWrapper users
+            ack_r = Signal()
+            with m.If(bus.cyc & bus.stb):
+                m.d.comb += mem_wr.en.eq(bus.we & ~ack_r)
+                m.d.sync += bus.ack.eq(ack_r)
+                m.d.sync += ack_r.eq(0)
+            with m.Else():
+                m.d.sync += ack_r.eq(1)
+
+        return mem
+
+    def test_program(self):
+        program = [
+            Asm.MOV_R0(5),                  # 0
+            Asm.ADD_R0(3),
+            Asm.WRITE_R0(0x10),
+            Asm.MOV_R0(0x20),
+            Asm.WRITE_IMM(0xabc),
+            Asm.WRITE_IMM(0xdef),           # 5
+            Asm.READ(0x10),
+            Asm.ADD_R0(1),
+            Asm.WRITE_R0(0x14),
+            Asm.JMP(11),
+            Asm.WRITE_R0(0x18),             # 10
+            Asm.WFI(0b1),
+            Asm.MOV_R0(0x1234),
+            Asm.WRITE_R0(0x1c),
+
+            # Counted loop, R0 counts the iterations
+            Asm.MOV_R1(4),
+            Asm.MOV_R0(0),                  # 15
+            Asm.WRITE_R1(0x24),
+            Asm.ADD_R0(1),
+            Asm.LOOP(16),
+            Asm.WRITE_R0(0x28),
+
+            # Post-increment and burst
+            Asm.MOV_R0(0x40),               # 20
+            Asm.WRITE_INC(0x11),
+            Asm.WRITE_INC(0x22),
+            *Asm.BURST([0x33, 0x44, 0x55]),
+            Asm.WRITE_IMM(0x66),            # 27
+            Asm.WRITE_R0(0x2c),
+
+            # Branches on R0
+            Asm.MOV_R0(0),
+            Asm.JNZ(33),                    # 30
+            Asm.MOV_R0(1),
+            Asm.JNZ(34),
+            Asm.WRITE_R0(0x30),
+            Asm.JMP(34),
+        ]
+
+        for name, controller, kwargs in self.controllers:
+            with self.subTest(controller=name):
+                m = Module()
+                wb = Record(get_layout())
+                irq = Signal()
+                m.submodules.buscontroller = controller(
+                    bus=wb, irq=irq, program=program, **kwargs)
+                mem = self.slave(m, wb, kwargs.get("back_to_back", False))
+
+                sim = Simulator(m)
+                sim.add_clock(1/10e6, domain="sync")
+
+                def process():
+                    for _ in range(100):
+                        yield
+                    self.assertEqual((yield mem[0x1c // 4]), 0)
+                    yield irq.eq(1)
+                    for _ in range(300):
+                        yield
+                    self.assertEqual((yield mem[0x10 // 4]), 8)
+                    self.assertEqual((yield mem[0x14 // 4]), 9)
+                    self.assertEqual((yield mem[0x18 // 4]), 0)
+                    self.assertEqual((yield mem[0x1c // 4]), 0x1234)
+                    self.assertEqual((yield mem[0x20 // 4]), 0xdef)
+                    self.assertEqual((yield mem[0x24 // 4]), 1)
+                    self.assertEqual((yield mem[0x28 // 4]), 4)
+                    self.assertEqual((yield mem[0x2c // 4]), 0x54)
+                    self.assertEqual((yield mem[0x30 // 4]), 0)
+                    for i, v in enumerate([0x11, 0x22, 0x33, 0x44, 0x55, 0x66]):
+                        self.assertEqual((yield mem[0x40 // 4 + i]), v)
+
+                sim.add_sync_process(process)
+                sim.run()
+
+    def cycles(self, program, pipelined, back_to_back=False):
+        """
+        Model of the cycles from the first to the second write to the first written
+        address, with all interrupts asserted
+        """
+        pc, r0, r1, burst = 0, 0, 0, 0
+        total = 0
+        prev_bus = False
+        first = None
+        writes = []
+        while len(writes) < 2:
+            opcode, value = Opcodes(program[pc] >> 32), program[pc] & 0xffffffff
+            is_bus = burst != 0 or opcode in BUS_OPCODES
+            total += instruction_cycles(is_bus, prev_bus, pipelined, back_to_back)
+            prev_bus = is_bus
+
+            adr = None
+            pc += 1
+            if burst != 0:
+                adr = r0
+                r0 += 4
+                burst -= 1
+            elif opcode == Opcodes.MOV_R0:
+                r0 = value
+            elif opcode == Opcodes.ADD_R0:
+                r0 = (r0 + value) & 0xffffffff
+            elif opcode == Opcodes.MOV_R1:
+                r1 = value
+            elif opcode == Opcodes.ADD_R1:
+                r1 = (r1 + value) & 0xffffffff
+            elif opcode in [Opcodes.WRITE_R0, Opcodes.WRITE_R1]:
+                adr = value
+            elif opcode == Opcodes.WRITE_IMM:
+                adr = r0
+            elif opcode == Opcodes.WRITE_INC:
+                adr = r0
+                r0 += 4
+            elif opcode == Opcodes.BURST:
+                burst = value
+            elif opcode == Opcodes.JMP:
+                pc = value
+            elif opcode == Opcodes.LOOP:
+                r1 = (r1 - 1) & 0xffffffff
+                if r1 != 0:
+                    pc = value
+            elif opcode == Opcodes.JNZ:
+                if r0 != 0:
+                    pc = value
+
+            if adr is not None:
+                if first is None:
+                    first = adr
+                if adr == first:
+                    writes.append(total)
+
+        return writes[1] - writes[0]
+
+    def test_gfxdemo_cycles(self):
+        """
+        Cycles of one iteration of gfxdemo_program with all interrupts asserted
+        """
+        from ...applets.gfxdemo import gfxdemo_program
+
+        results = {}
+        for name, controller, kwargs in self.controllers:
+            m = Module()
+            wb = Record(get_layout())
+            m.submodules.buscontroller = controller(
+                bus=wb, irq=Const(0b111, 3), program=gfxdemo_program, **kwargs)
+            self.slave(m, wb, kwargs.get("back_to_back", False))
+
+            sim = Simulator(m)
+            sim.add_clock(1/25e6, domain="sync")
+
+            def process():
+                # Cycles between the two first writes of the DAC value, the first write
+                writes = []
+                cycle = 0
+                while len(writes) < 2:
+                    yield
+                    cycle += 1
+                    if (yield wb.ack) and (yield wb.adr) == 0x3000_0000:
+                        writes.append(cycle)
+                results[name] = writes[1] - writes[0]
+
+            sim.add_sync_process(process)
+            sim.run()
+
+        self.assertEqual(results["BusController"],
+                         self.cycles(gfxdemo_program, pipelined=False))
+        self.assertEqual(results["PipelinedBusController"],
+                         self.cycles(gfxdemo_program, pipelined=True))
+        self.assertEqual(results["PipelinedBusController, back_to_back"],
+                         self.cycles(gfxdemo_program, pipelined=True, back_to_back=True))
+        self.assertLess(results["PipelinedBusController"], results["BusController"] * 2 // 3)
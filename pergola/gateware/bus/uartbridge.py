@@ -0,0 +1,231 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+
+from enum import IntEnum
+
+from ...util.test import FHDLTestCase
+from ..uart import UART
+from .wb import get_layout
+
+
+class UARTBridgeCommand(IntEnum):
+    WRITE = 0x01
+    READ  = 0x02
+
+
+class UARTBridge(Elaboratable):
+    """
+    Wishbone bus master controlled by a host over a UART.
+
+    All values are sent MSB first, addresses are byte addresses like for BusController.
+
+    WRITE:  0x01, addr[4], data[4]
+    READ:   0x02, addr[4]           Replies with data[4]
+
+    A transaction that is not acked within bus_timeout cycles is aborted, reads
+    then return 0.
+
+    uart:   UART instance, the bridge consumes all received bytes
+    bus:    Wishbone bus with 32 bit addresses and data
+
+    stream_data, stream_valid, stream_ready:
+            Bytes to send to the host unrequested, e.g. bulk data. They are sent
+            while the bridge is waiting for a command.
+    """
+
+    def __init__(self, uart, bus, bus_timeout=100):
+        self.uart = uart
+        self.bus = bus
+        self.bus_timeout = bus_timeout
+
+        self.stream_data = Signal(8)
+        self.stream_valid = Signal()
+        self.stream_ready = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        uart = self.uart
+        bus = self.bus
+
+        cmd = Signal(8)
+        addr = Signal(32)
+        data = Signal(32)
+        count = Signal(range(5))
+        tmo_ctr = Signal(range(self.bus_timeout + 1), reset=self.bus_timeout)
+
+        # The received byte is taken right away, so the next one can always be received
+        rx_taken = Signal()
+        rx_strobe = Signal()
+        m.d.comb += [
+            uart.rx_ack.eq(1),
+            rx_strobe.eq(uart.rx_rdy & ~rx_taken & ~uart.rx_err),
+        ]
+        with m.If(~uart.rx_rdy):
+            m.d.sync += rx_taken.eq(0)
+        with m.Elif(rx_strobe):
+            m.d.sync += rx_taken.eq(1)
+
+        with m.FSM():
+            with m.State("CMD"):
+                m.d.comb += [
+                    uart.tx_data.eq(self.stream_data),
+                    uart.tx_rdy.eq(self.stream_valid),
+                    self.stream_ready.eq(uart.tx_ack),
+                ]
+                with m.If(rx_strobe):
+                    m.d.sync += [
+                        cmd.eq(uart.rx_data),
+                        count.eq(4),
+                    ]
+                    with m.If((uart.rx_data == UARTBridgeCommand.WRITE) |
+                              (uart.rx_data == UARTBridgeCommand.READ)):
+                        m.next = "ADDR"
+
+            with m.State("ADDR"):
+                with m.If(rx_strobe):
+                    m.d.sync += [
+                        addr.eq(Cat(uart.rx_data, addr[:-8])),
+                        count.eq(count - 1),
+                    ]
+                    with m.If(count == 1):
+                        with m.If(cmd == UARTBridgeCommand.WRITE):
+                            m.d.sync += count.eq(4)
+                            m.next = "DATA"
+                        with m.Else():
+                            m.next = "BUS"
+
+            with m.State("DATA"):
+                with m.If(rx_strobe):
+                    m.d.sync += [
+                        data.eq(Cat(uart.rx_data, data[:-8])),
+                        count.eq(count - 1),
+                    ]
+                    with m.If(count == 1):
+                        m.next = "BUS"
+
+            with m.State("BUS"):
+                m.d.comb += [
+                    bus.cyc.eq(1),
+                    bus.stb.eq(1),
+                    bus.adr.eq(addr),
+                    bus.dat_w.eq(data),
+                    bus.sel.eq(-1),
+                    bus.we.eq(cmd == UARTBridgeCommand.WRITE),
+                ]
+                m.d.sync += tmo_ctr.eq(tmo_ctr - 1)
+                with m.If(bus.ack | (tmo_ctr == 0)):
+                    m.d.sync += [
+                        tmo_ctr.eq(self.bus_timeout),
+                        data.eq(Mux(bus.ack, bus.dat_r, 0)),
+                        count.eq(4),
+                    ]
+                    with m.If(cmd == UARTBridgeCommand.WRITE):
+                        m.next = "CMD"
+                    with m.Else():
+                        m.next = "REPLY"
+
+            with m.State("REPLY"):
+                m.d.comb += [
+                    uart.tx_data.eq(data[-8:]),
+                    uart.tx_rdy.eq(1),
+                ]
+                with m.If(uart.tx_ack):
+                    m.d.sync += [
+                        data.eq(data << 8),
+                        count.eq(count - 1),
+                    ]
+                    with m.If(count == 1):
+                        m.next = "CMD"
+
+        return m
+
+
+class UARTBridgeTest(FHDLTestCase):
+
+    def test_write_read(self):
+        m = Module()
+
+        divisor = 4
+
+        m.submodules.uart = uart = UART(divisor=divisor)
+        m.submodules.host = host = UART(divisor=divisor)
+        m.d.comb += [
+            uart.rx_i.eq(host.tx_o),
+            host.rx_i.eq(uart.tx_o),
+        ]
+
+        bus = Record(get_layout())
+        m.submodules.bridge = bridge = UARTBridge(uart, bus)
+
+        # A few registers at 0x1000, acked one cycle later
+        regs = Array(Signal(32, name=f"reg{i}") for i in range(4))
+        with m.If(bus.cyc & bus.stb & ~bus.ack & (bus.adr[4:] == 0x100)):
+            m.d.sync += bus.ack.eq(1)
+            with m.If(bus.we):
+                m.d.sync += regs[bus.adr[2:4]].eq(bus.dat_w)
+            with m.Else():
+                m.d.sync += bus.dat_r.eq(regs[bus.adr[2:4]])
+        with m.Else():
+            m.d.sync += bus.ack.eq(0)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def send(data):
+            for byte in data:
+                yield host.tx_data.eq(byte)
+                yield host.tx_rdy.eq(1)
+                yield
+                while not (yield host.tx_ack):
+                    yield
+                yield host.tx_rdy.eq(0)
+                yield
+
+        def receive(n):
+            data = []
+            yield host.rx_ack.eq(1)
+            for i in range(n):
+                # rx_rdy stays set until the next start bit
+                while (yield host.rx_rdy):
+                    yield
+                while not (yield host.rx_rdy):
+                    yield
+                data.append((yield host.rx_data))
+            return data
+
+        def process():
+            yield from send([UARTBridgeCommand.WRITE, 0x00, 0x00, 0x10, 0x08, 0x12, 0x34, 0x56, 0x78])
+            yield from send([UARTBridgeCommand.WRITE, 0x00, 0x00, 0x10, 0x04, 0xca, 0xfe, 0xba, 0xbe])
+            yield from send([UARTBridgeCommand.READ, 0x00, 0x00, 0x10, 0x08])
+            self.assertEqual((yield from receive(4)), [0x12, 0x34, 0x56, 0x78])
+            yield from send([UARTBridgeCommand.READ, 0x00, 0x00, 0x10, 0x04])
+            self.assertEqual((yield from receive(4)), [0xca, 0xfe, 0xba, 0xbe])
+
+            # Unmapped addresses time out and read as 0
+            yield from send([UARTBridgeCommand.READ, 0x00, 0x00, 0x20, 0x00])
+            self.assertEqual((yield from receive(4)), [0, 0, 0, 0])
+
+        def stream_process():
+            # Wait for the last reply to start
+            for _ in range(3000):
+                yield
+            for byte in [0x55, 0xaa]:
+                yield bridge.stream_data.eq(byte)
+                yield bridge.stream_valid.eq(1)
+                yield
+                while not (yield bridge.stream_ready):
+                    yield
+                yield bridge.stream_valid.eq(0)
+                yield
+
+        def stream_receive_process():
+            for _ in range(3000):
+                yield
+            self.assertEqual((yield from receive(2)), [0x55, 0xaa])
+
+        sim.add_sync_process(process)
+        sim.add_sync_process(stream_process)
+        sim.add_sync_process(stream_receive_process)
+        with sim.write_vcd("uartbridge.vcd"):
+            sim.run()
@@ -0,0 +1,290 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+
+from .bus.buswrapper import BusWrapper, AccessFlags
+from .bus.wb import get_layout
+from ..util.test import FHDLTestCase, wb_write
+
+
+CAPTURE_MAGIC = b"PGC"
+
+
+class FrameCapture(Elaboratable):
+    """
+    Captures a region of a video frame into block RAM and sends it run-length
+    encoded as a byte stream, e.g. to UARTBridge.stream_*.
+
+    A capture is started by writing to the control register. The next complete
+    frame is sampled: starting at (x, y), every 2**shift'th pixel of every
+    2**shift'th line is stored as RGB332 until width x height pixels are stored.
+    Then the stream is sent:
+
+        "PGC", width[2], height[2], (count, pixel)..., 0
+
+    where count is 1 to 255 and everything is MSB first. See pergola/host/capture.py.
+
+    h_ctr, v_ctr:   Position of the pixel, e.g. from VGAOutputSubtarget
+    r, g, b:        Pixel
+    width, height:  Size of the captured image
+
+    wb:             Wishbone bus with byte addresses. Offsets from base_addr:
+                    0x0: Control, write to capture. Reads 1 while busy.
+                    0x4: x [0:12], y [16:28]
+                    0x8: shift, 0 to 7
+    stream_data, stream_valid, stream_ready:
+                    Byte stream of the captured image
+    """
+
+    def __init__(self, h_ctr, v_ctr, r, g, b, width=160, height=120, base_addr=0):
+        self.h_ctr = h_ctr
+        self.v_ctr = v_ctr
+        self.r = r
+        self.g = g
+        self.b = b
+        self.width = width
+        self.height = height
+        self.base_addr = base_addr
+
+        self.busy = Signal()
+        self.origin = Signal(32)
+        self.shift = Signal(3)
+
+        self.mem = Memory(width=8, depth=width * height)
+
+        self.wb = Record(get_layout())
+
+        self.stream_data = Signal(8)
+        self.stream_valid = Signal()
+        self.stream_ready = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        wb = self.wb
+        h_ctr = self.h_ctr
+        v_ctr = self.v_ctr
+        pixels = self.width * self.height
+
+        # Registers
+        m.submodules.regs = regs = BusWrapper(
+            address_width=2,
+            signals_r=[self.busy, self.origin, self.shift],
+        )
+        regs.add_endpoints(AccessFlags.W, [self.origin, self.shift], start=1)
+
+        ack_r = Signal()
+        m.d.comb += [
+            regs.we.eq(wb.we),
+            regs.addr.eq(wb.adr[2:4]),
+            regs.write_data.eq(wb.dat_w),
+            wb.dat_r.eq(regs.read_data),
+        ]
+        with m.If(wb.cyc & wb.stb):
+            m.d.comb += regs.cs.eq(~ack_r)
+            m.d.sync += wb.ack.eq(ack_r)
+            m.d.sync += ack_r.eq(0)
+        with m.Else():
+            m.d.sync += ack_r.eq(1)
+
+        trigger = Signal()
+        m.d.comb += trigger.eq(regs.cs & regs.we & (regs.addr == 0))
+
+        # Sampling
+        m.submodules.wr = wr = self.mem.write_port()
+        m.submodules.rd = rd = self.mem.read_port()
+
+        rel_x = Signal(13)
+        rel_y = Signal(13)
+        mask = Signal((1 << len(self.shift)) - 1)
+        sample = Signal()
+        m.d.comb += [
+            rel_x.eq(h_ctr - self.origin[0:12]),
+            rel_y.eq(v_ctr - self.origin[16:28]),
+            mask.eq((1 << self.shift) - 1),
+            sample.eq(((rel_x & mask) == 0) & ((rel_y & mask) == 0) &
+                      ((rel_x >> self.shift) < self.width) &
+                      ((rel_y >> self.shift) < self.height)),
+            wr.data.eq(Cat(self.b[6:8], self.g[5:8], self.r[5:8])),
+        ]
+
+        addr = Signal(range(pixels + 1))
+        m.d.comb += [
+            wr.addr.eq(addr),
+            rd.addr.eq(addr),
+        ]
+
+        frame_start = Signal()
+        capturing = Signal()
+        m.d.comb += frame_start.eq((h_ctr == 0) & (v_ctr == 0))
+
+        # Encoding
+        header = Array(Const(v, 8) for v in list(CAPTURE_MAGIC) + [
+            self.width >> 8, self.width & 0xff, self.height >> 8, self.height & 0xff])
+        index = Signal(range(len(header)))
+        value = Signal(8)
+        run = Signal(8)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(trigger):
+                    m.d.sync += self.busy.eq(1)
+                    m.next = "WAIT"
+
+            with m.State("WAIT"):
+                m.d.sync += addr.eq(0)
+                with m.If(frame_start):
+                    m.d.comb += capturing.eq(1)
+                    m.next = "CAPTURE"
+
+            with m.State("CAPTURE"):
+                # Regions outside of the frame are left as they are
+                with m.If((addr == pixels) | frame_start):
+                    m.d.sync += [
+                        addr.eq(0),
+                        index.eq(0),
+                    ]
+                    m.next = "HEADER"
+                with m.Else():
+                    m.d.comb += capturing.eq(1)
+
+            with m.State("HEADER"):
+                m.d.comb += [
+                    self.stream_data.eq(header[index]),
+                    self.stream_valid.eq(1),
+                ]
+                with m.If(self.stream_ready):
+                    m.d.sync += index.eq(index + 1)
+                    with m.If(index == len(header) - 1):
+                        m.d.sync += run.eq(0)
+                        m.next = "FETCH"
+
+            with m.State("FETCH"):
+                # rd.data is valid in the next cycle
+                m.next = "COMPARE"
+
+            with m.State("COMPARE"):
+                with m.If(addr == pixels):
+                    m.next = "COUNT"
+                with m.Elif((run == 0) | ((rd.data == value) & (run != 255))):
+                    m.d.sync += [
+                        value.eq(rd.data),
+                        run.eq(run + 1),
+                        addr.eq(addr + 1),
+                    ]
+                    m.next = "FETCH"
+                with m.Else():
+                    m.next = "COUNT"
+
+            with m.State("COUNT"):
+                m.d.comb += [
+                    self.stream_data.eq(run),
+                    self.stream_valid.eq(1),
+                ]
+                with m.If(self.stream_ready):
+                    m.next = "VALUE"
+
+            with m.State("VALUE"):
+                m.d.comb += [
+                    self.stream_data.eq(value),
+                    self.stream_valid.eq(1),
+                ]
+                with m.If(self.stream_ready):
+                    m.d.sync += run.eq(0)
+                    with m.If(addr == pixels):
+                        m.next = "END"
+                    with m.Else():
+                        m.next = "FETCH"
+
+            with m.State("END"):
+                m.d.comb += [
+                    self.stream_data.eq(0),
+                    self.stream_valid.eq(1),
+                ]
+                with m.If(self.stream_ready):
+                    m.d.sync += self.busy.eq(0)
+                    m.next = "IDLE"
+
+        with m.If(capturing & sample & (addr != pixels)):
+            m.d.comb += wr.en.eq(1)
+            m.d.sync += addr.eq(addr + 1)
+
+        return m
+
+
+class FrameCaptureTest(FHDLTestCase):
+
+    def test_capture(self):
+        self.check_capture(48, 36, 20, 16, [(3, 2, 0), (1, 1, 1)])
+
+    def test_capture_sparse(self):
+        # Every 64th pixel, the mask is as wide as the largest shift
+        self.check_capture(136, 72, 2, 2, [(3, 2, 6)])
+
+    def check_capture(self, h_total, v_total, width, height, captures):
+        from ..host.capture import decode_capture
+
+        h_active, v_active = h_total - 4, v_total - 2
+
+        m = Module()
+
+        h_ctr = Signal(12)
+        v_ctr = Signal(12)
+        r = Signal(8)
+        g = Signal(8)
+        b = Signal(8)
+        m.submodules.capture = capture = FrameCapture(h_ctr, v_ctr, r, g, b, width=width, height=height)
+        wb = capture.wb
+
+        def pixel(x, y):
+            # A run longer than 255 pixels, then short runs
+            if y < 16:
+                return (0x20, 0x40, 0x80)
+            return (((x // 4) * 0x20) & 0xff, (y * 0x20) & 0xff, 0xc0 if x < 16 else 0x40)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def video_process():
+            for frame in range(3 * len(captures)):
+                for y in range(v_total):
+                    for x in range(h_total):
+                        yield h_ctr.eq(x)
+                        yield v_ctr.eq(y)
+                        rgb = pixel(x, y) if x < h_active and y < v_active else (0, 0, 0)
+                        yield Cat(r, g, b).eq(rgb[0] | (rgb[1] << 8) | (rgb[2] << 16))
+                        yield
+
+        def receive():
+            data = []
+            yield capture.stream_ready.eq(1)
+            while True:
+                yield
+                if (yield capture.stream_valid):
+                    data.append((yield capture.stream_data))
+                    if len(data) > 7 and len(data) % 2 == 0 and data[-1] == 0:
+                        break
+            yield capture.stream_ready.eq(0)
+            return bytes(data)
+
+        def expected(x0, y0, shift):
+            image = []
+            for y in range(height):
+                for x in range(width):
+                    r, g, b = pixel(x0 + (x << shift), y0 + (y << shift))
+                    image.append((r & 0xe0) | ((g & 0xe0) >> 3) | (b >> 6))
+            return image
+
+        def process():
+            for x0, y0, shift in captures:
+                yield from wb_write(wb, 0x4, (y0 << 16) | x0)
+                yield from wb_write(wb, 0x8, shift)
+                yield from wb_write(wb, 0x0, 1)
+                data = yield from receive()
+                w, h, image = decode_capture(data)
+                self.assertEqual((w, h), (width, height))
+                self.assertEqual(image, expected(x0, y0, shift))
+
+        sim.add_sync_process(video_process)
+        sim.add_sync_process(process)
+        with sim.write_vcd(f"capture_{width}x{height}.vcd"):
+            sim.run()
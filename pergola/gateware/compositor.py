@@ -0,0 +1,338 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+from nmigen.utils import bits_for
+
+from .bus.buswrapper import BusWrapper, AccessFlags
+from .bus.wb import get_layout
+from ..util.test import FHDLTestCase, wb_write
+
+
+def argb4444(a, r, g, b):
+    return ((a & 0xf) << 12) | ((r & 0xf) << 8) | ((g & 0xf) << 4) | (b & 0xf)
+
+
+def blend(bg, argb, channel):
+    """
+    Reference model of one blending stage for one 8-bit channel (0: r, 1: g, 2: b).
+    """
+    a = (argb >> 12) & 0xf
+    fg = (argb >> (8 - 4 * channel)) & 0xf
+    fg = fg * 0x11
+    a = a + (a >> 3)
+    return bg + (((fg - bg) * a) >> 4)
+
+
+class Compositor(Elaboratable):
+    """
+    Draws a character cell text layer and hardware sprites on top of a video stream.
+
+    Pixels are ARGB4444 with a 4-bit alpha, 0 is transparent and 15 opaque. Every
+    layer is blended onto the result of the layer below in its own pipeline stage,
+    one multiplier per channel and layer, which map to the ECP5 DSP blocks. The
+    layers from bottom to top are the video input, the text layer and sprite 0 to
+    n_sprites - 1.
+
+    h_ctr, v_ctr:   Position of the input pixel, e.g. from VGAOutputSubtarget
+    in_r/g/b:       Input pixel
+    out_r/g/b:      Output pixel, `latency` cycles after the input
+
+    n_sprites:      Number of sprites
+    sprite_size:    Sprites are sprite_size x sprite_size pixels, power of two
+    text_cols:      Text layer size in 8x8 pixel cells
+    text_rows:
+    base_addr:      Base address of `wb`
+
+    wb:             Wishbone bus with byte addresses to update the layers. Only the
+                    registers can be read back. Offsets from base_addr:
+
+    0x0000 + 4 * i: Sprite i position, x [0:12], y [16:28], enable [31]
+    0x0040:         Text layer position, x [0:12], y [16:28], enable [31]
+    0x0080 + 4 * i: Text palette entry i of 16, ARGB4444. Entry 0 is transparent and
+                    entry 1 is opaque white after reset.
+    memory_map:     Base addresses of the memories:
+        "text":     Cells, one per word, char [0:8], foreground palette entry [8:12],
+                    background palette entry [12:16]. Rows are text_stride cells apart.
+        "font":     8x8 font, one row per word, 8 words per char, bit 7 is the leftmost
+                    pixel
+        "sprite{i}": Pixels of sprite i in ARGB4444, row by row
+    """
+
+    def __init__(self, h_ctr, v_ctr, in_r, in_g, in_b, out_r, out_g, out_b, n_sprites=4,
+                 sprite_size=32, text_cols=80, text_rows=30, base_addr=0):
+        assert(sprite_size & (sprite_size - 1) == 0)
+        assert(n_sprites <= 16)
+
+        self.h_ctr = h_ctr
+        self.v_ctr = v_ctr
+        self.in_r = in_r
+        self.in_g = in_g
+        self.in_b = in_b
+        self.out_r = out_r
+        self.out_g = out_g
+        self.out_b = out_b
+        self.n_sprites = n_sprites
+        self.sprite_size = sprite_size
+        self.text_cols = text_cols
+        self.text_rows = text_rows
+        self.base_addr = base_addr
+
+        self.latency = 5 + n_sprites
+
+        self.sprite_bits = bits_for(sprite_size - 1)
+        self.text_col_bits = bits_for(text_cols - 1)
+        self.text_stride = 1 << self.text_col_bits
+
+        self.sprite_regs = [Signal(32, name=f"sprite{i}") for i in range(n_sprites)]
+        self.text_reg = Signal(32)
+        self.palette = Array(Signal(16, name=f"palette{i}", reset={1: 0xffff}.get(i, 0))
+                             for i in range(16))
+
+        self.text = Memory(width=16, depth=text_rows * self.text_stride)
+        self.font = Memory(width=8, depth=256 * 8)
+        self.sprites = [Memory(width=16, depth=sprite_size * sprite_size) for _ in range(n_sprites)]
+
+        # All memories get a region of the same, power of two, size after the registers
+        memories = [("text", self.text), ("font", self.font)]
+        memories += [(f"sprite{i}", mem) for i, mem in enumerate(self.sprites)]
+        self.region_bits = 2 + max(bits_for(mem.depth - 1) for _, mem in memories)
+        self.memories = memories
+        self.memory_map = {name: base_addr + ((i + 1) << self.region_bits)
+                           for i, (name, _) in enumerate(memories)}
+
+        self.wb = Record(get_layout())
+
+    def elaborate(self, platform):
+        m = Module()
+
+        wb = self.wb
+        h_ctr = self.h_ctr
+        v_ctr = self.v_ctr
+
+        # Registers
+        m.submodules.regs = regs = BusWrapper(address_width=6, signals_rw=self.sprite_regs)
+        for flags in [AccessFlags.R, AccessFlags.W]:
+            regs.add_endpoints(flags, [self.text_reg], start=0x10)
+            regs.add_endpoints(flags, self.palette, start=0x20)
+
+        # Bus
+        region = Signal(range(len(self.memories) + 1))
+        ack_r = Signal()
+        m.d.comb += [
+            region.eq(wb.adr[self.region_bits:] - (self.base_addr >> self.region_bits)),
+            regs.we.eq(wb.we),
+            regs.addr.eq(wb.adr[2:8]),
+            regs.write_data.eq(wb.dat_w),
+            wb.dat_r.eq(regs.read_data),
+        ]
+        with m.If(wb.cyc & wb.stb):
+            m.d.sync += wb.ack.eq(ack_r)
+            m.d.sync += ack_r.eq(0)
+            with m.If(region == 0):
+                m.d.comb += regs.cs.eq(~ack_r)
+        with m.Else():
+            m.d.sync += ack_r.eq(1)
+
+        for i, (name, mem) in enumerate(self.memories):
+            m.submodules[f"{name}_wr"] = wr = mem.write_port()
+            m.d.comb += [
+                wr.addr.eq(wb.adr[2:]),
+                wr.data.eq(wb.dat_w),
+                wr.en.eq(wb.cyc & wb.stb & wb.we & ~ack_r & (region == i + 1)),
+            ]
+
+        # Stage 0: Position relative to the text layer
+        text_x = Signal(12)
+        text_y = Signal(12)
+        text_en = Signal()
+        m.d.comb += Cat(text_x, text_y).eq(Cat(self.text_reg[0:12], self.text_reg[16:28]))
+        m.d.comb += text_en.eq(self.text_reg[31])
+
+        t1_x = Signal(13)
+        t1_y = Signal(13)
+        m.d.sync += [
+            t1_x.eq(h_ctr - text_x),
+            t1_y.eq(v_ctr - text_y),
+        ]
+
+        # Stage 1: Read the cell
+        m.submodules.text_rd = text_rd = self.text.read_port()
+        t2_in = Signal()
+        t2_fx = Signal(3)
+        t2_fy = Signal(3)
+        m.d.comb += text_rd.addr.eq(Cat(t1_x[3:3 + self.text_col_bits], t1_y[3:]))
+        m.d.sync += [
+            t2_in.eq(text_en & (t1_x < 8 * self.text_cols) & (t1_y < 8 * self.text_rows)),
+            t2_fx.eq(t1_x[:3]),
+            t2_fy.eq(t1_y[:3]),
+        ]
+
+        # Stage 2: Read the font row of the char
+        m.submodules.font_rd = font_rd = self.font.read_port()
+        t3_in = Signal()
+        t3_fx = Signal(3)
+        t3_fg = Signal(4)
+        t3_bg = Signal(4)
+        m.d.comb += font_rd.addr.eq(Cat(t2_fy, text_rd.data[0:8]))
+        m.d.sync += [
+            t3_in.eq(t2_in),
+            t3_fx.eq(t2_fx),
+            t3_fg.eq(text_rd.data[8:12]),
+            t3_bg.eq(text_rd.data[12:16]),
+        ]
+
+        # Stage 3: Look up the color
+        t4_argb = Signal(16)
+        font_pixel = Signal()
+        m.d.comb += font_pixel.eq((font_rd.data << t3_fx)[7])
+        m.d.sync += t4_argb.eq(Mux(t3_in, self.palette[Mux(font_pixel, t3_fg, t3_bg)], 0))
+
+        # Sprites
+        sprite_argb = []
+        for i, (reg, mem) in enumerate(zip(self.sprite_regs, self.sprites)):
+            s1_x = Signal(13, name=f"sprite{i}_x")
+            s1_y = Signal(13, name=f"sprite{i}_y")
+            s1_en = Signal(name=f"sprite{i}_en")
+            m.d.sync += [
+                s1_x.eq(h_ctr - reg[0:12]),
+                s1_y.eq(v_ctr - reg[16:28]),
+                s1_en.eq(reg[31]),
+            ]
+
+            m.submodules[f"sprite{i}_rd"] = rd = mem.read_port()
+            s2_in = Signal(name=f"sprite{i}_in")
+            m.d.comb += rd.addr.eq(Cat(s1_x[:self.sprite_bits], s1_y[:self.sprite_bits]))
+            m.d.sync += s2_in.eq(s1_en & (s1_x < self.sprite_size) & (s1_y < self.sprite_size))
+
+            argb = Signal(16, name=f"sprite{i}_argb_s3")
+            m.d.sync += argb.eq(Mux(s2_in, rd.data, 0))
+
+            # Sprite i is blended in stage 5 + i
+            for stage in range(4, 6 + i):
+                argb_r = Signal(16, name=f"sprite{i}_argb_s{stage}")
+                m.d.sync += argb_r.eq(argb)
+                argb = argb_r
+            sprite_argb.append(argb)
+
+        # Delay the input pixel to stage 4
+        rgb = Cat(self.in_r, self.in_g, self.in_b)
+        for i in range(4):
+            rgb_r = Signal(24, name=f"rgb_s{i + 1}")
+            m.d.sync += rgb_r.eq(rgb)
+            rgb = rgb_r
+
+        # Stage 4 and up: Blend the layers, bottom to top
+        for i, argb in enumerate([t4_argb] + sprite_argb):
+            alpha = Signal(5, name=f"alpha{i}")
+            m.d.comb += alpha.eq(argb[12:16] + argb[15])
+
+            blended = Signal(24, name=f"blended{i}")
+            for c in range(3):
+                bg = rgb[8 * c:8 * c + 8]
+                fg = Cat(argb[8 - 4 * c:12 - 4 * c], argb[8 - 4 * c:12 - 4 * c])
+                diff = Signal(signed(9), name=f"diff{i}_{c}")
+                m.d.comb += diff.eq(fg - bg)
+                m.d.sync += blended[8 * c:8 * c + 8].eq(bg + ((diff * alpha) >> 4))
+            rgb = blended
+
+        m.d.comb += Cat(self.out_r, self.out_g, self.out_b).eq(rgb)
+
+        return m
+
+
+class CompositorTest(FHDLTestCase):
+
+    def test_layers(self):
+        import random
+
+        random.seed(0)
+
+        width = 40
+        height = 24
+
+        m = Module()
+
+        h_ctr = Signal(12)
+        v_ctr = Signal(12)
+        in_r = Signal(8)
+        in_g = Signal(8)
+        in_b = Signal(8)
+        out_r = Signal(8)
+        out_g = Signal(8)
+        out_b = Signal(8)
+
+        m.submodules.compositor = compositor = Compositor(
+            h_ctr, v_ctr, in_r, in_g, in_b, out_r, out_g, out_b,
+            n_sprites=2, sprite_size=8, text_cols=3, text_rows=2)
+
+        wb = compositor.wb
+
+        # Contents, see the reference model below
+        font = [random.getrandbits(8) for _ in range(256 * 8)]
+        text = [random.getrandbits(16) for _ in range(2 * compositor.text_stride)]
+        sprites = [[random.getrandbits(16) for _ in range(8 * 8)] for _ in range(2)]
+        palette = [argb4444(*[random.getrandbits(4) for _ in range(4)]) for _ in range(16)]
+        sprite_pos = [(5, 3), (10, 9)]
+        text_pos = (7, 6)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def video(x, y):
+            return ((x * 7) & 0xff, (y * 11) & 0xff, ((x + y) * 5) & 0xff)
+
+        def expected(x, y):
+            layers = []
+            tx, ty = x - text_pos[0], y - text_pos[1]
+            if 0 <= tx < 8 * 3 and 0 <= ty < 8 * 2:
+                cell = text[(ty // 8) * compositor.text_stride + tx // 8]
+                row = font[(cell & 0xff) * 8 + ty % 8]
+                entry = (cell >> 8) & 0xf if (row << (tx % 8)) & 0x80 else cell >> 12
+                layers.append(palette[entry])
+            else:
+                layers.append(0)
+            for sprite, (sx, sy) in zip(sprites, sprite_pos):
+                if 0 <= x - sx < 8 and 0 <= y - sy < 8:
+                    layers.append(sprite[(y - sy) * 8 + x - sx])
+                else:
+                    layers.append(0)
+            rgb = list(video(x, y))
+            for argb in layers:
+                rgb = [blend(rgb[c], argb, c) for c in range(3)]
+            return tuple(rgb)
+
+        def process():
+            for i, v in enumerate(font):
+                yield from wb_write(wb, compositor.memory_map["font"] + 4 * i, v)
+            for i, v in enumerate(text):
+                yield from wb_write(wb, compositor.memory_map["text"] + 4 * i, v)
+            for k, sprite in enumerate(sprites):
+                for i, v in enumerate(sprite):
+                    yield from wb_write(wb, compositor.memory_map[f"sprite{k}"] + 4 * i, v)
+            for i, v in enumerate(palette):
+                yield from wb_write(wb, 0x80 + 4 * i, v)
+            for k, (x, y) in enumerate(sprite_pos):
+                yield from wb_write(wb, 4 * k, (1 << 31) | (y << 16) | x)
+            yield from wb_write(wb, 0x40, (1 << 31) | (text_pos[1] << 16) | text_pos[0])
+
+            positions = [(x, y) for y in range(height) for x in range(width)]
+            results = []
+            for i in range(len(positions) + compositor.latency):
+                if i < len(positions):
+                    x, y = positions[i]
+                    r, g, b = video(x, y)
+                    yield h_ctr.eq(x)
+                    yield v_ctr.eq(y)
+                    yield in_r.eq(r)
+                    yield in_g.eq(g)
+                    yield in_b.eq(b)
+                yield
+                results.append(((yield out_r), (yield out_g), (yield out_b)))
+
+            # Registered outputs are read one cycle late in the loop above
+            results = results[compositor.latency:]
+            for (x, y), rgb in zip(positions, results):
+                self.assertEqual(rgb, expected(x, y), (x, y))
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("compositor.vcd"):
+            sim.run()
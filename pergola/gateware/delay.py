@@ -0,0 +1,104 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+
+from ..util.test import FHDLTestCase
+
+
+class Delay(Elaboratable):
+    """Delays a signal
+
+    Delays the input signal with `depth` clock cycles.
+
+    Delays up to `threshold` cycles are a chain of registers. Longer delays are a circular
+    buffer in a memory of depth - 1 words, which is written and read at the same address,
+    plus the register of its read port. Yosys maps it to distributed RAM (16 words per
+    TRELLIS_DPR16X4) or to an EBR, so the delay costs a counter and `shape` registers instead
+    of depth * `shape` registers. With the default `threshold` of None, registers are always
+    used. A memory is not reset, so after a reset the old contents come out for `depth`
+    cycles, which rules it out for control signals that have to be low after a reset.
+
+    Cells of SystolicMatMul(8, 8, unsigned(32), buffered=True) with synth_ecp5. The delays
+    of the inputs and outputs take 2972 of the registers without memories:
+
+        delay_threshold TRELLIS_FF  TRELLIS_DPR16X4 LUT4
+        None            8980        0               6144
+        4               7343        80              6181
+        3               7061        104             6191
+        2               6872        128             6197
+
+    """
+    def __init__(self, shape, depth, threshold=None):
+        self.shape = shape
+        self.depth = depth
+        self.threshold = threshold
+
+        self.w_data = Signal(shape)
+        self.r_data = Signal(shape)
+
+    def elaborate(self, platform):
+        depth = self.depth
+
+        m = Module()
+
+        if depth == 0:
+            m.d.comb += self.r_data.eq(self.w_data)
+        elif depth == 1:
+            m.d.sync += self.r_data.eq(self.w_data)
+        elif self.threshold is None or depth <= self.threshold:
+            buffer = [Signal.like(self.w_data, name=f"buf_{n}") for n in range(depth)]
+            m.d.sync += buffer[0].eq(self.w_data)
+            m.d.comb += self.r_data.eq(buffer[-1])
+            for i in range(1, depth):
+                m.d.sync += buffer[i].eq(buffer[i - 1])
+        else:
+            memory = Memory(width=len(self.w_data), depth=depth - 1)
+            m.submodules.w_port = w_port = memory.write_port()
+            m.submodules.r_port = r_port = memory.read_port(transparent=False)
+
+            # The word read is the one written depth - 1 cycles ago
+            addr = Signal(range(depth - 1))
+            with m.If(addr == depth - 2):
+                m.d.sync += addr.eq(0)
+            with m.Else():
+                m.d.sync += addr.eq(addr + 1)
+
+            m.d.comb += [
+                w_port.addr.eq(addr),
+                w_port.data.eq(self.w_data),
+                w_port.en.eq(1),
+                r_port.addr.eq(addr),
+                self.r_data.eq(r_port.data),
+            ]
+
+        return m
+
+
+class DelayTest(FHDLTestCase):
+
+    def test_delay(self):
+        m = Module()
+
+        max_depth = 8
+        counter = Signal(8)
+        delays = []
+        for threshold in [None, 1, 3]:
+            for depth in range(max_depth):
+                delay = Delay(signed(8), depth, threshold)
+                setattr(m.submodules, f"delay_{threshold}_{depth}", delay)
+                m.d.comb += delay.w_data.eq(counter)
+                delays.append(delay)
+
+        sim = Simulator(m)
+        sim.add_clock(1/10e6, domain="sync")
+
+        def process():
+            for i in range(100):
+                yield counter.eq(i)
+                yield
+                if i > max_depth:
+                    for delay in delays:
+                        self.assertEqual((yield delay.r_data), i - delay.depth,
+                                         f"depth {delay.depth}, threshold {delay.threshold}")
+
+        sim.add_sync_process(process)
+        sim.run()
@@ -0,0 +1,197 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+
+from .tmds import TMDS_CONTROL_TOKENS
+from ..util.test import FHDLTestCase
+
+
+class TMDSDeskew(Elaboratable):
+    """
+    Per-lane elastic buffer that removes whole-character skew between TMDS channels.
+
+    Every lane is pushed through a short shift register of TMDS characters. After a
+    blanking period (at least `min_blank` control tokens in a row), each lane sees
+    a control -> data edge. The arrival time of that edge is measured on every lane
+    and the lanes that arrive early are delayed until all three lanes line up.
+
+    The alignment is re-evaluated on every blanking -> data edge, so it tracks slowly
+    changing skew without needing a reset.
+
+    Inputs are 10-bit TMDS characters in the `sync` domain, already word aligned.
+
+    in_d:      List of 3 TMDS characters (d0, d1, d2)
+
+    out_d:     List of 3 deskewed TMDS characters, one cycle of latency plus the
+               per-lane delay
+    delay:     Current per-lane delay in characters
+    aligned:   All lanes saw the last data edge within `depth` characters
+
+    depth:     Maximum correctable skew + 1, in characters
+    min_blank: Number of control tokens in a row that qualifies as blanking
+    """
+
+    def __init__(self, depth=4, min_blank=8, lanes=3):
+        assert(depth >= 2)
+
+        self.depth = depth
+        self.min_blank = min_blank
+        self.lanes = lanes
+
+        self.in_d = [Signal(10, name=f"in_d{i}") for i in range(lanes)]
+        self.out_d = [Signal(10, name=f"out_d{i}") for i in range(lanes)]
+        self.delay = [Signal(range(depth), name=f"delay_d{i}") for i in range(lanes)]
+        self.aligned = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        depth = self.depth
+        lanes = self.lanes
+        in_d = self.in_d
+        out_d = self.out_d
+        delay = self.delay
+
+        # Window that opens on the first data edge on any lane
+        window_active = Signal()
+        window_ctr = Signal(range(depth))
+        seen = Signal(lanes)
+        arrival = [Signal(range(depth), name=f"arrival_d{i}") for i in range(lanes)]
+        commit = Signal()
+
+        edges = []
+        for i in range(lanes):
+            # Delay line, taps[0] is the current input
+            taps = [in_d[i]]
+            for n in range(depth - 1):
+                buf = Signal(10, name=f"buf_d{i}_{n}")
+                m.d.sync += buf.eq(taps[-1])
+                taps.append(buf)
+
+            with m.Switch(delay[i]):
+                for n in range(depth):
+                    with m.Case(n):
+                        m.d.sync += out_d[i].eq(taps[n])
+
+            # Edge detection
+            is_ctrl = Signal(name=f"is_ctrl_d{i}")
+            m.d.comb += is_ctrl.eq(0)
+            with m.Switch(in_d[i]):
+                with m.Case(*TMDS_CONTROL_TOKENS):
+                    m.d.comb += is_ctrl.eq(1)
+
+            ctrl_run = Signal(range(self.min_blank + 1), name=f"ctrl_run_d{i}")
+            with m.If(is_ctrl):
+                with m.If(ctrl_run != self.min_blank):
+                    m.d.sync += ctrl_run.eq(ctrl_run + 1)
+            with m.Else():
+                m.d.sync += ctrl_run.eq(0)
+
+            edge = Signal(name=f"edge_d{i}")
+            m.d.comb += edge.eq(~is_ctrl & (ctrl_run == self.min_blank))
+            edges.append(edge)
+
+        with m.If(window_active):
+            m.d.sync += window_ctr.eq(window_ctr + 1)
+            for i in range(lanes):
+                with m.If(edges[i] & ~seen[i]):
+                    m.d.sync += [
+                        seen[i].eq(1),
+                        arrival[i].eq(window_ctr + 1),
+                    ]
+            with m.If((seen | Cat(*edges)).all()):
+                m.d.sync += [
+                    window_active.eq(0),
+                    commit.eq(1),
+                ]
+            with m.Elif(window_ctr == depth - 2):
+                # The last lane did not show up in time
+                m.d.sync += [
+                    window_active.eq(0),
+                    self.aligned.eq(0),
+                ]
+        with m.Elif(Cat(*edges).any()):
+            m.d.sync += [
+                window_ctr.eq(0),
+                seen.eq(Cat(*edges)),
+            ]
+            for i in range(lanes):
+                m.d.sync += arrival[i].eq(0)
+            with m.If(Cat(*edges).all()):
+                m.d.sync += commit.eq(1)
+            with m.Else():
+                m.d.sync += window_active.eq(1)
+
+        # Align every lane to the one that arrived last
+        latest = arrival[0]
+        for i in range(1, lanes):
+            latest = Mux(arrival[i] > latest, arrival[i], latest)
+
+        with m.If(commit):
+            m.d.sync += commit.eq(0)
+            m.d.sync += self.aligned.eq(1)
+            for i in range(lanes):
+                m.d.sync += delay[i].eq(latest - arrival[i])
+
+        return m
+
+
+class TMDSDeskewTest(FHDLTestCase):
+
+    def _run_skew(self, skews, depth=4):
+        import random
+
+        random.seed(len(skews) * 100 + sum(skews))
+
+        m = Module()
+        m.submodules.deskew = deskew = TMDSDeskew(depth=depth)
+
+        # Build a few lines worth of blanking followed by active data
+        data_chars = [c for c in range(1 << 10) if c not in TMDS_CONTROL_TOKENS]
+        stream = []
+        for line in range(6):
+            stream += [[TMDS_CONTROL_TOKENS[(line + lane) % 4] for lane in range(3)] for _ in range(20)]
+            stream += [[random.choice(data_chars) for lane in range(3)] for _ in range(30)]
+
+        # Apply the skew by delaying each lane individually
+        skewed = []
+        for t in range(len(stream)):
+            skewed.append([stream[max(0, t - skews[lane])][lane] for lane in range(3)])
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        outputs = []
+
+        def process():
+            for t in range(len(skewed)):
+                for lane in range(3):
+                    yield deskew.in_d[lane].eq(skewed[t][lane])
+                yield
+                out = []
+                for lane in range(3):
+                    out.append((yield deskew.out_d[lane]))
+                outputs.append(out)
+                if t == len(skewed) // 2:
+                    self.assertEqual((yield deskew.aligned), 1)
+
+        sim.add_sync_process(process)
+        sim.run()
+
+        # All lanes are delayed to match the slowest one.
+        # +1 since the output is sampled in the same cycle as the input is set.
+        latency = max(skews) + 1
+        for t in range(len(stream) // 2, len(stream) - latency):
+            self.assertEqual(outputs[t + latency], stream[t])
+
+    def test_deskew_none(self):
+        self._run_skew([0, 0, 0])
+
+    def test_deskew_single(self):
+        self._run_skew([0, 1, 0])
+
+    def test_deskew_multi(self):
+        self._run_skew([3, 0, 2])
+        self._run_skew([1, 3, 0])
+
+    def test_deskew_large(self):
+        self._run_skew([0, 5, 7], depth=8)
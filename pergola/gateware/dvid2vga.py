@@ -1,6 +1,8 @@
 from nmigen import *
 from nmigen.lib.cdc import *
 from .tmds import TMDSEncoder, TMDSDecoder
+from .deskew import TMDSDeskew
+from .hdmi import DataIslandDecoder
 from ..util.test import FHDLTestCase
 
 
@@ -30,7 +32,16 @@ class DVID2VGA(Elaboratable):
     out_ctl2: CTL2
     out_ctl3: CTL3
 
+    data_island:   High while a HDMI data island is received. Video outputs are
+                   blanked and hsync/vsync are taken from the island.
+    packet_valid:  Strobed when a HDMI packet has been received
+    packet_header: Packet header HB0..HB2
+    packet_data:   Packet body PB0..PB27
+    packet_ecc_ok: ECC of the received packet matched
+
     xdr:       Data rate. SDR=1, DDR=2, QDR=4
+    deskew_depth: Number of TMDS characters of inter-lane skew that can be corrected + 1.
+               Set to 0 to disable the deskew buffer.
 
     Clock domains
     sync:      Pixel clock
@@ -39,7 +50,7 @@ class DVID2VGA(Elaboratable):
 
 
     def __init__(self, in_d0, in_d1, in_d2, out_r, out_g, out_b, out_de0, out_hsync, out_vsync,
-                 out_de1, out_ctl0, out_ctl1, out_de2, out_ctl2, out_ctl3, xdr=1):
+                 out_de1, out_ctl0, out_ctl1, out_de2, out_ctl2, out_ctl3, xdr=1, deskew_depth=4):
         assert(len(in_d0) == xdr)
         assert(len(in_d1) == xdr)
         assert(len(in_d2) == xdr)
@@ -66,6 +77,7 @@ class DVID2VGA(Elaboratable):
         self.out_ctl3 = out_ctl3
 
         self.xdr = xdr
+        self.deskew_depth = deskew_depth
 
         self.d0_full = Signal(30)
         self.d0_offset = Signal(4)
@@ -73,6 +85,10 @@ class DVID2VGA(Elaboratable):
         self.d0 = Signal(20)
 
         self.data_island = Signal()
+        self.packet_valid = Signal()
+        self.packet_header = Signal(24)
+        self.packet_data = Signal(28 * 8)
+        self.packet_ecc_ok = Signal()
 
     def elaborate(self, platform):
         in_d0 = self.in_d0
@@ -152,11 +168,70 @@ class DVID2VGA(Elaboratable):
 
 
 
-        # TODO: Handle HDMI data island
-
-        m.submodules.tmds_dec_d0 = TMDSDecoder(d0_s_s, self.out_b, Cat(self.out_hsync, self.out_vsync), self.out_de0)
-        m.submodules.tmds_dec_d1 = TMDSDecoder(d1_s_s, self.out_g, Cat(self.out_ctl0,  self.out_ctl1),  self.out_de1)
-        m.submodules.tmds_dec_d2 = TMDSDecoder(d2_s_s, self.out_r, Cat(self.out_ctl2,  self.out_ctl3),  self.out_de2)
+        # Remove whole-character skew between the lanes
+        if self.deskew_depth > 0:
+            m.submodules.deskew = deskew = TMDSDeskew(depth=self.deskew_depth)
+            m.d.comb += [
+                deskew.in_d[0].eq(d0_s_s),
+                deskew.in_d[1].eq(d1_s_s),
+                deskew.in_d[2].eq(d2_s_s),
+            ]
+            d0_c, d1_c, d2_c = deskew.out_d
+        else:
+            d0_c, d1_c, d2_c = d0_s_s, d1_s_s, d2_s_s
+
+        dec_r = Signal(8)
+        dec_g = Signal(8)
+        dec_b = Signal(8)
+        dec_c0 = Signal(2)
+        dec_c1 = Signal(2)
+        dec_c2 = Signal(2)
+        dec_de0 = Signal()
+        dec_de1 = Signal()
+        dec_de2 = Signal()
+
+        m.submodules.tmds_dec_d0 = TMDSDecoder(d0_c, dec_b, dec_c0, dec_de0)
+        m.submodules.tmds_dec_d1 = TMDSDecoder(d1_c, dec_g, dec_c1, dec_de1)
+        m.submodules.tmds_dec_d2 = TMDSDecoder(d2_c, dec_r, dec_c2, dec_de2)
+
+        # HDMI data islands and video guard bands are not pixel data
+        m.submodules.data_island = di = DataIslandDecoder()
+        m.d.comb += [
+            di.in_d[0].eq(d0_c),
+            di.in_d[1].eq(d1_c),
+            di.in_d[2].eq(d2_c),
+
+            data_island.eq(di.island),
+            self.packet_valid.eq(di.packet_valid),
+            self.packet_header.eq(di.packet_header),
+            self.packet_data.eq(di.packet_data),
+            self.packet_ecc_ok.eq(di.packet_ecc_ok),
+        ]
+
+        not_video = Signal()
+        m.d.comb += not_video.eq(di.island | di.guard)
+
+        hv_r = Signal(2)
+        m.d.sync += hv_r.eq(Cat(self.out_hsync, self.out_vsync))
+
+        m.d.comb += [
+            self.out_r.eq(Mux(not_video, 0, dec_r)),
+            self.out_g.eq(Mux(not_video, 0, dec_g)),
+            self.out_b.eq(Mux(not_video, 0, dec_b)),
+            self.out_de0.eq(dec_de0 & ~not_video),
+            self.out_de1.eq(dec_de1 & ~not_video),
+            self.out_de2.eq(dec_de2 & ~not_video),
+            Cat(self.out_ctl0, self.out_ctl1).eq(Mux(not_video, 0, dec_c1)),
+            Cat(self.out_ctl2, self.out_ctl3).eq(Mux(not_video, 0, dec_c2)),
+        ]
+
+        with m.If(di.island):
+            m.d.comb += Cat(self.out_hsync, self.out_vsync).eq(Cat(di.hsync, di.vsync))
+        with m.Elif(di.guard):
+            # hsync/vsync are not carried by the video guard band, keep the previous values
+            m.d.comb += Cat(self.out_hsync, self.out_vsync).eq(hv_r)
+        with m.Else():
+            m.d.comb += Cat(self.out_hsync, self.out_vsync).eq(dec_c0)
 
         # Recover the start offset in the TMDS signal by searching for multiple
         # clock cycles of ~de0 (any control word on d0) in the pixel clock domain.
@@ -0,0 +1,283 @@
+from nmigen import *
+from nmigen.lib.cdc import FFSynchronizer
+from nmigen.back.pysim import Simulator
+
+from .psram import PSRAMController, PSRAMModel, psram_layout
+from .vga import VGAOutputSubtarget, VGAParameters
+from ..util.test import FHDLTestCase
+
+
+class FramebufferReader(Elaboratable):
+    """
+    Displays a framebuffer stored in PSRAM.
+
+    Lines are prefetched into a double buffered line buffer in block RAM: while a
+    line is displayed, the next one is read from the PSRAM in bursts of up to
+    `burst` words. The PSRAM side runs in the `sync` domain of the controller, the
+    pixels are produced in `pixel_domain`.
+
+    A line of h_active pixels has to be read within one line time, i.e.
+    h_active * bpp / (8 * chips) words at 4 cycles each, plus the command overhead
+    of 2 * (8 + 6) cycles per burst. E.g. 640x480 at 8bpp with two chips needs a
+    PSRAM `sync` clock of at least ~1.7x the pixel clock, 1280x720 at 4bpp ~0.9x.
+    With a slower clock a line is requested while the previous one is still being
+    fetched. The request is served when the fetch is done, too late for its line, and
+    underrun is set.
+
+    psram:          PSRAMController, must not be used by anything else
+    vga_parameters: Video timing
+    v_ctr, h_ctr:   Counters from VGAOutputSubtarget in the pixel domain
+    r, g, b:        8-bit pixel outputs, registered like the other image generators
+    underrun:       Sticky, set in `sync` when a line was requested during a fetch
+
+    bpp:            Bits per pixel
+                    4:  Grayscale
+                    8:  RGB332
+                    16: RGB565
+    base:           Address of the first word of the framebuffer in the PSRAM
+    burst:          Maximum number of words per PSRAM command
+    """
+
+    def __init__(self, psram, vga_parameters, v_ctr, h_ctr, r, g, b, bpp=8, base=0, burst=64,
+                 pixel_domain="pixel"):
+        assert(bpp in (4, 8, 16))
+
+        self.psram = psram
+        self.vga_parameters = vga_parameters
+        self.v_ctr = v_ctr
+        self.h_ctr = h_ctr
+        self.r = r
+        self.g = g
+        self.b = b
+        self.bpp = bpp
+        self.base = base
+        self.burst = min(burst, psram.max_burst)
+        self.pixel_domain = pixel_domain
+
+        self.underrun = Signal()
+
+        word_width = psram.data_width
+        assert((vga_parameters.h_active * bpp) % word_width == 0)
+        self.pixels_per_word = word_width // bpp
+        self.line_words = vga_parameters.h_active * bpp // word_width
+
+    def elaborate(self, platform):
+        m = Module()
+
+        psram = self.psram
+        params = self.vga_parameters
+        line_words = self.line_words
+        pixels_per_word = self.pixels_per_word
+
+        v_total = params.v_front + params.v_sync + params.v_back + params.v_active
+
+        linebuf = Memory(width=psram.data_width, depth=2 * line_words)
+        m.submodules.linebuf_wr = linebuf_wr = linebuf.write_port()
+        m.submodules.linebuf_rd = linebuf_rd = linebuf.read_port(domain=self.pixel_domain)
+
+        # Pixel side: request the next line at the start of the current one, so that
+        # a full line time is available to fetch it.
+        pix = m.d[self.pixel_domain]
+
+        fetch_line = Signal(range(params.v_active))
+        fetch_toggle = Signal()
+        with m.If(self.h_ctr == 0):
+            with m.If(self.v_ctr == v_total - 1):
+                pix += [
+                    fetch_line.eq(0),
+                    fetch_toggle.eq(~fetch_toggle),
+                ]
+            with m.Elif(self.v_ctr < params.v_active - 1):
+                pix += [
+                    fetch_line.eq(self.v_ctr + 1),
+                    fetch_toggle.eq(~fetch_toggle),
+                ]
+
+        # Display the current line
+        sub_pixel = Signal(range(pixels_per_word))
+        m.d.comb += linebuf_rd.addr.eq(Mux(self.v_ctr[0], line_words, 0) + self.h_ctr // pixels_per_word)
+        pix += sub_pixel.eq(self.h_ctr % pixels_per_word)
+
+        word = linebuf_rd.data
+        pixel = Signal(self.bpp)
+        m.d.comb += pixel.eq(word.word_select(sub_pixel, self.bpp))
+
+        if self.bpp == 4:
+            m.d.comb += [
+                self.r.eq(Cat(pixel, pixel)),
+                self.g.eq(Cat(pixel, pixel)),
+                self.b.eq(Cat(pixel, pixel)),
+            ]
+        elif self.bpp == 8:
+            m.d.comb += [
+                self.r.eq(Cat(pixel[6:8], pixel[5:8], pixel[5:8])),
+                self.g.eq(Cat(pixel[3:5], pixel[2:5], pixel[2:5])),
+                self.b.eq(Cat(pixel[0:2], pixel[0:2], pixel[0:2], pixel[0:2])),
+            ]
+        else:
+            m.d.comb += [
+                self.r.eq(Cat(pixel[11:16][2:], pixel[11:16])),
+                self.g.eq(Cat(pixel[5:11][4:], pixel[5:11])),
+                self.b.eq(Cat(pixel[0:5][2:], pixel[0:5])),
+            ]
+
+        # PSRAM side
+        fetch_toggle_s = Signal()
+        fetch_toggle_r = Signal()
+        m.submodules += FFSynchronizer(fetch_toggle, fetch_toggle_s)
+
+        # fetch_line is stable for a whole line when the toggle is seen
+        addr = Signal(24)
+        remaining = Signal(range(line_words + 1))
+        wr_addr = Signal(range(2 * line_words))
+
+        m.d.comb += [
+            linebuf_wr.addr.eq(wr_addr),
+            linebuf_wr.data.eq(psram.rd_data),
+            linebuf_wr.en.eq(psram.rd_valid),
+        ]
+        with m.If(psram.rd_valid):
+            m.d.sync += wr_addr.eq(wr_addr + 1)
+
+        burst_len = Signal(range(self.burst + 1))
+        m.d.comb += burst_len.eq(Mux(remaining > self.burst, self.burst, remaining))
+
+        with m.FSM(name="fetch") as fsm:
+            with m.State("IDLE"):
+                with m.If(fetch_toggle_s != fetch_toggle_r):
+                    m.d.sync += [
+                        fetch_toggle_r.eq(fetch_toggle_s),
+                        addr.eq(self.base + fetch_line * line_words),
+                        remaining.eq(line_words),
+                        wr_addr.eq(Mux(fetch_line[0], line_words, 0)),
+                    ]
+                    m.next = "FETCH"
+
+            with m.State("FETCH"):
+                m.d.comb += [
+                    psram.cmd_valid.eq(1),
+                    psram.cmd_write.eq(0),
+                    psram.cmd_addr.eq(addr),
+                    psram.cmd_len.eq(burst_len),
+                ]
+                with m.If(psram.cmd_ready):
+                    m.d.sync += [
+                        addr.eq(addr + burst_len),
+                        remaining.eq(remaining - burst_len),
+                    ]
+                    m.next = "WAIT"
+
+            with m.State("WAIT"):
+                with m.If(psram.cmd_ready):
+                    with m.If(remaining == 0):
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.next = "FETCH"
+
+        with m.If(~fsm.ongoing("IDLE") & (fetch_toggle_s != fetch_toggle_r)):
+            m.d.sync += self.underrun.eq(1)
+
+        return m
+
+
+class FramebufferReaderTest(FHDLTestCase):
+
+    def _run(self, bpp, chips, psram_clock=100e6):
+        import random
+
+        random.seed(bpp + chips)
+
+        params = VGAParameters(
+            h_front=4, h_sync=8, h_back=52, h_active=32,
+            v_front=1, v_sync=1, v_back=1, v_active=4)
+        h_total = params.h_front + params.h_sync + params.h_back + params.h_active
+        v_total = params.v_front + params.v_sync + params.v_back + params.v_active
+
+        # Framebuffer contents, stored as words in the PSRAM
+        word_width = 8 * chips
+        line_words = params.h_active * bpp // word_width
+        words = [random.randrange(1 << word_width) for _ in range(line_words * params.v_active)]
+
+        m = Module()
+
+        pins = [Record(psram_layout(), name=f"psram{k}") for k in range(chips)]
+        m.submodules.psram = psram = PSRAMController(pins, max_burst=8, init_delay=10)
+        for k in range(chips):
+            setattr(m.submodules, f"model{k}", PSRAMModel(
+                pins[k], size=256, init=[(w >> (8 * k)) & 0xff for w in words]))
+
+        vga_output = Record([('hs', 1), ('vs', 1), ('blank', 1)])
+        m.submodules.vga = vga = DomainRenamer("pixel")(VGAOutputSubtarget(
+            output=vga_output,
+            vga_parameters=params,
+        ))
+
+        r = Signal(8)
+        g = Signal(8)
+        b = Signal(8)
+        m.submodules.fb = fb = FramebufferReader(
+            psram, params, vga.v_ctr, vga.h_ctr, r, g, b, bpp=bpp)
+
+        m.domains.pixel = ClockDomain()
+
+        sim = Simulator(m)
+        sim.add_clock(1/psram_clock, domain="sync")
+        sim.add_clock(1/25e6, domain="pixel")
+
+        def expected(x, y):
+            ppw = word_width // bpp
+            p = (words[y * line_words + x // ppw] >> (bpp * (x % ppw))) & ((1 << bpp) - 1)
+            if bpp == 4:
+                return (p * 0x11,) * 3
+            if bpp == 8:
+                r, g, b = p >> 5, (p >> 2) & 0x7, p & 0x3
+                return ((r << 5) | (r << 2) | (r >> 1), (g << 5) | (g << 2) | (g >> 1), b * 0x55)
+            r, g, b = p >> 11, (p >> 5) & 0x3f, p & 0x1f
+            return ((r << 3) | (r >> 2), (g << 2) | (g >> 4), (b << 3) | (b >> 2))
+
+        result = {}
+
+        def process():
+            checked = 0
+            errors = 0
+            h_r = v_r = None
+            # Skip the first frame, the first line is fetched during the last line of a frame
+            for i in range(2 * h_total * v_total + 1):
+                yield
+                if h_r is not None and i > h_total * v_total:
+                    if h_r < params.h_active and v_r < params.v_active:
+                        if ((yield r), (yield g), (yield b)) != expected(h_r, v_r):
+                            errors += 1
+                        checked += 1
+                h_r = (yield vga.h_ctr)
+                v_r = (yield vga.v_ctr)
+            self.assertEqual(checked, params.h_active * params.v_active)
+            result["errors"] = errors
+            result["underrun"] = yield fb.underrun
+
+        sim.add_sync_process(process, domain="pixel")
+        with sim.write_vcd("framebuffer.vcd"):
+            sim.run()
+
+        return result
+
+    def check(self, bpp, chips):
+        result = self._run(bpp, chips)
+        self.assertEqual(result["errors"], 0)
+        self.assertEqual(result["underrun"], 0)
+
+    def test_rgb332(self):
+        self.check(bpp=8, chips=2)
+
+    def test_rgb565(self):
+        self.check(bpp=16, chips=2)
+
+    def test_grayscale_single_chip(self):
+        self.check(bpp=4, chips=1)
+
+    def test_underrun(self):
+        # A line takes longer to fetch than to display, requests during a fetch are
+        # reported instead of lost silently
+        result = self._run(bpp=8, chips=2, psram_clock=20e6)
+        self.assertGreater(result["errors"], 0)
+        self.assertEqual(result["underrun"], 1)
@@ -1,23 +1,100 @@
 from nmigen import *
-from nmigen.back.pysim import Simulator, Active
-from nmigen.lib.fifo import AsyncFIFOBuffered
+from nmigen.back.pysim import Simulator, Settle
+from nmigen.lib.cdc import FFSynchronizer
+from nmigen.lib.coding import GrayDecoder
+from nmigen.utils import bits_for
+
+import math
 
 from ..util.test import FHDLTestCase
 
 
 class Gearbox(Elaboratable):
-    def __init__(self, width_in, width_out, domain_in, domain_out, depth=3):
+    """Converts width_in bit words in domain_in to width_out bit words in domain_out.
+
+    The clocks must have the same bit rate, width_in * f_in == width_out * f_out. A word is
+    taken from data_in every domain_in cycle and one is put on data_out every domain_out
+    cycle. The bits are sent LSB first, so the LSB of the first output word is the LSB of
+    the first input word.
+
+    The bits are written to a circular buffer of `depth` bits at a bit pointer that advances
+    width_in bits per cycle, and read at a pointer that advances width_out bits per cycle.
+    Any ratio works without a width_in * width_out wide FIFO and the buffer only needs to
+    cover the bits in flight while the pointers cross the clock domains. The buffer is split
+    into blocks of the power of two at or above both widths, so every bit is written from a
+    mux of at most width_in inputs and a word is read from two neighbouring blocks. The
+    default depth is the multiple of the block size at or above 5 * (width_in + width_out).
+    A 10 to 7 bit gearbox has a 96 bit buffer and takes 392 LUT4 and 232 TRELLIS_FF with
+    synth_ecp5.
+
+    Each side counts its words in Gray code and passes the count to the other side, which
+    adds the words counted since its last cycle to the bits that it sees written or read.
+    The reading starts when the buffer is filled so far that, with the counts that each side
+    sees a few cycles late, it stays as far from empty as from full. After that both sides
+    run freely.
+
+    When `stream` is set, both sides are valid/ready streams instead and the clocks can
+    have any rate. A word is taken when valid_in and ready_in are high, ready_in is high
+    while the buffer has room for a word. A word is put on data_out as soon as its bits
+    have been written and stays there until ready_out is high. As the counts that each
+    side sees are a few cycles old, ready_in and valid_out are late, never early, so no
+    word is lost or repeated, and overflow and underflow stay low.
+
+    When `framing` is set, first_in and last_in mark the first and the last word of a frame.
+    first_out and last_out are set on the output words that hold the first and the last bit
+    of a frame. With `stream`, the last word of a frame is padded with zeros to a whole
+    output word and put out as soon as the last bit is written, so every frame starts and
+    ends on output word boundaries and the end of a frame is never held back until the next
+    one. Without `stream`, the bit rates have to match and frames are not padded, so they
+    only start and end on output word boundaries when their length is a multiple of
+    width_out bits.
+
+    data_in:    Input word, domain_in
+    valid_in:   data_in holds a word, stream only
+    ready_in:   The word is taken, stream only
+    first_in:   First word of a frame, framing only
+    last_in:    Last word of a frame, framing only
+    overflow:   Set when a word was written over bits that were not read yet, domain_in
+
+    data_out:   Output word, domain_out
+    valid_out:  High from the first output word on, or while data_out holds a word
+    ready_out:  data_out is taken, stream only
+    first_out:  Output word with the first bit of a frame, framing only
+    last_out:   Output word with the last bit of a frame, framing only
+    underflow:  Set when a word was read before it was written, domain_out
+
+    The flags are sticky and compare against a pointer that is a few cycles old, so they
+    are set a few words early rather than too late.
+    """
+    def __init__(self, width_in, width_out, domain_in, domain_out, depth=None, stream=False,
+                 framing=False):
+        block = 1 << bits_for(max(width_in, width_out) - 1)
+        if depth is None:
+            depth = -(-5 * (width_in + width_out) // block) * block
+        assert depth % block == 0, f"depth must be a multiple of {block}"
+        assert depth >= 5 * (width_in + width_out), "depth is too small for the widths"
+
         self.width_in = width_in
         self.width_out = width_out
         self.depth = depth
         self.domain_in = domain_in
         self.domain_out = domain_out
+        self.stream = stream
+        self.framing = framing
 
         self.data_in = Signal(width_in)
-        self.data_out = Signal(width_out)
+        self.valid_in = Signal()
+        self.ready_in = Signal()
+        self.first_in = Signal()
+        self.last_in = Signal()
+        self.overflow = Signal()
 
-        self.ctr_in = Signal(range(width_out))
-        self.ctr_out = Signal(range(width_in))
+        self.data_out = Signal(width_out)
+        self.valid_out = Signal()
+        self.ready_out = Signal()
+        self.first_out = Signal()
+        self.last_out = Signal()
+        self.underflow = Signal()
 
     def elaborate(self, platform):
         m = Module()
@@ -28,77 +105,404 @@ class Gearbox(Elaboratable):
         domain_in = self.domain_in
         domain_out = self.domain_out
 
-        data_in = self.data_in
-        data_out = self.data_out
+        block_bits = bits_for(max(width_in, width_out) - 1)
+        block = 1 << block_bits
+        blocks = depth // block
+        count_bits = bits_for(depth)
 
-        ctr_in = self.ctr_in
-        ctr_out = self.ctr_out
+        buffer = Signal(depth)
+        # Frame markers at the first and the last bit of a frame
+        first_buffer = Signal(depth)
+        last_buffer = Signal(depth)
 
-        fifo_width = width_in * width_out
+        def times(value, constant):
+            # Shifts and adds, a multiplication would take a DSP
+            return sum(value << i for i in range(bits_for(constant)) if (constant >> i) & 1)
 
-        fifo_data_in = Signal(fifo_width)
-        fifo_data_out = Signal(fifo_width)
+        def wrap(addr):
+            return Mux(addr >= depth, addr - depth, addr)
 
-        m.submodules.fifo = fifo = AsyncFIFOBuffered(
-            width=fifo_width,
-            depth=depth,
-            exact_depth=True,
-            w_domain=domain_in,
-            r_domain=domain_out,
-        )
+        # Write side
+        w_en = Signal()
+        w_count = Signal(count_bits)
+        w_next = Signal(count_bits)
+        w_gray = Signal(count_bits)
+        w_addr = Signal(range(depth))
+        # Bits skipped after the last word of a frame, stream and framing only
+        w_pad = Signal(range(width_out))
+        m.d.comb += w_next.eq(w_count + 1)
 
-        with m.If(ctr_in == (width_out - 1)):
-            m.d[domain_in] += ctr_in.eq(0)
-        with m.Else():
-            m.d[domain_in] += ctr_in.eq(ctr_in + 1)
+        # Every bit of the buffer is written from one of the width_in bits of a word, selected
+        # by the offset of the write pointer in its block, if it is in the block of the
+        # pointer and at or above the offset, or in the next block and below the offset.
+        w_offset = w_addr[:block_bits]
+        w_block = w_addr[block_bits:]
+        def place(value):
+            shifted = Signal(2 * block)
+            placed = Signal(block)
+            m.d.comb += [
+                shifted.eq(value << w_offset),
+                placed.eq(shifted[:block] | shifted[block:]),
+            ]
+            return placed
 
-        with m.If(ctr_out == (width_in - 1)):
-            m.d[domain_out] += ctr_out.eq(0)
-        with m.Else():
-            m.d[domain_out] += ctr_out.eq(ctr_out + 1)
+        w_mask = place(Const((1 << width_in) - 1, width_in))
+        w_data = place(self.data_in)
+        if self.framing:
+            w_first = place(Cat(self.first_in, Const(0, width_in - 1)))
+            w_last = place(Cat(Const(0, width_in - 1), self.last_in))
 
-        m.d.comb += fifo.w_data.eq(fifo_data_in)
-        m.d[domain_in] += fifo.w_en.eq(fifo.w_rdy & (ctr_in == (width_out - 1)))
-        m.d[domain_in] += fifo_data_in.eq(Cat(fifo_data_in[width_in:], data_in))
+        w_block_en = Signal(blocks)
+        m.d.comb += w_block_en.eq(w_en << w_block)
+        for i in range(depth):
+            n, offset = divmod(i, block)
+            with m.If(w_mask[offset] & Mux(offset >= w_offset, w_block_en[n],
+                                           w_block_en[(n - 1) % blocks])):
+                m.d[domain_in] += buffer[i].eq(w_data[offset])
+                if self.framing:
+                    m.d[domain_in] += [
+                        first_buffer[i].eq(w_first[offset]),
+                        last_buffer[i].eq(w_last[offset]),
+                    ]
 
-        m.d[domain_out] += fifo.r_en.eq(fifo.r_rdy & (ctr_out == (width_in - 1)))
-        with m.If(ctr_out == 0):
-            m.d[domain_out] += fifo_data_out.eq(fifo.r_data)
-        with m.Else():
-            m.d[domain_out] += fifo_data_out.eq(fifo_data_out[width_out:])
+        with m.If(w_en):
+            m.d[domain_in] += [
+                w_count.eq(w_next),
+                w_gray.eq(w_next ^ w_next[1:]),
+                w_addr.eq(wrap(w_addr + width_in + w_pad)),
+            ]
 
-        m.d.comb += data_out.eq(fifo_data_out[:width_out])
+        # Read side
+        r_en = Signal()
+        r_count = Signal(count_bits)
+        r_next = Signal(count_bits)
+        r_gray = Signal(count_bits)
+        r_addr = Signal(range(depth))
+        r_addr_next = Signal(range(depth))
+        # Bits of the word that are kept and the zeros after them, stream and framing only
+        r_keep = Signal(width_out, reset=(1 << width_out) - 1)
+        r_pad = Signal(range(width_out))
+        running = Signal()
+        m.d.comb += [
+            r_next.eq(r_count + 1),
+            r_addr_next.eq(Mux(r_en, wrap(r_addr + width_out), r_addr)),
+        ]
+
+        # The blocks at the read pointer are registered every cycle and the word is picked
+        # from them by the offset. The bits that the read side counts as written were written
+        # a cycle before they were registered.
+        r_offset = Signal(block_bits)
+        m.d[domain_out] += r_offset.eq(r_addr_next[:block_bits])
+        r_block = r_addr_next[block_bits:]
+        r_block_next = Mux(r_block == blocks - 1, 0, r_block + 1)
+        def window(value):
+            value_blocks = Array(value[n * block:(n + 1) * block] for n in range(blocks))
+            pair = Signal(block + width_out - 1)
+            m.d[domain_out] += pair.eq(Cat(value_blocks[r_block], value_blocks[r_block_next]))
+            return pair.bit_select(r_offset, width_out)
+
+        r_data = window(buffer)
+        if self.framing:
+            r_first = window(first_buffer)
+            r_last = window(last_buffer)
+
+        with m.If(r_en):
+            m.d[domain_out] += [
+                self.data_out.eq(r_data & r_keep),
+                r_count.eq(r_next),
+                r_gray.eq(r_next ^ r_next[1:]),
+                r_addr.eq(r_addr_next),
+            ]
+            if self.framing:
+                m.d[domain_out] += [
+                    self.first_out.eq((r_first & r_keep) != 0),
+                    self.last_out.eq((r_last & r_keep) != 0),
+                ]
+
+        # The bits written, as seen by the read side
+        w_gray_r = Signal(count_bits)
+        m.submodules.w_gray_sync = FFSynchronizer(w_gray, w_gray_r, o_domain=domain_out)
+        m.submodules.w_gray_decoder = w_decoder = GrayDecoder(count_bits)
+        w_count_r = Signal(count_bits)
+        w_words = Signal(count_bits)
+        fill = Signal(signed(count_bits + 2))
+        fill_next = Signal.like(fill)
+        # The bits of the word at the read pointer that have been written
+        r_written = Signal(width_out)
+        m.d.comb += [
+            w_decoder.i.eq(w_gray_r),
+            w_words.eq(w_decoder.o - w_count_r),
+            fill_next.eq(fill + times(w_words, width_in) - Mux(r_en, width_out - r_pad, 0)),
+        ]
+        m.d[domain_out] += [
+            w_count_r.eq(w_decoder.o),
+            fill.eq(fill_next),
+            r_written.eq(Cat(fill_next > i for i in range(width_out))),
+        ]
+
+        # The bits read, as seen by the write side
+        r_gray_w = Signal(count_bits)
+        m.submodules.r_gray_sync = FFSynchronizer(r_gray, r_gray_w, o_domain=domain_in)
+        m.submodules.r_gray_decoder = r_decoder = GrayDecoder(count_bits)
+        r_count_w = Signal(count_bits)
+        r_words = Signal(count_bits)
+        used = Signal(signed(count_bits + 2))
+        m.d.comb += [
+            r_decoder.i.eq(r_gray_w),
+            r_words.eq(r_decoder.o - r_count_w),
+        ]
+        m.d[domain_in] += [
+            r_count_w.eq(r_decoder.o),
+            used.eq(used + Mux(w_en, width_in + w_pad, 0) - times(r_words, width_out)),
+        ]
+
+        if self.stream:
+            m.d.comb += [
+                self.ready_in.eq(used <= depth - width_in),
+                w_en.eq(self.valid_in & self.ready_in),
+            ]
+
+            r_tail = Signal()
+            if self.framing and width_out > 1:
+                # The last word of a frame is padded to a whole output word, so that the next
+                # frame starts on a word. The write side skips the padding bits, the read side
+                # puts out a word with the last bit of a frame as soon as that bit is written,
+                # with zeros after it, and skips the same bits.
+                w_phase = Signal(range(width_out))
+                with m.If(w_en):
+                    with m.Switch(w_phase):
+                        for phase in range(width_out):
+                            end = phase + width_in
+                            with m.Case(phase):
+                                with m.If(self.last_in):
+                                    m.d.comb += w_pad.eq(-end % width_out)
+                                    m.d[domain_in] += w_phase.eq(0)
+                                with m.Else():
+                                    m.d[domain_in] += w_phase.eq(end % width_out)
+
+                # The first last bit among the bits that have been written wins
+                r_last_written = r_last & r_written
+                for i in reversed(range(width_out)):
+                    with m.If(r_last_written[i]):
+                        m.d.comb += [
+                            r_keep.eq((1 << (i + 1)) - 1),
+                            r_pad.eq(width_out - 1 - i),
+                        ]
+                m.d.comb += r_tail.eq(r_last_written != 0)
+
+            with m.If(~self.valid_out | self.ready_out):
+                m.d.comb += r_en.eq(r_written[-1] | r_tail)
+                m.d[domain_out] += self.valid_out.eq(r_en)
+
+            return m
+
+        m.d.comb += w_en.eq(1)
+        with m.If(used > depth - width_in):
+            m.d[domain_in] += self.overflow.eq(1)
+
+        m.d.comb += r_en.eq(running)
+        m.d[domain_out] += self.valid_out.eq(running)
+        with m.If(running):
+            with m.If(fill < width_out):
+                m.d[domain_out] += self.underflow.eq(1)
+        with m.Elif(fill >= (depth - 4 * (width_in + width_out)) // 2):
+            m.d[domain_out] += running.eq(1)
 
         return m
 
 
+# Only used for testing
+import importlib
+if importlib.util.find_spec("numpy") is not None:
+    import numpy as np
+
 class GearboxTest(FHDLTestCase):
+    # The TMDS serialisers and some odd ratios
+    ratios = [(10, 7), (7, 10), (10, 4), (4, 10), (10, 1), (1, 10), (3, 2), (2, 3), (8, 8)]
+
+    def stream(self, width_in, width_out, period_in, period_out, phase=0, words=300):
+        """Sends random words through a Gearbox and reassembles the bit stream.
+
+        Returns the bits sent and received, for every received word whether underflow was
+        set when it was read, the flags at the end, and the number of output cycles from the
+        first valid word on.
+        """
+        m = Module()
+        m.domains.gb_in = ClockDomain()
+        m.domains.gb_out = ClockDomain()
+
+        m.submodules.gearbox = gearbox = Gearbox(
+            width_in=width_in,
+            width_out=width_out,
+            domain_in="gb_in",
+            domain_out="gb_out",
+        )
+
+        np.random.seed(width_in * 100 + width_out)
+        data = [int(word) for word in np.random.randint(0, 1 << width_in, size=words)]
+
+        sim = Simulator(m)
+        sim.add_clock(period_in, domain="gb_in")
+        sim.add_clock(period_out, domain="gb_out", phase=phase)
+
+        result = {
+            "received": [],
+            "underflow_at": [],
+            "cycles": 0,
+        }
+
+        def process_in():
+            for word in data:
+                yield gearbox.data_in.eq(word)
+                yield
+            result["overflow"] = yield gearbox.overflow
+
+        def process_out():
+            # Stop a few words before the input runs out
+            for _ in range(int((words - 16) * period_in / period_out)):
+                if (yield gearbox.valid_out):
+                    result["received"].append((yield gearbox.data_out))
+                    result["underflow_at"].append((yield gearbox.underflow))
+                if result["received"]:
+                    result["cycles"] += 1
+                yield
+            result["underflow"] = yield gearbox.underflow
+
+        sim.add_sync_process(process_in, domain="gb_in")
+        sim.add_sync_process(process_out, domain="gb_out")
+        sim.run()
+
+        # The first word is taken at the first clock edge, before data_in is set
+        result["bits_in"] = [(word >> i) & 1 for word in [0] + data for i in range(width_in)]
+        result["bits_out"] = [(word >> i) & 1 for word in result["received"]
+                              for i in range(width_out)]
+        return result
+
+    def assertBitsEqual(self, bits_out, bits_in):
+        # Compares without the diff of unittest, which is slow for long lists
+        for i, (bit_out, bit_in) in enumerate(zip(bits_out, bits_in)):
+            if bit_out != bit_in:
+                self.fail(f"Bit {i} differs")
+        self.assertLessEqual(len(bits_out), len(bits_in))
+
     def test_gearbox(self):
+        # Same bit rate on both sides, at different phases of the clocks
+        for width_in, width_out in self.ratios:
+            for phase in [0, 0.25, 0.5, 0.75]:
+                with self.subTest(width_in=width_in, width_out=width_out, phase=phase):
+                    result = self.stream(width_in, width_out, width_in * 1e-9, width_out * 1e-9,
+                                         phase * width_out * 1e-9)
+                    self.assertBitsEqual(result["bits_out"], result["bits_in"])
+                    self.assertEqual(result["overflow"], 0)
+                    self.assertEqual(result["underflow"], 0)
+
+                    # Sustained, a word every output cycle
+                    bits_per_cycle = len(result["bits_out"]) / result["cycles"]
+                    self.assertEqual(bits_per_cycle, width_out)
+                    self.assertGreater(len(result["bits_out"]), 150 * width_in)
+
+    def test_rate_mismatch(self):
+        for width_in, width_out in [(10, 7), (7, 10), (3, 2)]:
+            with self.subTest(width_in=width_in, width_out=width_out):
+                # The output clock is too fast, the reader catches up with the writer.
+                # The words read before underflow is set are still correct.
+                result = self.stream(width_in, width_out, width_in * 1e-9, width_out * 0.95e-9)
+                self.assertEqual(result["underflow"], 1)
+                self.assertEqual(result["overflow"], 0)
+                good = result["underflow_at"].index(1) * width_out
+                self.assertBitsEqual(result["bits_out"][:good], result["bits_in"])
+
+                # The output clock is too slow, the writer catches up with the reader
+                result = self.stream(width_in, width_out, width_in * 1e-9, width_out * 1.05e-9)
+                self.assertEqual(result["overflow"], 1)
+                self.assertEqual(result["underflow"], 0)
+
+    def test_stream(self):
+        # Random valid and ready on both sides, with either side faster
+        for width_in, width_out in [(10, 7), (7, 10), (10, 4), (3, 2), (1, 10)]:
+            for period_in, period_out in [(1e-9, 1.3e-9), (1.7e-9, 0.6e-9)]:
+                with self.subTest(width_in=width_in, width_out=width_out,
+                                  period_in=period_in, period_out=period_out):
+                    self.check_stream(width_in, width_out, period_in, period_out)
+
+    def check_stream(self, width_in, width_out, period_in, period_out, frames=12):
         m = Module()
+        m.domains.gb_in = ClockDomain()
+        m.domains.gb_out = ClockDomain()
 
         m.submodules.gearbox = gearbox = Gearbox(
-            width_in=3,
-            width_out=2,
-            domain_in="slow",
-            domain_out="fast",
-            depth=3,
+            width_in=width_in,
+            width_out=width_out,
+            domain_in="gb_in",
+            domain_out="gb_out",
+            stream=True,
+            framing=True,
         )
 
-        m.d.comb += gearbox.data_in.eq(0b101)
+        # Frames of any length, the last word of a frame is padded to a whole output word
+        np.random.seed(width_in * 100 + width_out)
+        step = width_out // math.gcd(width_in, width_out)
+        frame_words = [int(n) for n in np.random.randint(1, 3 * step + 1, size=frames)]
+        if step > 1:
+            self.assertTrue(any(length % step for length in frame_words))
+        words = []
+        for length in frame_words:
+            for i in range(length):
+                words.append((int(np.random.randint(0, 1 << width_in)), i == 0, i == length - 1))
 
         sim = Simulator(m)
+        sim.add_clock(period_in, domain="gb_in")
+        sim.add_clock(period_out, domain="gb_out", phase=period_out / 3)
+
+        received = []
 
-        sim.add_clock(1/2e6, domain="slow")
-        sim.add_clock(1/3e6, domain="fast")
+        def process_in():
+            for data, first, last in words:
+                yield gearbox.data_in.eq(data)
+                yield gearbox.first_in.eq(first)
+                yield gearbox.last_in.eq(last)
+                while True:
+                    valid = np.random.randint(4) != 0
+                    yield gearbox.valid_in.eq(valid)
+                    yield Settle()
+                    ready = yield gearbox.ready_in
+                    yield
+                    if valid and ready:
+                        break
+            yield gearbox.valid_in.eq(0)
 
-        def process_slow():
-            yield Active()
-            for i in range(100):
-                # yield gearbox.data_in.eq(i)
+        def process_out():
+            expected = sum(-(-length * width_in // width_out) for length in frame_words)
+            for _ in range(20 * expected * max(width_in, width_out)):
+                ready = np.random.randint(4) != 0
+                yield gearbox.ready_out.eq(ready)
+                yield Settle()
+                if ready and (yield gearbox.valid_out):
+                    received.append(((yield gearbox.data_out),
+                                     (yield gearbox.first_out),
+                                     (yield gearbox.last_out)))
                 yield
+                if len(received) == expected:
+                    break
+
+        sim.add_sync_process(process_in, domain="gb_in")
+        sim.add_sync_process(process_out, domain="gb_out")
+        sim.run()
 
-        # sim.add_sync_process(process, domain="fast")
-        sim.add_sync_process(process_slow, domain="slow")
-        with sim.write_vcd("gearbox.vcd"):
-            sim.run()
+        bits_in = []
+        starts = []
+        ends = []
+        for data, first, last in words:
+            if first:
+                starts.append(len(bits_in) // width_out)
+            bits_in += [(data >> i) & 1 for i in range(width_in)]
+            if last:
+                bits_in += [0] * (-len(bits_in) % width_out)
+                ends.append(len(bits_in) // width_out - 1)
+        bits_out = [(data >> i) & 1 for data, _, _ in received for i in range(width_out)]
+        self.assertEqual(len(bits_out), len(bits_in))
+        self.assertBitsEqual(bits_out, bits_in)
 
+        # Frame boundaries in output words
+        self.assertEqual([i for i, word in enumerate(received) if word[1]], starts)
+        self.assertEqual([i for i, word in enumerate(received) if word[2]], ends)
@@ -0,0 +1,1024 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+
+from .tmds import TMDS_CONTROL_TOKENS, TMDSDecoder
+from ..util.test import FHDLTestCase
+
+"""
+HDMI data island support.
+
+HDMI extends DVI with data islands that are sent during blanking. A data island
+is announced by a preamble of 8 control characters on channel 1 and 2, followed by
+a leading guard band, one or more 32 character packets and a trailing guard band.
+The data inside the island is TERC4 encoded, i.e. every TMDS character carries 4 bits.
+
+    Channel 0: D0 = hsync, D1 = vsync, D2 = packet header bit, D3 = 0 on the first
+               character of the island, 1 otherwise
+    Channel 1: D0..D3 = bit 2*i of subpacket 0..3
+    Channel 2: D0..D3 = bit 2*i+1 of subpacket 0..3
+
+Active video periods in HDMI mode are announced the same way, with a different
+preamble, and start with a two character video guard band.
+
+All 10-bit characters below are written as q_out[9:0], i.e. the same way as the
+characters produced by TMDSEncoder. Control characters are tmds.TMDS_CONTROL_TOKENS.
+"""
+
+
+# TERC4 characters, indexed by the 4-bit value
+TERC4_CHARACTERS = [
+    0b1010011100,
+    0b1001100011,
+    0b1011100100,
+    0b1011100010,
+    0b0101110001,
+    0b0100011110,
+    0b0110001110,
+    0b0100111100,
+    0b1011001100,
+    0b0100111001,
+    0b0110011100,
+    0b1011000110,
+    0b1010001110,
+    0b1001110001,
+    0b0101100011,
+    0b1011000011,
+]
+
+# Guard band characters on channel 1 and 2 of a data island
+DATA_ISLAND_GUARD_BAND = 0b0100110011
+
+# Video guard band, channel 0, 1 and 2
+VIDEO_GUARD_BAND = [0b1011001100, 0b0100110011, 0b1011001100]
+
+# Preamble control values (CTL0/CTL1 on channel 1, CTL2/CTL3 on channel 2)
+DATA_ISLAND_PREAMBLE = [0b01, 0b01]
+VIDEO_PREAMBLE = [0b01, 0b00]
+
+PREAMBLE_LENGTH = 8
+GUARD_BAND_LENGTH = 2
+PACKET_LENGTH = 32
+
+
+def packet_ecc(bits, ecc=0):
+    """
+    BCH ECC used by HDMI packets, generator polynomial x^8 + x^7 + x^6 + 1.
+    `bits` is an iterable of bits in transmission order.
+    """
+    for bit in bits:
+        if (ecc ^ bit) & 1:
+            ecc = (ecc >> 1) ^ 0b10000011
+        else:
+            ecc = ecc >> 1
+    return ecc
+
+
+def packet_bits(header, body):
+    """
+    Splits a packet into the bits sent in each character of a packet period.
+
+    header: 3 header bytes HB0..HB2
+    body:   28 body bytes PB0..PB27
+
+    Returns a list of 32 tuples (header_bit, subpacket_bits) where subpacket_bits
+    is a list of 4 tuples with the (even, odd) bit of each subpacket.
+    """
+    assert(len(header) == 3)
+    assert(len(body) == 28)
+
+    def to_bits(data):
+        return [(byte >> i) & 1 for byte in data for i in range(8)]
+
+    header_bits = to_bits(header)
+    header_bits += [(packet_ecc(header_bits) >> i) & 1 for i in range(8)]
+
+    subpackets = []
+    for n in range(4):
+        bits = to_bits(body[n * 7:(n + 1) * 7])
+        bits += [(packet_ecc(bits) >> i) & 1 for i in range(8)]
+        subpackets.append(bits)
+
+    return [(header_bits[i], [(sp[2 * i], sp[2 * i + 1]) for sp in subpackets])
+            for i in range(PACKET_LENGTH)]
+
+
+def data_island_characters(packets, hsync=0, vsync=0):
+    """
+    Returns the TMDS characters (d0, d1, d2) of a complete data island, including
+    the preamble and guard bands.
+
+    packets: List of (header, body) tuples, see `packet_bits`
+    """
+    chars = []
+
+    hv = (vsync << 1) | hsync
+    preamble = (TMDS_CONTROL_TOKENS[hv],
+                TMDS_CONTROL_TOKENS[DATA_ISLAND_PREAMBLE[0]],
+                TMDS_CONTROL_TOKENS[DATA_ISLAND_PREAMBLE[1]])
+    guard_band = (TERC4_CHARACTERS[0b1100 | hv], DATA_ISLAND_GUARD_BAND, DATA_ISLAND_GUARD_BAND)
+
+    chars += [preamble] * PREAMBLE_LENGTH
+    chars += [guard_band] * GUARD_BAND_LENGTH
+
+    first = True
+    for header, body in packets:
+        for header_bit, sp in packet_bits(header, body):
+            d0 = hv | (header_bit << 2) | ((not first) << 3)
+            d1 = sum(even << n for n, (even, odd) in enumerate(sp))
+            d2 = sum(odd << n for n, (even, odd) in enumerate(sp))
+            chars.append((TERC4_CHARACTERS[d0], TERC4_CHARACTERS[d1], TERC4_CHARACTERS[d2]))
+            first = False
+
+    chars += [guard_band] * GUARD_BAND_LENGTH
+
+    return chars
+
+
+def infoframe(frame_type, version, payload):
+    """
+    Builds an InfoFrame packet, including the checksum in PB0.
+
+    Returns a (header, body) tuple, see `packet_bits`
+    """
+    assert(len(payload) <= 27)
+
+    header = [0x80 | frame_type, version, len(payload)]
+    body = [0] + list(payload) + [0] * (27 - len(payload))
+    body[0] = (-sum(header + body)) & 0xff
+    return (header, body)
+
+
+def avi_infoframe(vic=0, colorspace=0, picture_aspect=0, active_aspect=0b1000):
+    """
+    AVI InfoFrame, version 2.
+
+    vic:            CEA-861 video identification code, 0 for non-CEA modes
+    colorspace:     0 = RGB, 1 = YCbCr 4:2:2, 2 = YCbCr 4:4:4
+    picture_aspect: 0 = no data, 1 = 4:3, 2 = 16:9
+    active_aspect:  Active format aspect ratio, 0b1000 = same as picture
+    """
+    return infoframe(0x02, 0x02, [
+        (colorspace << 5) | (1 << 4),
+        (picture_aspect << 4) | active_aspect,
+        0x00,
+        vic & 0x7f,
+        0x00,
+    ] + [0] * 8)
+
+
+def audio_infoframe(channels=2):
+    """
+    Audio InfoFrame. Coding type, sample rate and sample size are left to the stream.
+    """
+    return infoframe(0x04, 0x01, [channels - 1] + [0] * 9)
+
+
+def audio_clock_regeneration_packet(n, cts):
+    """
+    Audio Clock Regeneration packet, sent with the N and CTS values used by the sink
+    to recover the audio clock: 128 * fs = f_tmds * N / CTS
+    """
+    subpacket = [
+        0x00,
+        (cts >> 16) & 0x0f, (cts >> 8) & 0xff, cts & 0xff,
+        (n >> 16) & 0x0f, (n >> 8) & 0xff, n & 0xff,
+    ]
+    return ([0x01, 0x00, 0x00], subpacket * 4)
+
+
+def audio_sample_packet(samples, frame_start=0):
+    """
+    Layout 0 (2 channel) audio sample packet with up to 4 stereo samples.
+
+    samples:     List of (left, right) 24-bit samples
+    frame_start: Bit mask of samples that start an IEC 60958 block
+    """
+    assert(len(samples) <= 4)
+
+    def parity(value):
+        return bin(value).count("1") & 1
+
+    present = (1 << len(samples)) - 1
+    header = [0x02, present, (frame_start & 0xf) << 4]
+
+    body = []
+    for left, right in samples:
+        left &= 0xffffff
+        right &= 0xffffff
+        # Valid, user and channel status bits are all 0
+        flags = (parity(right) << 7) | (parity(left) << 3)
+        body += [left & 0xff, (left >> 8) & 0xff, left >> 16,
+                 right & 0xff, (right >> 8) & 0xff, right >> 16, flags]
+    body += [0] * (28 - len(body))
+
+    return (header, body)
+
+
+def pack_packet(header, body):
+    """
+    Packs a packet into the integer values of the `packet_header` and `packet_data`
+    signals used by DataIslandEncoder and DataIslandDecoder.
+    """
+    return (sum(b << (8 * i) for i, b in enumerate(header)),
+            sum(b << (8 * i) for i, b in enumerate(body)))
+
+
+class TERC4Decoder(Elaboratable):
+    """
+    Combinatorial TERC4 decoder
+
+    data_in:  10-bit TMDS character
+    data_out: Decoded 4-bit value
+    valid:    data_in is a valid TERC4 character
+    """
+    def __init__(self):
+        self.data_in = Signal(10)
+        self.data_out = Signal(4)
+        self.valid = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        with m.Switch(self.data_in):
+            for value, char in enumerate(TERC4_CHARACTERS):
+                with m.Case(char):
+                    m.d.comb += [
+                        self.data_out.eq(value),
+                        self.valid.eq(1),
+                    ]
+
+        return m
+
+
+class DataIslandDecoder(Elaboratable):
+    """
+    Detects HDMI data islands and video guard bands and decodes the packets
+    inside data islands.
+
+    Inputs are deskewed 10-bit TMDS characters in the `sync` domain.
+
+    in_d:          List of 3 TMDS characters (d0, d1, d2)
+
+    Outputs are registered, i.e. aligned with the outputs of TMDSDecoder.
+
+    island:        The character is part of a data island (guard bands included)
+    guard:         The character is a video guard band character
+    hsync:         hsync carried by channel 0 during a data island
+    vsync:         vsync carried by channel 0 during a data island
+
+    packet_valid:  Strobed for one cycle when a full packet has been received
+    packet_header: HB0..HB2
+    packet_data:   PB0..PB27, PB0 in the lowest byte
+    packet_ecc_ok: The ECC of the header and all four subpackets matched
+    """
+
+    def __init__(self):
+        self.in_d = [Signal(10, name=f"in_d{i}") for i in range(3)]
+
+        self.island = Signal()
+        self.guard = Signal()
+        self.hsync = Signal()
+        self.vsync = Signal()
+
+        self.packet_valid = Signal()
+        self.packet_header = Signal(24)
+        self.packet_data = Signal(28 * 8)
+        self.packet_ecc_ok = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        in_d = self.in_d
+
+        terc4 = []
+        for i in range(3):
+            dec = TERC4Decoder()
+            setattr(m.submodules, f"terc4_d{i}", dec)
+            m.d.comb += dec.data_in.eq(in_d[i])
+            terc4.append(dec)
+
+        # Preamble detection on channel 1 and 2
+        di_preamble = Signal()
+        video_preamble = Signal()
+        m.d.comb += [
+            di_preamble.eq(
+                (in_d[1] == TMDS_CONTROL_TOKENS[DATA_ISLAND_PREAMBLE[0]]) &
+                (in_d[2] == TMDS_CONTROL_TOKENS[DATA_ISLAND_PREAMBLE[1]])),
+            video_preamble.eq(
+                (in_d[1] == TMDS_CONTROL_TOKENS[VIDEO_PREAMBLE[0]]) &
+                (in_d[2] == TMDS_CONTROL_TOKENS[VIDEO_PREAMBLE[1]])),
+        ]
+
+        di_guard = Signal()
+        video_guard = Signal()
+        m.d.comb += [
+            di_guard.eq(
+                (in_d[1] == DATA_ISLAND_GUARD_BAND) &
+                (in_d[2] == DATA_ISLAND_GUARD_BAND)),
+            video_guard.eq(
+                (in_d[0] == VIDEO_GUARD_BAND[0]) &
+                (in_d[1] == VIDEO_GUARD_BAND[1]) &
+                (in_d[2] == VIDEO_GUARD_BAND[2])),
+        ]
+
+        preamble_ctr = Signal(range(PREAMBLE_LENGTH + 1))
+        preamble_kind = Signal()    # 1 = data island, 0 = video
+        with m.If(di_preamble | video_preamble):
+            with m.If((preamble_kind != di_preamble) | (preamble_ctr == 0)):
+                m.d.sync += preamble_ctr.eq(1)
+            with m.Elif(preamble_ctr != PREAMBLE_LENGTH):
+                m.d.sync += preamble_ctr.eq(preamble_ctr + 1)
+            m.d.sync += preamble_kind.eq(di_preamble)
+        with m.Else():
+            m.d.sync += preamble_ctr.eq(0)
+
+        # The preamble on the wire is 8 characters, accept a couple of lost ones
+        preamble_done = Signal()
+        m.d.comb += preamble_done.eq(preamble_ctr >= PREAMBLE_LENGTH - 2)
+
+        # Packet assembly
+        char_ctr = Signal(range(PACKET_LENGTH))
+        guard_ctr = Signal(range(GUARD_BAND_LENGTH + 1))
+        header_bits = Signal(PACKET_LENGTH)
+        sp_bits = [Signal(2 * PACKET_LENGTH, name=f"sp{n}_bits") for n in range(4)]
+
+        header_ecc = Signal(8)
+        sp_ecc = [Signal(8, name=f"sp{n}_ecc") for n in range(4)]
+
+        def next_ecc(ecc, bit):
+            return (ecc >> 1) ^ Mux(ecc[0] ^ bit, 0b10000011, 0)
+
+        header_bit = terc4[0].data_out[2]
+        even = terc4[1].data_out
+        odd = terc4[2].data_out
+
+        # The current character belongs to a data island
+        island = Signal()
+
+        m.d.sync += [
+            self.island.eq(island),
+            self.guard.eq(0),
+            self.packet_valid.eq(0),
+        ]
+
+        with m.FSM(name="island"):
+            with m.State("IDLE"):
+                with m.If(preamble_done & preamble_kind & di_guard):
+                    m.d.comb += island.eq(1)
+                    m.d.sync += guard_ctr.eq(1)
+                    m.next = "LEADING_GUARD"
+                with m.Elif(preamble_done & ~preamble_kind & video_guard):
+                    m.d.sync += [
+                        self.guard.eq(1),
+                        guard_ctr.eq(1),
+                    ]
+                    m.next = "VIDEO_GUARD"
+
+            with m.State("VIDEO_GUARD"):
+                with m.If(video_guard & (guard_ctr != GUARD_BAND_LENGTH)):
+                    m.d.sync += [
+                        self.guard.eq(1),
+                        guard_ctr.eq(guard_ctr + 1),
+                    ]
+                with m.Else():
+                    m.next = "IDLE"
+
+            with m.State("LEADING_GUARD"):
+                m.d.comb += island.eq(1)
+                with m.If(di_guard):
+                    m.d.sync += guard_ctr.eq(guard_ctr + 1)
+                with m.Else():
+                    m.d.sync += [
+                        char_ctr.eq(1),
+                        header_bits.eq(header_bit << (PACKET_LENGTH - 1)),
+                        header_ecc.eq(next_ecc(Const(0, 8), header_bit)),
+                    ]
+                    for n in range(4):
+                        m.d.sync += [
+                            sp_bits[n].eq(Cat(even[n], odd[n]) << (2 * PACKET_LENGTH - 2)),
+                            sp_ecc[n].eq(next_ecc(next_ecc(Const(0, 8), even[n]), odd[n])),
+                        ]
+                    m.next = "PACKET"
+
+            with m.State("PACKET"):
+                m.d.comb += island.eq(1)
+
+                # Shift in from the top so that the first bit ends up as the LSB
+                m.d.sync += header_bits.eq(Cat(header_bits[1:], header_bit))
+                for n in range(4):
+                    m.d.sync += sp_bits[n].eq(Cat(sp_bits[n][2:], even[n], odd[n]))
+
+                with m.If(char_ctr < 24):
+                    m.d.sync += header_ecc.eq(next_ecc(header_ecc, header_bit))
+                with m.If(char_ctr < 28):
+                    for n in range(4):
+                        m.d.sync += sp_ecc[n].eq(next_ecc(next_ecc(sp_ecc[n], even[n]), odd[n]))
+
+                with m.If(char_ctr == PACKET_LENGTH - 1):
+                    m.d.sync += char_ctr.eq(0)
+                    m.next = "PACKET_DONE"
+                with m.Else():
+                    m.d.sync += char_ctr.eq(char_ctr + 1)
+
+            with m.State("PACKET_DONE"):
+                header = header_bits
+                ecc_ok = header[24:] == header_ecc
+                for n in range(4):
+                    ecc_ok &= sp_bits[n][56:] == sp_ecc[n]
+
+                m.d.sync += [
+                    self.packet_valid.eq(1),
+                    self.packet_header.eq(header[:24]),
+                    self.packet_data.eq(Cat(*[sp_bits[n][:56] for n in range(4)])),
+                    self.packet_ecc_ok.eq(ecc_ok),
+                ]
+                m.d.comb += island.eq(1)
+
+                # This character is either the trailing guard band or the start of the next packet
+                with m.If(di_guard):
+                    m.d.sync += guard_ctr.eq(1)
+                    m.next = "TRAILING_GUARD"
+                with m.Else():
+                    m.d.sync += [
+                        char_ctr.eq(1),
+                        header_bits.eq(header_bit << (PACKET_LENGTH - 1)),
+                        header_ecc.eq(next_ecc(Const(0, 8), header_bit)),
+                    ]
+                    for n in range(4):
+                        m.d.sync += [
+                            sp_bits[n].eq(Cat(even[n], odd[n]) << (2 * PACKET_LENGTH - 2)),
+                            sp_ecc[n].eq(next_ecc(next_ecc(Const(0, 8), even[n]), odd[n])),
+                        ]
+                    m.next = "PACKET"
+
+            with m.State("TRAILING_GUARD"):
+                with m.If(di_guard & (guard_ctr != GUARD_BAND_LENGTH)):
+                    m.d.comb += island.eq(1)
+                    m.d.sync += guard_ctr.eq(guard_ctr + 1)
+                with m.Else():
+                    m.next = "IDLE"
+
+        # hsync and vsync are carried in bit 0 and 1 of channel 0
+        with m.If(island):
+            m.d.sync += [
+                self.hsync.eq(terc4[0].data_out[0]),
+                self.vsync.eq(terc4[0].data_out[1]),
+            ]
+
+        return m
+
+
+class DataIslandEncoder(Elaboratable):
+    """
+    Turns a DVI video timing into HDMI by adding video preambles and guard bands
+    before each active line, and data islands with packets in the blanking periods.
+
+    Active video is never touched. The video timing is instead delayed by
+    `LOOKAHEAD` characters, so that the preamble and guard band in front of each
+    active line can be sent during blanking. The pixel data must be delayed by the
+    same amount, see VGA2DVID.
+
+    A data island is started 4 characters into a blanking period if there is a
+    packet to send and the island fits, based on the length of the previous
+    horizontal blanking period. More packets are added to the island for as long
+    as they fit. During vertical blanking, islands are placed once per line.
+
+    Inputs in the `sync` domain
+
+    in_blank:      Blanking signal
+    in_hsync:      Horizontal sync signal
+    in_vsync:      Vertical sync signal
+
+    packet_valid:  A packet is available, can be connected to `r_rdy` of a SyncFIFO
+    packet_ready:  The packet is consumed, can be connected to `r_en` of a SyncFIFO
+    packet_header: HB0..HB2
+    packet_data:   PB0..PB27, PB0 in the lowest byte
+
+    Outputs
+
+    blank:         in_blank delayed by LOOKAHEAD characters
+    hsync:         in_hsync delayed by LOOKAHEAD characters
+    vsync:         in_vsync delayed by LOOKAHEAD characters
+
+    out_d:         List of 3 TMDS characters (d0, d1, d2), registered, i.e. aligned
+                   with the output of TMDSEncoder fed with `blank`, `hsync` and `vsync`
+    out_en:        List of 3 signals, out_d replaces the TMDSEncoder output when set
+
+    avi_infoframe: (header, body) of the AVI InfoFrame that is sent once per frame,
+                   see `avi_infoframe`. None to disable.
+    max_packets:   Maximum number of packets in one data island
+    """
+
+    LOOKAHEAD = PREAMBLE_LENGTH + GUARD_BAND_LENGTH
+
+    # Characters from the start of blanking to the start of a data island
+    ISLAND_OFFSET = 4
+
+    # Minimum number of control characters between two data or video periods
+    MIN_CONTROL_PERIOD = 12
+
+    def __init__(self, avi_infoframe=avi_infoframe(), max_packets=18):
+        assert(1 <= max_packets <= 18)
+
+        self.avi_infoframe = avi_infoframe
+        self.max_packets = max_packets
+
+        self.in_blank = Signal()
+        self.in_hsync = Signal()
+        self.in_vsync = Signal()
+
+        self.packet_valid = Signal()
+        self.packet_ready = Signal()
+        self.packet_header = Signal(24)
+        self.packet_data = Signal(28 * 8)
+
+        self.blank = Signal()
+        self.hsync = Signal()
+        self.vsync = Signal()
+
+        self.out_d = [Signal(10, name=f"out_d{i}") for i in range(3)]
+        self.out_en = [Signal(name=f"out_en{i}") for i in range(3)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        lookahead = self.LOOKAHEAD
+
+        # blank_d[k] is in_blank delayed by k characters
+        blank_d = [self.in_blank]
+        hsync_d = [self.in_hsync]
+        vsync_d = [self.in_vsync]
+        for k in range(lookahead):
+            for taps, name in ((blank_d, "blank"), (hsync_d, "hsync"), (vsync_d, "vsync")):
+                s = Signal(name=f"{name}_d{k + 1}")
+                m.d.sync += s.eq(taps[-1])
+                taps.append(s)
+
+        blank = blank_d[lookahead]
+        hsync = hsync_d[lookahead]
+        vsync = vsync_d[lookahead]
+        m.d.comb += [
+            self.blank.eq(blank),
+            self.hsync.eq(hsync),
+            self.vsync.eq(vsync),
+        ]
+
+        # Video preamble and guard band in front of the next active line
+        video_guard = Signal()
+        video_preamble = Signal()
+        m.d.comb += [
+            video_guard.eq(blank & ~(blank_d[lookahead - 1] & blank_d[lookahead - 2])),
+            video_preamble.eq(blank & ~video_guard &
+                ~Cat(*blank_d[:lookahead - GUARD_BAND_LENGTH]).all()),
+        ]
+
+        # Measure the line length and the horizontal blanking length.
+        # blank_pos is the position of the current character in the blanking period,
+        # it wraps once per line during vertical blanking.
+        h_total = Signal(16)
+        h_blank = Signal(16)
+        line_ctr = Signal(16)
+        blank_pos = Signal(16)
+
+        hsync_r = Signal()
+        m.d.sync += hsync_r.eq(hsync)
+        with m.If(hsync & ~hsync_r):
+            m.d.sync += [
+                line_ctr.eq(1),
+                h_total.eq(line_ctr),
+            ]
+        with m.Elif(line_ctr != 0xffff):
+            m.d.sync += line_ctr.eq(line_ctr + 1)
+
+        with m.If(blank_d[lookahead - 1] & ~blank):
+            m.d.sync += blank_pos.eq(0)
+        with m.Elif(blank_d[lookahead - 1]):
+            with m.If(blank_pos + 1 == h_total):
+                m.d.sync += blank_pos.eq(0)
+            with m.Else():
+                m.d.sync += blank_pos.eq(blank_pos + 1)
+        with m.If(blank & ~blank_d[lookahead - 1]):
+            m.d.sync += h_blank.eq(blank_pos + 1)
+
+        # Room needed after the start of a packet: the packet, the trailing guard band
+        # and a control period that includes the video preamble and guard band.
+        packet_room = PACKET_LENGTH + GUARD_BAND_LENGTH + self.MIN_CONTROL_PERIOD + GUARD_BAND_LENGTH
+        island_start = self.ISLAND_OFFSET + PREAMBLE_LENGTH + GUARD_BAND_LENGTH
+
+        # Packet sources
+        avi_pending = Signal()
+        vsync_r = Signal()
+        m.d.sync += vsync_r.eq(vsync)
+        if self.avi_infoframe is not None:
+            with m.If(vsync & ~vsync_r):
+                m.d.sync += avi_pending.eq(1)
+        avi_header, avi_data = pack_packet(*(self.avi_infoframe or ([0] * 3, [0] * 28)))
+
+        packet_pending = Signal()
+        m.d.comb += packet_pending.eq(avi_pending | self.packet_valid)
+
+        # Packet shift registers, the ECC is shifted out after the data
+        header_sr = Signal(24)
+        header_ecc = Signal(8)
+        sp_sr = [Signal(56, name=f"sp{n}_sr") for n in range(4)]
+        sp_ecc = [Signal(8, name=f"sp{n}_ecc") for n in range(4)]
+
+        def next_ecc(ecc, bit):
+            return (ecc >> 1) ^ Mux(ecc[0] ^ bit, 0b10000011, 0)
+
+        def load_packet():
+            stmts = [header_ecc.eq(0)] + [sp_ecc[n].eq(0) for n in range(4)]
+            with m.If(avi_pending):
+                m.d.sync += avi_pending.eq(0)
+                m.d.sync += [header_sr.eq(avi_header)]
+                m.d.sync += [sp_sr[n].eq(avi_data >> (56 * n)) for n in range(4)]
+            with m.Else():
+                m.d.comb += self.packet_ready.eq(1)
+                m.d.sync += [header_sr.eq(self.packet_header)]
+                m.d.sync += [sp_sr[n].eq(self.packet_data[56 * n:56 * (n + 1)]) for n in range(4)]
+            m.d.sync += stmts
+
+        char_ctr = Signal(range(PACKET_LENGTH))
+        packet_ctr = Signal(range(self.max_packets + 1))
+        first = Signal()
+
+        hv = Cat(hsync, vsync)
+        terc4 = Array(Const(c, 10) for c in TERC4_CHARACTERS)
+        island_guard = Const(0b1100, 4) | hv
+
+        d = [Signal(10, name=f"d{i}") for i in range(3)]
+        en = [Signal(name=f"en{i}") for i in range(3)]
+
+        with m.FSM(name="island"):
+            with m.State("IDLE"):
+                with m.If(blank & (blank_pos == self.ISLAND_OFFSET) &
+                          (h_blank >= island_start + packet_room) & packet_pending):
+                    m.d.sync += char_ctr.eq(1)
+                    m.d.comb += [
+                        d[1].eq(TMDS_CONTROL_TOKENS[DATA_ISLAND_PREAMBLE[0]]),
+                        d[2].eq(TMDS_CONTROL_TOKENS[DATA_ISLAND_PREAMBLE[1]]),
+                        en[1].eq(1),
+                        en[2].eq(1),
+                    ]
+                    m.next = "PREAMBLE"
+
+            with m.State("PREAMBLE"):
+                m.d.comb += [
+                    d[1].eq(TMDS_CONTROL_TOKENS[DATA_ISLAND_PREAMBLE[0]]),
+                    d[2].eq(TMDS_CONTROL_TOKENS[DATA_ISLAND_PREAMBLE[1]]),
+                    en[1].eq(1),
+                    en[2].eq(1),
+                ]
+                with m.If(char_ctr == PREAMBLE_LENGTH - 1):
+                    m.d.sync += char_ctr.eq(0)
+                    m.next = "LEADING_GUARD"
+                with m.Else():
+                    m.d.sync += char_ctr.eq(char_ctr + 1)
+
+            with m.State("LEADING_GUARD"):
+                m.d.comb += [
+                    d[0].eq(terc4[island_guard]),
+                    d[1].eq(DATA_ISLAND_GUARD_BAND),
+                    d[2].eq(DATA_ISLAND_GUARD_BAND),
+                    en[0].eq(1),
+                    en[1].eq(1),
+                    en[2].eq(1),
+                ]
+                with m.If(char_ctr == GUARD_BAND_LENGTH - 1):
+                    load_packet()
+                    m.d.sync += [
+                        char_ctr.eq(0),
+                        packet_ctr.eq(1),
+                        first.eq(1),
+                    ]
+                    m.next = "PACKET"
+                with m.Else():
+                    m.d.sync += char_ctr.eq(char_ctr + 1)
+
+            with m.State("PACKET"):
+                header_bit = Signal()
+                even = Signal(4)
+                odd = Signal(4)
+
+                with m.If(char_ctr < 24):
+                    m.d.comb += header_bit.eq(header_sr[0])
+                    m.d.sync += [
+                        header_sr.eq(header_sr >> 1),
+                        header_ecc.eq(next_ecc(header_ecc, header_sr[0])),
+                    ]
+                with m.Else():
+                    m.d.comb += header_bit.eq(header_ecc[0])
+                    m.d.sync += header_ecc.eq(header_ecc >> 1)
+
+                for n in range(4):
+                    with m.If(char_ctr < 28):
+                        m.d.comb += [
+                            even[n].eq(sp_sr[n][0]),
+                            odd[n].eq(sp_sr[n][1]),
+                        ]
+                        m.d.sync += [
+                            sp_sr[n].eq(sp_sr[n] >> 2),
+                            sp_ecc[n].eq(next_ecc(next_ecc(sp_ecc[n], sp_sr[n][0]), sp_sr[n][1])),
+                        ]
+                    with m.Else():
+                        m.d.comb += [
+                            even[n].eq(sp_ecc[n][0]),
+                            odd[n].eq(sp_ecc[n][1]),
+                        ]
+                        m.d.sync += sp_ecc[n].eq(sp_ecc[n] >> 2)
+
+                m.d.sync += first.eq(0)
+                m.d.comb += [
+                    d[0].eq(terc4[Cat(hv, header_bit, ~first)]),
+                    d[1].eq(terc4[even]),
+                    d[2].eq(terc4[odd]),
+                    en[0].eq(1),
+                    en[1].eq(1),
+                    en[2].eq(1),
+                ]
+
+                with m.If(char_ctr == PACKET_LENGTH - 1):
+                    m.d.sync += char_ctr.eq(0)
+                    with m.If(packet_pending & (packet_ctr != self.max_packets) &
+                              (blank_pos + 1 + packet_room <= h_blank)):
+                        load_packet()
+                        m.d.sync += packet_ctr.eq(packet_ctr + 1)
+                    with m.Else():
+                        m.next = "TRAILING_GUARD"
+                with m.Else():
+                    m.d.sync += char_ctr.eq(char_ctr + 1)
+
+            with m.State("TRAILING_GUARD"):
+                m.d.comb += [
+                    d[0].eq(terc4[island_guard]),
+                    d[1].eq(DATA_ISLAND_GUARD_BAND),
+                    d[2].eq(DATA_ISLAND_GUARD_BAND),
+                    en[0].eq(1),
+                    en[1].eq(1),
+                    en[2].eq(1),
+                ]
+                with m.If(char_ctr == GUARD_BAND_LENGTH - 1):
+                    m.d.sync += char_ctr.eq(0)
+                    m.next = "IDLE"
+                with m.Else():
+                    m.d.sync += char_ctr.eq(char_ctr + 1)
+
+        # Video preambles and guard bands take precedence, a data island can only
+        # collide with them if the timing changes.
+        with m.If(video_guard):
+            for i in range(3):
+                m.d.sync += [
+                    self.out_d[i].eq(VIDEO_GUARD_BAND[i]),
+                    self.out_en[i].eq(1),
+                ]
+        with m.Elif(video_preamble):
+            m.d.sync += [
+                self.out_d[0].eq(0),
+                self.out_en[0].eq(0),
+                self.out_d[1].eq(TMDS_CONTROL_TOKENS[VIDEO_PREAMBLE[0]]),
+                self.out_d[2].eq(TMDS_CONTROL_TOKENS[VIDEO_PREAMBLE[1]]),
+                self.out_en[1].eq(1),
+                self.out_en[2].eq(1),
+            ]
+        with m.Elif(blank):
+            for i in range(3):
+                m.d.sync += [
+                    self.out_d[i].eq(d[i]),
+                    self.out_en[i].eq(en[i]),
+                ]
+        with m.Else():
+            for i in range(3):
+                m.d.sync += self.out_en[i].eq(0)
+
+        return m
+
+
+class DataIslandDecoderTest(FHDLTestCase):
+
+    def test_data_island_decoder(self):
+        import random
+
+        random.seed(27)
+
+        m = Module()
+        m.submodules.decoder = decoder = DataIslandDecoder()
+
+        packets = [
+            ([0x82, 0x02, 0x0d], [random.randrange(256) for _ in range(28)]),
+            ([0x84, 0x01, 0x0a], [random.randrange(256) for _ in range(28)]),
+            ([0x01, 0x00, 0x00], [random.randrange(256) for _ in range(28)]),
+        ]
+
+        blank = [(TMDS_CONTROL_TOKENS[0b01],) * 3] * 20
+        video_preamble = [(TMDS_CONTROL_TOKENS[0],
+                           TMDS_CONTROL_TOKENS[VIDEO_PREAMBLE[0]],
+                           TMDS_CONTROL_TOKENS[VIDEO_PREAMBLE[1]])] * PREAMBLE_LENGTH
+        video = [tuple(VIDEO_GUARD_BAND)] * GUARD_BAND_LENGTH + [(0x155, 0x2aa, 0x133)] * 10
+
+        island = data_island_characters(packets, hsync=1, vsync=0)
+        chars = blank + island + blank + video_preamble + video + blank
+
+        # Expected flags per character
+        island_start = len(blank) + PREAMBLE_LENGTH
+        island_end = len(blank) + len(island)
+        guard_start = island_end + len(blank) + PREAMBLE_LENGTH
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        received = []
+
+        def process():
+            for t, c in enumerate(chars + blank):
+                for lane in range(3):
+                    yield decoder.in_d[lane].eq(c[lane])
+                yield
+
+                # Outputs are registered, they describe the previous character
+                n = t - 1
+                if n < 0:
+                    continue
+                self.assertEqual((yield decoder.island), int(island_start <= n < island_end), n)
+                self.assertEqual((yield decoder.guard),
+                    int(guard_start <= n < guard_start + GUARD_BAND_LENGTH), n)
+                if island_start <= n < island_end:
+                    self.assertEqual((yield decoder.hsync), 1)
+                    self.assertEqual((yield decoder.vsync), 0)
+
+                if (yield decoder.packet_valid):
+                    header = (yield decoder.packet_header)
+                    data = (yield decoder.packet_data)
+                    self.assertEqual((yield decoder.packet_ecc_ok), 1)
+                    received.append((
+                        [(header >> (8 * i)) & 0xff for i in range(3)],
+                        [(data >> (8 * i)) & 0xff for i in range(28)],
+                    ))
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("hdmi_decoder.vcd"):
+            sim.run()
+
+        self.assertEqual(received, packets)
+
+    def test_packet_ecc(self):
+        # Reference values for an all-zero and all-one header
+        self.assertEqual(packet_ecc([0] * 24), 0)
+        header = [1] * 24
+        ecc = packet_ecc(header)
+        # Appending the ECC must give a zero syndrome
+        self.assertEqual(packet_ecc(header + [(ecc >> i) & 1 for i in range(8)]), 0)
+
+    def test_sync_polarity(self):
+        # DVID2VGA takes hsync/vsync from TMDSDecoder in control periods and from
+        # DataIslandDecoder inside islands, both have to agree for every value
+        m = Module()
+        m.submodules.decoder = decoder = DataIslandDecoder()
+        c0 = Signal(2)
+        m.submodules.tmds = TMDSDecoder(decoder.in_d[0], Signal(8), c0, Signal())
+
+        # Control characters from the DVI 1.0 specification, indexed by {C1, C0}
+        spec_tokens = [0b1101010100, 0b0010101011, 0b0101010100, 0b1010101011]
+
+        packets = [([0x84, 0x02, 0x0d], list(range(28)))]
+        chars = []
+        expected = []
+        for hv in range(4):
+            control = [(spec_tokens[hv], spec_tokens[0], spec_tokens[0])] * 20
+            island = data_island_characters(packets, hsync=hv & 1, vsync=hv >> 1)
+            chars += control + island + control
+            expected += [hv] * (len(control) + len(island) + len(control))
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def process():
+            for t, c in enumerate(chars):
+                for lane in range(3):
+                    yield decoder.in_d[lane].eq(c[lane])
+                yield
+                if t == 0:
+                    continue
+                if (yield decoder.island):
+                    hv = (yield decoder.hsync) | ((yield decoder.vsync) << 1)
+                else:
+                    hv = (yield c0)
+                self.assertEqual(hv, expected[t - 1], t - 1)
+
+        sim.add_sync_process(process)
+        sim.run()
+
+
+class DataIslandEncoderTest(FHDLTestCase):
+
+    def test_data_island_encoder(self):
+        import random
+
+        random.seed(28)
+
+        # Small video timing, 2 packets fit in the horizontal blanking
+        h_active, h_front, h_sync, h_back = 32, 6, 20, 80
+        v_active, v_front, v_sync, v_back = 4, 1, 1, 1
+        h_total = h_active + h_front + h_sync + h_back
+        v_total = v_active + v_front + v_sync + v_back
+
+        # Start with a blank line so that the first active line gets a preamble too
+        timing = [(1, 0, 0)] * h_total
+        for frame in range(3):
+            for y in range(v_total):
+                for x in range(h_total):
+                    blank = int(x >= h_active or y >= v_active)
+                    hsync = int(h_active + h_front <= x < h_active + h_front + h_sync)
+                    vsync = int(v_active + v_front <= y < v_active + v_front + v_sync)
+                    timing.append((blank, hsync, vsync))
+
+        packets = [audio_clock_regeneration_packet(6144, 25200)]
+        packets += [audio_sample_packet([(random.randrange(1 << 24), random.randrange(1 << 24))
+                                         for _ in range(4)]) for _ in range(12)]
+        packets.append(audio_infoframe())
+
+        m = Module()
+        m.submodules.encoder = encoder = DataIslandEncoder(max_packets=2)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        sent = []
+        chars = []
+
+        def process():
+            fifo = list(packets)
+            timing_r = (0, 0)
+            for blank, hsync, vsync in timing:
+                yield encoder.in_blank.eq(blank)
+                yield encoder.in_hsync.eq(hsync)
+                yield encoder.in_vsync.eq(vsync)
+                if fifo:
+                    header, data = pack_packet(*fifo[0])
+                    yield encoder.packet_header.eq(header)
+                    yield encoder.packet_data.eq(data)
+                    yield encoder.packet_valid.eq(1)
+                else:
+                    yield encoder.packet_valid.eq(0)
+                yield
+                if (yield encoder.packet_ready):
+                    sent.append(fifo.pop(0))
+
+                # Reconstruct the TMDS characters as VGA2DVID would send them.
+                # out_d is registered, it belongs to the timing of the previous cycle.
+                blank, hv = timing_r
+                timing_r = ((yield encoder.blank),
+                            (yield encoder.hsync) | ((yield encoder.vsync) << 1))
+                c = []
+                for i in range(3):
+                    if (yield encoder.out_en[i]):
+                        self.assertEqual(blank, 1)
+                        c.append((yield encoder.out_d[i]))
+                    elif blank:
+                        c.append(TMDS_CONTROL_TOKENS[hv if i == 0 else 0])
+                    else:
+                        # Active video is never replaced
+                        c.append(0x155)
+                chars.append((blank, tuple(c)))
+
+        sim.add_sync_process(process)
+        sim.run()
+
+        self.assertEqual(sent, packets)
+
+        # Feed the result back through the decoder
+        m = Module()
+        m.submodules.decoder = decoder = DataIslandDecoder()
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        received = []
+        guards = []
+
+        def process():
+            for blank, c in chars:
+                for i in range(3):
+                    yield decoder.in_d[i].eq(c[i])
+                yield
+                guards.append((yield decoder.guard))
+                if (yield decoder.packet_valid):
+                    self.assertEqual((yield decoder.packet_ecc_ok), 1)
+                    header = (yield decoder.packet_header)
+                    data = (yield decoder.packet_data)
+                    received.append((
+                        [(header >> (8 * i)) & 0xff for i in range(3)],
+                        [(data >> (8 * i)) & 0xff for i in range(28)],
+                    ))
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("hdmi_encoder.vcd"):
+            sim.run()
+
+        # One AVI InfoFrame per frame
+        avi = avi_infoframe()
+        self.assertEqual([p for p in received if p != avi], packets)
+        self.assertEqual(received.count(avi), 3)
+
+        # Every active line is preceded by a video guard band
+        lines = sum(1 for t in range(1, len(chars)) if chars[t - 1][0] and not chars[t][0])
+        self.assertEqual(sum(guards), lines * GUARD_BAND_LENGTH)
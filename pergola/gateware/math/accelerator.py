@@ -0,0 +1,323 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator, Settle
+from nmigen.lib.fifo import SyncFIFOBuffered
+from nmigen.test.utils import FHDLTestCase
+
+from .gemm import TiledMatMul
+
+
+MATMUL_MAGIC = 0x4d
+
+
+class MatMulAccelerator(Elaboratable):
+    """Multiplies int8 matrices sent over a byte stream, e.g. a UART.
+
+    Request:    MATMUL_MAGIC, m, k, n, A[m * k], B[k * n]
+    Response:   C[m * n]
+
+    A and B are int8, C is int32 MSB first, all row-major. Bytes before MATMUL_MAGIC are
+    skipped. Sizes are 1 to max_size, a request with another size is dropped without a
+    response, and the bytes after the size are skipped up to the next MATMUL_MAGIC. See
+    pergola/host/matmul.py.
+
+    The received bytes go through a FIFO into the banks of a TiledMatMul and the response
+    through another FIFO. A request is computed as soon as it has been received and the
+    previous response has been read out of the banks, and the next request is received
+    while a response is sent. A host can therefore keep two requests in flight, more would
+    overflow the input FIFO of a transport without flow control.
+
+    rx_data, rx_valid, rx_ready:    Bytes from the host
+    tx_data, tx_valid, tx_ready:    Bytes to the host
+    busy:                           High while computing
+    """
+    def __init__(self, rows=4, cols=4, max_size=32, fifo_depth=64):
+        assert max_size < 256
+
+        self.rows = rows
+        self.cols = cols
+        self.max_size = max_size
+        self.fifo_depth = fifo_depth
+
+        self.gemm = TiledMatMul(rows, cols, signed(8), signed(32), max_size, max_size, max_size)
+
+        self.rx_data = Signal(8)
+        self.rx_valid = Signal()
+        self.rx_ready = Signal()
+
+        self.tx_data = Signal(8)
+        self.tx_valid = Signal()
+        self.tx_ready = Signal()
+
+        self.busy = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        rows = self.rows
+        cols = self.cols
+        m.submodules.gemm = gemm = self.gemm
+
+        m.submodules.rx_fifo = rx_fifo = SyncFIFOBuffered(width=8, depth=self.fifo_depth)
+        m.submodules.tx_fifo = tx_fifo = SyncFIFOBuffered(width=8, depth=self.fifo_depth)
+        m.d.comb += [
+            rx_fifo.w_data.eq(self.rx_data),
+            rx_fifo.w_en.eq(self.rx_valid),
+            self.rx_ready.eq(rx_fifo.w_rdy),
+
+            self.tx_data.eq(tx_fifo.r_data),
+            self.tx_valid.eq(tx_fifo.r_rdy),
+            tx_fifo.r_en.eq(self.tx_ready),
+
+            self.busy.eq(gemm.busy),
+        ]
+
+        a_wr = [bank.write_port() for bank in gemm.a_banks]
+        b_wr = [bank.write_port() for bank in gemm.b_banks]
+        c_rd = [bank.read_port() for bank in gemm.c_banks]
+        for i, port in enumerate(a_wr + b_wr + c_rd):
+            setattr(m.submodules, f"port_{i}", port)
+
+        # Receive a request, see pack_a and pack_b for the layout of the banks
+        byte = rx_fifo.r_data
+        strobe = Signal()
+        m.d.comb += strobe.eq(rx_fifo.r_en & rx_fifo.r_rdy)
+
+        size_m = Signal(8)
+        size_k = Signal(8)
+        size_n = Signal(8)
+        row = Signal(8)
+        col = Signal(8)
+        bank = Signal(range(max(rows, cols)))
+        base = Signal(range(max(gemm.a_depth, gemm.b_depth) + 1))
+        index = Signal.like(base)
+        m.d.comb += index.eq(base + col)
+
+        for i, port in enumerate(a_wr):
+            m.d.comb += [
+                port.addr.eq(index),
+                port.data.eq(byte),
+            ]
+        for j, port in enumerate(b_wr):
+            m.d.comb += [
+                port.addr.eq(base + row),
+                port.data.eq(byte),
+            ]
+
+        tx_start = Signal()
+        tx_busy = Signal()
+
+        with m.FSM():
+            with m.State("MAGIC"):
+                m.d.comb += rx_fifo.r_en.eq(1)
+                with m.If(strobe & (byte == MATMUL_MAGIC)):
+                    m.next = "M"
+
+            for state, size, next_state in [("M", size_m, "K"), ("K", size_k, "N"), ("N", size_n, "A")]:
+                with m.State(state):
+                    m.d.comb += rx_fifo.r_en.eq(1)
+                    with m.If(strobe):
+                        m.d.sync += [
+                            size.eq(byte),
+                            row.eq(0),
+                            col.eq(0),
+                            bank.eq(0),
+                            base.eq(0),
+                        ]
+                        with m.If((byte == 0) | (byte > self.max_size)):
+                            m.next = "MAGIC"
+                        with m.Else():
+                            m.next = next_state
+
+            with m.State("A"):
+                # A[row][col] goes to bank row % rows at (row // rows) * k + col
+                m.d.comb += rx_fifo.r_en.eq(1)
+                with m.If(strobe):
+                    m.d.comb += Array(port.en for port in a_wr)[bank].eq(1)
+                    m.d.sync += col.eq(col + 1)
+                    with m.If(col == size_k - 1):
+                        m.d.sync += [
+                            col.eq(0),
+                            row.eq(row + 1),
+                            bank.eq(bank + 1),
+                        ]
+                        with m.If(bank == rows - 1):
+                            m.d.sync += [
+                                bank.eq(0),
+                                base.eq(base + size_k),
+                            ]
+                        with m.If(row == size_m - 1):
+                            m.d.sync += [
+                                row.eq(0),
+                                bank.eq(0),
+                                base.eq(0),
+                            ]
+                            m.next = "B"
+
+            with m.State("B"):
+                # B[row][col] goes to bank col % cols at (col // cols) * k + row
+                m.d.comb += rx_fifo.r_en.eq(1)
+                with m.If(strobe):
+                    m.d.comb += Array(port.en for port in b_wr)[bank].eq(1)
+                    m.d.sync += [
+                        col.eq(col + 1),
+                        bank.eq(bank + 1),
+                    ]
+                    with m.If(bank == cols - 1):
+                        m.d.sync += [
+                            bank.eq(0),
+                            base.eq(base + size_k),
+                        ]
+                    with m.If(col == size_n - 1):
+                        m.d.sync += [
+                            col.eq(0),
+                            bank.eq(0),
+                            base.eq(0),
+                            row.eq(row + 1),
+                        ]
+                        with m.If(row == size_k - 1):
+                            m.next = "WAIT"
+
+            with m.State("WAIT"):
+                # The previous response is still read from the C banks
+                with m.If(~tx_busy):
+                    m.d.comb += gemm.start.eq(1)
+                    m.d.sync += [
+                        gemm.m.eq(size_m),
+                        gemm.k.eq(size_k),
+                        gemm.n.eq(size_n),
+                    ]
+                    m.next = "COMPUTE"
+
+            with m.State("COMPUTE"):
+                with m.If(~gemm.busy):
+                    m.d.comb += tx_start.eq(1)
+                    m.next = "MAGIC"
+
+        # Send the response
+        tx_m = Signal(8)
+        tx_n = Signal(8)
+        tx_row = Signal(8)
+        tx_col = Signal(8)
+        tx_bank = Signal(range(rows))
+        tx_base = Signal(range(gemm.c_depth + 1))
+        tx_count = Signal(range(4))
+        word = Signal(32)
+        m.d.comb += word.eq(Array(port.data for port in c_rd)[tx_bank])
+        for port in c_rd:
+            m.d.comb += port.addr.eq(tx_base + tx_col)
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(tx_start):
+                    m.d.sync += [
+                        tx_m.eq(size_m),
+                        tx_n.eq(size_n),
+                        tx_row.eq(0),
+                        tx_col.eq(0),
+                        tx_bank.eq(0),
+                        tx_base.eq(0),
+                        tx_busy.eq(1),
+                    ]
+                    m.next = "FETCH"
+
+            with m.State("FETCH"):
+                # The read ports have a cycle of latency
+                m.d.sync += tx_count.eq(3)
+                m.next = "SEND"
+
+            with m.State("SEND"):
+                m.d.comb += [
+                    tx_fifo.w_data.eq(word.word_select(tx_count, 8)),
+                    tx_fifo.w_en.eq(1),
+                ]
+                with m.If(tx_fifo.w_rdy):
+                    m.d.sync += tx_count.eq(tx_count - 1)
+                    with m.If(tx_count == 0):
+                        m.d.sync += tx_col.eq(tx_col + 1)
+                        m.next = "FETCH"
+                        with m.If(tx_col == tx_n - 1):
+                            m.d.sync += [
+                                tx_col.eq(0),
+                                tx_row.eq(tx_row + 1),
+                                tx_bank.eq(tx_bank + 1),
+                            ]
+                            with m.If(tx_bank == rows - 1):
+                                m.d.sync += [
+                                    tx_bank.eq(0),
+                                    tx_base.eq(tx_base + tx_n),
+                                ]
+                            with m.If(tx_row == tx_m - 1):
+                                m.d.sync += tx_busy.eq(0)
+                                m.next = "IDLE"
+
+        return m
+
+
+# Only used for testing
+import importlib
+if importlib.util.find_spec("numpy") is not None:
+    import numpy as np
+
+class MatMulAcceleratorTest(FHDLTestCase):
+
+    def test_requests(self):
+        from ...host.matmul import pack_request, unpack_response
+
+        m = Module()
+        m.submodules.accel = accel = MatMulAccelerator(rows=4, cols=3, max_size=16, fifo_depth=16)
+
+        np.random.seed(1234)
+        pairs = []
+        for M, K, N in [(6, 5, 7), (3, 9, 2), (8, 8, 8)]:
+            pairs.append((np.random.randint(-128, 128, size=(M, K)),
+                          np.random.randint(-128, 128, size=(K, N))))
+
+        sim = Simulator(m)
+        sim.add_clock(1/16e6, domain="sync")
+
+        # Headers with sizes out of range are dropped
+        bad_headers = bytes([MATMUL_MAGIC, 0, 3, 3, MATMUL_MAGIC, 4, 17, 4, MATMUL_MAGIC, 2, 2, 0])
+
+        def send_process():
+            # Garbage before the first request, then all requests back to back
+            data = b"\x00\x12" + bad_headers + b"".join(pack_request(A, B) for A, B in pairs)
+            for byte in data:
+                yield accel.rx_data.eq(byte)
+                yield accel.rx_valid.eq(1)
+                # The byte is taken at the clock edge if ready is high before it
+                while True:
+                    yield Settle()
+                    ready = yield accel.rx_ready
+                    yield
+                    if ready:
+                        break
+            yield accel.rx_valid.eq(0)
+
+        def receive_process():
+            # Not ready every other cycle
+            data = bytearray()
+            expected = sum(4 * A.shape[0] * B.shape[1] for A, B in pairs)
+            cycle = 0
+            while len(data) < expected:
+                # A request that was not dropped stalls the ones behind it
+                self.assertLess(cycle, 20000)
+                ready = cycle % 2
+                cycle += 1
+                yield accel.tx_ready.eq(ready)
+                yield Settle()
+                valid = yield accel.tx_valid
+                byte = yield accel.tx_data
+                yield
+                if valid and ready:
+                    data.append(byte)
+
+            for A, B in pairs:
+                size = 4 * A.shape[0] * B.shape[1]
+                C = unpack_response(bytes(data[:size]), A.shape[0], B.shape[1])
+                data = data[size:]
+                self.assertTrue(np.array_equal(C, A @ B), f"\n{C}\n{A @ B}")
+
+        sim.add_sync_process(send_process)
+        sim.add_sync_process(receive_process)
+        with sim.write_vcd("accelerator.vcd"):
+            sim.run()
@@ -0,0 +1,162 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator, Settle
+from nmigen.test.utils import FHDLTestCase
+
+from enum import Enum
+import math
+
+
+class FloatFormat(Enum):
+    """Floating point formats, (exponent bits, mantissa bits).
+
+    Denormals are flushed to zero, infinities and NaNs are not supported.
+    """
+    BFLOAT16 = (8, 7)
+    TF32     = (8, 10)
+    FP32     = (8, 23)
+
+    @property
+    def exponent_bits(self):
+        return self.value[0]
+
+    @property
+    def mantissa_bits(self):
+        return self.value[1]
+
+    @property
+    def width(self):
+        return 1 + self.exponent_bits + self.mantissa_bits
+
+    @property
+    def bias(self):
+        return (1 << (self.exponent_bits - 1)) - 1
+
+
+class FixedToFloat(Elaboratable):
+    """Converts a signed fixed point number to FP32, rounding to nearest even.
+
+    `i` has `width` bits of which `frac_bits` are fraction bits, `o` is the FP32 bit pattern.
+    The conversion is combinational.
+    """
+    def __init__(self, width, frac_bits):
+        fmt = FloatFormat.FP32
+        assert width > fmt.mantissa_bits + 1
+        assert 0 < width - 1 - frac_bits + fmt.bias < (1 << fmt.exponent_bits) - 1
+        assert 0 < -frac_bits + fmt.bias
+
+        self.width = width
+        self.frac_bits = frac_bits
+
+        self.i = Signal(signed(width))
+        self.o = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        width = self.width
+        fmt = FloatFormat.FP32
+        mbits = fmt.mantissa_bits
+
+        sign = Signal()
+        mag = Signal(width)
+        m.d.comb += [
+            sign.eq(self.i < 0),
+            mag.eq(Mux(sign, -self.i, self.i)),
+        ]
+
+        # Position of the leading one
+        lead = Signal(range(width))
+        for i in range(width):
+            with m.If(mag[i]):
+                m.d.comb += lead.eq(i)
+
+        # Leading one at the MSB, then round the bits below the mantissa
+        norm = Signal(width)
+        mantissa = Signal(mbits + 1)
+        guard = Signal()
+        sticky = Signal()
+        m.d.comb += [
+            norm.eq(mag << (width - 1 - lead)),
+            mantissa.eq(norm[width - 1 - mbits:width - 1]),
+            guard.eq(norm[width - 2 - mbits]),
+            sticky.eq(norm[:width - 2 - mbits] != 0),
+        ]
+
+        rounded = Signal(mbits + 1)
+        exponent = Signal(fmt.exponent_bits)
+        m.d.comb += [
+            rounded.eq(mantissa + (guard & (sticky | mantissa[0]))),
+            # A carry out of the mantissa increments the exponent
+            exponent.eq(lead + (fmt.bias - self.frac_bits) + rounded[mbits]),
+        ]
+
+        with m.If(mag != 0):
+            m.d.comb += self.o.eq(Cat(rounded[:mbits], exponent, sign))
+
+        return m
+
+
+# Reference models and conversions, only used for testing and by host tools
+import importlib
+if importlib.util.find_spec("numpy") is not None:
+    import numpy as np
+
+
+def to_bits(values, fmt):
+    """Rounds float32 values to `fmt`, to nearest even. Returns the bit patterns."""
+    bits = np.asarray(values, dtype=np.float32).view(np.uint32).astype(np.uint64)
+    drop = FloatFormat.FP32.mantissa_bits - fmt.mantissa_bits
+    if drop > 0:
+        bits = (bits + (1 << (drop - 1)) - 1 + ((bits >> drop) & 1)) >> drop
+    # Flush denormals to zero
+    exponent = (bits >> fmt.mantissa_bits) & ((1 << fmt.exponent_bits) - 1)
+    bits = np.where(exponent == 0, bits & (1 << (fmt.width - 1)), bits)
+    return bits.astype(np.uint32)
+
+
+def from_bits(bits, fmt):
+    """Returns the float32 values of `fmt` bit patterns."""
+    drop = FloatFormat.FP32.mantissa_bits - fmt.mantissa_bits
+    return (np.asarray(bits, dtype=np.uint32) << drop).view(np.float32)
+
+
+class FloatTest(FHDLTestCase):
+
+    def test_to_bits(self):
+        values = np.array([0, 1, -2, 1.5, 3.14159, 1e-40], dtype=np.float32)
+        self.assertEqual(list(to_bits(values, FloatFormat.BFLOAT16)),
+                         [0x0000, 0x3f80, 0xc000, 0x3fc0, 0x4049, 0x0000])
+        self.assertEqual(list(to_bits(values, FloatFormat.TF32)),
+                         [0x00000, 0x1fc00, 0x60000, 0x1fe00, 0x20248, 0x00000])
+        self.assertEqual(list(from_bits(to_bits(values[:4], FloatFormat.BFLOAT16), FloatFormat.BFLOAT16)),
+                         list(values[:4]))
+
+    def test_fixed_to_float(self):
+        width = 64
+        frac_bits = 32
+
+        m = Module()
+        m.submodules.conv = conv = FixedToFloat(width, frac_bits)
+
+        np.random.seed(1234)
+        values = [0, 1, -1, (1 << 63) - 1, -(1 << 63), 0x1_0000_0001, 0x1_ffff_ff80, 0x1_ffff_ffff]
+        values += [int(v) for v in np.random.randint(-(1 << 62), 1 << 62, size=100, dtype=np.int64)]
+        values += [int(v) for v in np.random.randint(-(1 << 20), 1 << 20, size=100)]
+
+        sim = Simulator(m)
+
+        def process():
+            for value in values:
+                yield conv.i.eq(value)
+                yield Settle()
+                result = from_bits([(yield conv.o)], FloatFormat.FP32)[0]
+                # Keep the dropped bits as a sticky bit, so that float64 -> float32
+                # rounds like a single rounding
+                mag = abs(value)
+                shift = max(0, mag.bit_length() - 53)
+                reduced = (mag >> shift) | (mag & ((1 << shift) - 1) != 0)
+                expected = np.float32(math.copysign(math.ldexp(reduced, shift - frac_bits), value))
+                self.assertEqual(result, expected, hex(value))
+
+        sim.add_process(process)
+        sim.run()
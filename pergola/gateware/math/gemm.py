@@ -0,0 +1,327 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+from nmigen.test.utils import FHDLTestCase
+
+from .matmul import SystolicMatMul
+from ..delay import Delay
+
+
+def ceil_div(a, b):
+    return -(-a // b)
+
+
+def pack_a(A, rows):
+    """Returns the contents of the A banks of a TiledMatMul for the M x K matrix A.
+
+    Bank i holds the rows i, i + rows, ..., one row block after the other.
+    """
+    M, K = len(A), len(A[0])
+    banks = [[] for _ in range(rows)]
+    for mb in range(ceil_div(M, rows)):
+        for i in range(rows):
+            row = mb * rows + i
+            banks[i] += [int(A[row][k]) if row < M else 0 for k in range(K)]
+    return banks
+
+
+def pack_b(B, cols):
+    """Returns the contents of the B banks of a TiledMatMul for the K x N matrix B.
+
+    Bank j holds the columns j, j + cols, ..., one column block after the other.
+    """
+    K, N = len(B), len(B[0])
+    banks = [[] for _ in range(cols)]
+    for nb in range(ceil_div(N, cols)):
+        for j in range(cols):
+            col = nb * cols + j
+            banks[j] += [int(B[k][col]) if col < N else 0 for k in range(K)]
+    return banks
+
+
+def unpack_c(banks, M, N):
+    """Returns the M x N result from the contents of the C banks of a TiledMatMul.
+
+    Bank i holds the rows i, i + rows, ... of C.
+    """
+    rows = len(banks)
+    return [[banks[row % rows][(row // rows) * N + n] for n in range(N)] for row in range(M)]
+
+
+class TiledMatMul(Elaboratable):
+    """Multiplies M x K by K x N matrices of any size on a rows x cols SystolicMatMul.
+
+    The matrices are stored in banked block RAMs, see pack_a, pack_b and unpack_c, so that a
+    whole column of an A tile and a whole row of a B tile are read every cycle. C is split
+    into output blocks of rows x cols. For every block, the K columns of the row block of A
+    and the K rows of the column block of B are streamed into the pipelined array, back to
+    back with the previous block. The PEs accumulate the partial sums of all of K, so no
+    partial sums are written back, and each block of C is written once while the next one
+    is computed. A and B are loaded into the banks once and reused for all blocks that need
+    them, every row block of A is read ceil(N / cols) times and every column block of B
+    ceil(M / rows) times, at the full rate of the array.
+
+    A block takes max(K, cols) cycles, with zeros fed when K < cols. With full blocks the
+    array is busy all the time except for the latency at the end, see `cycles`.
+
+    shape, acc_shape:           Shapes of the elements of A and B, and of C
+    max_m, max_k, max_n:        Largest matrices, sets the depth of the banks
+
+    m, k, n:                    Size of the matrices, set before start
+    start:                      Strobe to start
+    busy:                       High from start until C has been written
+    a_banks, b_banks, c_banks:  Memories, one per row or column of the array
+    """
+    def __init__(self, rows, cols, shape, acc_shape, max_m, max_k, max_n):
+        self.rows = rows
+        self.cols = cols
+        self.shape = shape
+        self.acc_shape = acc_shape
+
+        self.m = Signal(range(max_m + 1))
+        self.k = Signal(range(max_k + 1))
+        self.n = Signal(range(max_n + 1))
+        self.start = Signal()
+        self.busy = Signal()
+
+        width = Shape.cast(shape).width
+        acc_width = Shape.cast(acc_shape).width
+        self.a_depth = ceil_div(max_m, rows) * max_k
+        self.b_depth = ceil_div(max_n, cols) * max_k
+        self.c_depth = ceil_div(max_m, rows) * max_n
+        self.a_banks = [Memory(width=width, depth=self.a_depth) for _ in range(rows)]
+        self.b_banks = [Memory(width=width, depth=self.b_depth) for _ in range(cols)]
+        self.c_banks = [Memory(width=acc_width, depth=self.c_depth) for _ in range(rows)]
+
+        self.matmul = SystolicMatMul(rows, cols, shape, pipelined=True, acc_shape=acc_shape)
+        # Cycles from done_in until the first column of results
+        self.latency = rows + cols + self.matmul.latency
+
+    def cycles(self, m, k, n):
+        """Cycles from start until busy is low again."""
+        blocks = ceil_div(m, self.rows) * ceil_div(n, self.cols)
+        # Start, the blocks, the final done, the read latency, the results of the last block
+        return 1 + blocks * max(k, self.cols) + 1 + 1 + self.latency + self.cols
+
+    def elaborate(self, platform):
+        m = Module()
+
+        rows = self.rows
+        cols = self.cols
+        m.submodules.matmul = matmul = self.matmul
+
+        a_rd = [bank.read_port() for bank in self.a_banks]
+        b_rd = [bank.read_port() for bank in self.b_banks]
+        c_wr = [bank.write_port() for bank in self.c_banks]
+        for i, port in enumerate(a_rd + b_rd + c_wr):
+            setattr(m.submodules, f"port_{i}", port)
+
+        # Position in the loops
+        length = Signal.like(self.k)
+        k = Signal.like(self.k)
+        a_base = Signal(range(self.a_depth + 1))
+        b_base = Signal(range(self.b_depth + 1))
+        c_base = Signal(range(self.c_depth + 1))
+        n0 = Signal.like(self.n)
+        row0 = Signal.like(self.m)
+        first = Signal()
+
+        # The block that is finished by the next done
+        done_c_index = Signal.like(c_base)
+        done_n0 = Signal.like(self.n)
+
+        m.d.comb += length.eq(Mux(self.k < cols, cols, self.k))
+
+        # Inputs of the array, one cycle after the addresses
+        issue_valid = Signal()
+        issue_done = Signal()
+        valid = Signal()
+        done = Signal()
+        m.d.sync += [
+            valid.eq(issue_valid),
+            done.eq(issue_done),
+        ]
+        for i in range(rows):
+            m.d.comb += [
+                a_rd[i].addr.eq(a_base + k),
+                matmul.left_in[i].eq(Mux(valid, a_rd[i].data, 0)),
+                matmul.done_in[i].eq(done),
+            ]
+        for j in range(cols):
+            m.d.comb += [
+                b_rd[j].addr.eq(b_base + k),
+                matmul.top_in[j].eq(Mux(valid, b_rd[j].data, 0)),
+            ]
+
+        drain = Signal(range(self.latency + cols + 2))
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.start):
+                    m.d.sync += [
+                        self.busy.eq(1),
+                        k.eq(0),
+                        a_base.eq(0),
+                        b_base.eq(0),
+                        c_base.eq(0),
+                        n0.eq(0),
+                        row0.eq(0),
+                        first.eq(1),
+                    ]
+                    m.next = "RUN"
+
+            with m.State("RUN"):
+                m.d.comb += [
+                    issue_valid.eq(k < self.k),
+                    issue_done.eq((k == 0) & ~first),
+                ]
+                m.d.sync += k.eq(k + 1)
+                with m.If(k == length - 1):
+                    m.d.sync += [
+                        k.eq(0),
+                        first.eq(0),
+                        done_c_index.eq(c_base + n0),
+                        done_n0.eq(n0),
+                    ]
+                    with m.If(n0 + cols < self.n):
+                        # Next column block
+                        m.d.sync += [
+                            n0.eq(n0 + cols),
+                            b_base.eq(b_base + self.k),
+                        ]
+                    with m.Else():
+                        # Next row block
+                        m.d.sync += [
+                            n0.eq(0),
+                            b_base.eq(0),
+                            row0.eq(row0 + rows),
+                            a_base.eq(a_base + self.k),
+                            c_base.eq(c_base + self.n),
+                        ]
+                        with m.If(row0 + rows >= self.m):
+                            m.next = "FLUSH"
+
+            with m.State("FLUSH"):
+                # Finish the last block
+                m.d.comb += issue_done.eq(1)
+                m.d.sync += drain.eq(self.latency + cols)
+                m.next = "DRAIN"
+
+            with m.State("DRAIN"):
+                m.d.sync += drain.eq(drain - 1)
+                with m.If(drain == 0):
+                    m.d.sync += self.busy.eq(0)
+                    m.next = "IDLE"
+
+        # Write the results, which arrive `latency` cycles after done, last column first
+        info = Signal(len(done_c_index) + len(done_n0))
+        m.d.sync += info.eq(Cat(done_c_index, done_n0))
+
+        # done has to be low after a reset, info is only used with it
+        delay_done = Delay(1, self.latency)
+        delay_info = Delay(len(info), self.latency, threshold=2)
+        m.submodules.delay_done = delay_done
+        m.submodules.delay_info = delay_info
+        m.d.comb += [
+            delay_done.w_data.eq(done),
+            delay_info.w_data.eq(info),
+        ]
+
+        col = Signal(range(cols))
+        writing = Signal()
+        c_index = Signal.like(done_c_index)
+        c_n0 = Signal.like(done_n0)
+        col_r = Signal.like(col)
+        writing_r = Signal()
+        info_r = Signal.like(info)
+        with m.If(delay_done.r_data):
+            m.d.comb += [
+                writing.eq(1),
+                col.eq(cols - 1),
+                Cat(c_index, c_n0).eq(delay_info.r_data),
+            ]
+            m.d.sync += [
+                info_r.eq(delay_info.r_data),
+                col_r.eq(max(cols - 2, 0)),
+                writing_r.eq(cols > 1),
+            ]
+        with m.Else():
+            m.d.comb += [
+                writing.eq(writing_r),
+                col.eq(col_r),
+                Cat(c_index, c_n0).eq(info_r),
+            ]
+            with m.If(writing_r):
+                m.d.sync += col_r.eq(col_r - 1)
+                with m.If(col_r == 0):
+                    m.d.sync += writing_r.eq(0)
+
+        for i in range(rows):
+            m.d.comb += [
+                c_wr[i].addr.eq(c_index + col),
+                c_wr[i].data.eq(matmul.right_out[i]),
+                # Columns past n would overwrite the next row block
+                c_wr[i].en.eq(writing & (c_n0 + col < self.n)),
+            ]
+
+        return m
+
+
+# Only used for testing
+import importlib
+if importlib.util.find_spec("numpy") is not None:
+    import numpy as np
+
+class TiledMatMulTest(FHDLTestCase):
+
+    def test_gemm(self):
+        rows = 4
+        cols = 3
+
+        for M, K, N in [(10, 7, 8), (5, 2, 4), (4, 3, 3), (9, 13, 1)]:
+            with self.subTest(M=M, K=K, N=N):
+                self.check_gemm(rows, cols, M, K, N)
+
+    def check_gemm(self, rows, cols, M, K, N):
+        m = Module()
+        m.submodules.gemm = gemm = TiledMatMul(rows, cols, signed(8), signed(32),
+                                               max_m=16, max_k=16, max_n=16)
+
+        np.random.seed(M * K * N)
+        A = np.random.randint(-128, 128, size=(M, K))
+        B = np.random.randint(-128, 128, size=(K, N))
+        for bank, init in zip(gemm.a_banks, pack_a(A, rows)):
+            bank.init = init
+        for bank, init in zip(gemm.b_banks, pack_b(B, cols)):
+            bank.init = init
+
+        sim = Simulator(m)
+        sim.add_clock(1/10e6, domain="sync")
+
+        def process():
+            yield gemm.m.eq(M)
+            yield gemm.k.eq(K)
+            yield gemm.n.eq(N)
+            yield gemm.start.eq(1)
+            yield
+            yield gemm.start.eq(0)
+            cycles = 1
+            yield
+            while (yield gemm.busy):
+                cycles += 1
+                yield
+
+            self.assertEqual(cycles, gemm.cycles(M, K, N))
+
+            banks = []
+            for bank in gemm.c_banks:
+                banks.append([])
+                for i in range(bank.depth):
+                    banks[-1].append((yield bank[i]))
+            # Memory contents are unsigned
+            C = np.array(unpack_c(banks, M, N))
+            C = np.where(C >= 1 << 31, C - (1 << 32), C)
+            self.assertTrue(np.array_equal(C, A @ B), f"\n{C}\n{A @ B}")
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("gemm.vcd"):
+            sim.run()
@@ -1,6 +1,10 @@
 from nmigen import *
-from nmigen.back.pysim import Simulator
+from nmigen.back.pysim import Simulator, Settle
 from nmigen.test.utils import FHDLTestCase
+from nmigen.utils import bits_for
+
+from .fp import FloatFormat, FixedToFloat
+from ..delay import Delay
 
 
 class ProcessingUnit(Elaboratable):
@@ -16,7 +20,9 @@ class ProcessingUnit(Elaboratable):
                    v
                bottom_out
 
-    Each cycle, `acc + top_in * left_in` is stored in `acc`.
+    Each cycle, `acc + top_in * left_in` is stored in `acc`. The operands have `shape` and
+    `acc` has `acc_shape`, `shape` by default. `right_out` passes the results as well, so it
+    and `left_in` have `acc_shape`, and only the `shape` LSBs of `left_in` are multiplied.
 
     `done_in` should be asserted for one cycle after the last input has been shifted in.
     `left_in` and `top_in` should also be `0` during this cycle.
@@ -24,22 +30,91 @@ class ProcessingUnit(Elaboratable):
     The result will arrive 2*N cycles later with the left-most PE's accumulator value first,
     where N is the number of elements in the horizontal chain.
 
+    When `pipelined` is set, the accumulator is double buffered:
+
+                top_in
+                   v
+                +-----+
+     left_in -> |     | -> right_out
+     done_in -> | P E | -> done_out
+   result_in -> |     | -> result_out
+        load -> |     |
+                +-----+
+                   v
+               bottom_out
+
+    `done_in` is asserted together with the first inputs of the next set, or with zeros
+    if there is none. The finished `acc` is then stored in `result` while `acc` starts
+    over with the new inputs, so sets can be shifted in back to back. `done_out` and
+    `right_out` are delayed by one cycle instead of two. `left_in` and `right_out` only pass
+    operands and have `shape`, the result chain has `acc_shape`.
+
+    The results are shifted out on a separate chain. When `load` is asserted, `result`
+    is stored in `result_out`, otherwise `result_in` is passed. `load` should be
+    asserted for all PEs in the chain in the cycle after `done_in` of the right-most PE,
+    the results then arrive at its `result_out` right-most first, one per cycle.
+    The next set must not be shorter than the chain.
+
     """
-    def __init__(self, shape, suffix):
+    latency = 0
+
+    def __init__(self, shape, suffix, pipelined=False, acc_shape=None):
+        if acc_shape is None:
+            acc_shape = shape
+        self.shape = shape
+        self.acc_shape = acc_shape
+        self.pipelined = pipelined
+
+        left_shape = shape if pipelined else acc_shape
         self.top_in = Signal(shape, name=f"top_in_{suffix}")
-        self.left_in = Signal(shape, name=f"left_in_{suffix}")
-        self.acc = Signal(shape, name=f"acc_{suffix}")
+        self.left_in = Signal(left_shape, name=f"left_in_{suffix}")
+        self.acc = Signal(acc_shape, name=f"acc_{suffix}")
         self.bottom_out = Signal(shape, name=f"bottom_out_{suffix}")
-        self.right_out = Signal(shape, name=f"right_out_{suffix}")
+        self.right_out = Signal(left_shape, name=f"right_out_{suffix}")
 
         self.done_in = Signal(name=f"done_in_{suffix}")
         self.done_in_r = Signal(name=f"done_in_r_{suffix}")
         self.done_out = Signal(name=f"done_out_{suffix}")
 
+        if pipelined:
+            self.result = Signal(acc_shape, name=f"result_{suffix}")
+            self.result_in = Signal(acc_shape, name=f"result_in_{suffix}")
+            self.result_out = Signal(acc_shape, name=f"result_out_{suffix}")
+            self.load = Signal(name=f"load_{suffix}")
+
     def elaborate(self, platform):
         m = Module()
+
+        # Multiply with operands of `shape` only
+        left = Signal(self.shape)
+        product = Signal(Shape(2 * len(left), left.signed))
         mac = Signal.like(self.acc)
-        m.d.comb += mac.eq(self.acc + self.top_in * self.left_in)
+        m.d.comb += [
+            left.eq(self.left_in),
+            product.eq(self.top_in * left),
+            mac.eq(self.acc + product),
+        ]
+
+        if self.pipelined:
+            m.d.sync += [
+                self.bottom_out.eq(self.top_in),
+                self.right_out.eq(self.left_in),
+                self.done_out.eq(self.done_in),
+            ]
+            with m.If(self.done_in):
+                # Store the finished acc, start over with the next set
+                m.d.sync += self.result.eq(self.acc)
+                m.d.sync += self.acc.eq(product)
+            with m.Else():
+                m.d.sync += self.acc.eq(mac)
+
+            with m.If(self.load):
+                m.d.sync += self.result_out.eq(self.result)
+            with m.Else():
+                m.d.sync += self.result_out.eq(self.result_in)
+
+            return m
+
         m.d.sync += [
             self.bottom_out.eq(self.top_in),
             self.done_out.eq(self.done_in_r),
@@ -61,36 +136,189 @@ class ProcessingUnit(Elaboratable):
         return m
 
 
-class Delay(Elaboratable):
-    """Delays a signal
+class FloatProcessingUnit(Elaboratable):
+    """Performs floating point multiply accumulate and passes data.
+
+    Has the ports of a pipelined ProcessingUnit and works the same way. `top_in` and `left_in`
+    are bit patterns in `fmt`, a FloatFormat like bfloat16 or tf32.
+
+    The mantissas, including the hidden bit, are multiplied in a DSP and the product is
+    registered, so `acc` is updated `latency` cycles after the inputs and `load` has to be
+    delayed as much. The product is then shifted to a signed fixed point number with
+    `frac_bits` fraction bits and added to `acc`, which has `acc_shape`. The accumulation is
+    exact as long as the sum fits into `acc_shape`, products below its resolution are truncated.
+    Zeros and denormals multiply to zero. Products and sums that do not fit saturate `acc` to
+    the largest positive or negative value of `acc_shape`.
 
-    Delays the input signal with `depth` clock cycles.
     """
-    def __init__(self, shape, depth):
-        self.shape = shape
-        self.depth = depth
+    latency = 1
+
+    def __init__(self, fmt, suffix, acc_shape=signed(64), frac_bits=32):
+        assert(Shape.cast(acc_shape).signed)
+
+        self.fmt = fmt
+        self.frac_bits = frac_bits
+
+        shape = unsigned(fmt.width)
+        self.top_in = Signal(shape, name=f"top_in_{suffix}")
+        self.left_in = Signal(shape, name=f"left_in_{suffix}")
+        self.acc = Signal(acc_shape, name=f"acc_{suffix}")
+        self.bottom_out = Signal(shape, name=f"bottom_out_{suffix}")
+        self.right_out = Signal(shape, name=f"right_out_{suffix}")
 
-        self.w_data = Signal(shape)
-        self.r_data = Signal(shape)
+        self.done_in = Signal(name=f"done_in_{suffix}")
+        self.done_out = Signal(name=f"done_out_{suffix}")
+
+        self.result = Signal(acc_shape, name=f"result_{suffix}")
+        self.result_in = Signal(acc_shape, name=f"result_in_{suffix}")
+        self.result_out = Signal(acc_shape, name=f"result_out_{suffix}")
+        self.load = Signal(name=f"load_{suffix}")
 
     def elaborate(self, platform):
-        depth = self.depth
+        m = Module()
+
+        fmt = self.fmt
+        mbits = fmt.mantissa_bits
+        ebits = fmt.exponent_bits
+        acc_width = len(self.acc)
+
+        m.d.sync += [
+            self.bottom_out.eq(self.top_in),
+            self.right_out.eq(self.left_in),
+            self.done_out.eq(self.done_in),
+        ]
 
+        # Stage 1: Multiply the mantissas, add the exponents
+        top_exponent = self.top_in[mbits:mbits + ebits]
+        left_exponent = self.left_in[mbits:mbits + ebits]
+        product = Signal(2 * (mbits + 1))
+        sign = Signal()
+        exponent = Signal(ebits + 1)
+        zero = Signal()
+        done = Signal()
+        m.d.sync += [
+            product.eq(Cat(self.top_in[:mbits], 1) * Cat(self.left_in[:mbits], 1)),
+            sign.eq(self.top_in[-1] ^ self.left_in[-1]),
+            exponent.eq(top_exponent + left_exponent),
+            zero.eq((top_exponent == 0) | (left_exponent == 0)),
+            done.eq(self.done_in),
+        ]
+
+        # Stage 2: Shift the product to the fixed point and accumulate.
+        # The product is product * 2**(exponent - 2 * bias - 2 * mbits)
+        offset = self.frac_bits - 2 * fmt.bias - 2 * mbits
+        shift = Signal(signed(ebits + 3 + bits_for(abs(offset))))
+        aligned = Signal(acc_width)
+        value = Signal.like(self.acc)
+        m.d.comb += shift.eq(exponent + offset)
+
+        # The MSB of the product is bit -1 or -2, the shifted product has to fit into the
+        # acc_width - 1 magnitude bits of acc
+        p_width = len(product)
+        overflow = Signal()
+        m.d.comb += overflow.eq((shift >= acc_width - p_width) &
+                                ((shift != acc_width - p_width) | product[-1]))
+
+        with m.If(zero):
+            pass
+        with m.Elif(overflow):
+            m.d.comb += aligned.eq(2**(acc_width - 1) - 1)
+        with m.Elif(shift >= 0):
+            m.d.comb += aligned.eq(product << shift[:bits_for(acc_width)])
+        with m.Elif(shift > -len(product)):
+            m.d.comb += aligned.eq(product >> (-shift)[:bits_for(len(product))])
+        m.d.comb += value.eq(Mux(sign, -aligned, aligned))
+
+        # Saturate the sum if the signs of acc and value are equal and differ from the sum
+        wrapped = Signal.like(self.acc)
+        acc_sum = Signal.like(self.acc)
+        m.d.comb += wrapped.eq(self.acc + value)
+        with m.If((self.acc[-1] == value[-1]) & (wrapped[-1] != value[-1])):
+            m.d.comb += acc_sum.eq(Mux(value[-1], -2**(acc_width - 1), 2**(acc_width - 1) - 1))
+        with m.Else():
+            m.d.comb += acc_sum.eq(wrapped)
+
+        with m.If(done):
+            # Store the finished acc, start over with the next set
+            m.d.sync += self.result.eq(self.acc)
+            m.d.sync += self.acc.eq(value)
+        with m.Else():
+            m.d.sync += self.acc.eq(acc_sum)
+
+        with m.If(self.load):
+            m.d.sync += self.result_out.eq(self.result)
+        with m.Else():
+            m.d.sync += self.result_out.eq(self.result_in)
+
+        return m
+
+
+class WeightStationaryUnit(Elaboratable):
+    """Multiplies a streamed operand with a stored weight and adds it to a passed sum.
+
+                top_in   sum_in
+                   v       v
+                +-----------+
+     left_in -> |           | -> right_out
+     done_in -> |    P E    | -> done_out
+        load -> |           |
+                +-----------+
+                   v       v
+             bottom_out   sum_out
+
+    Each cycle, `sum_in + left_in * weight` is stored in `sum_out` and `left_in` is passed to
+    `right_out`. The operands have `shape`, the sums have `acc_shape`, `shape` by default.
+
+    The weights are shifted in through `top_in` and `bottom_out` while `load` is asserted,
+    into `shadow`, so that they can be loaded while the previous ones are used. When `done_in`
+    is asserted, `shadow` is used and stored in `weight`. `done_in` is passed to `done_out`
+    and should be asserted together with the first input of the next set.
+
+    """
+    latency = 0
+
+    def __init__(self, shape, suffix, acc_shape=None):
+        if acc_shape is None:
+            acc_shape = shape
+        self.shape = shape
+        self.acc_shape = acc_shape
+
+        self.top_in = Signal(shape, name=f"top_in_{suffix}")
+        self.left_in = Signal(shape, name=f"left_in_{suffix}")
+        self.bottom_out = Signal(shape, name=f"bottom_out_{suffix}")
+        self.right_out = Signal(shape, name=f"right_out_{suffix}")
+        self.sum_in = Signal(acc_shape, name=f"sum_in_{suffix}")
+        self.sum_out = Signal(acc_shape, name=f"sum_out_{suffix}")
+
+        self.weight = Signal(shape, name=f"weight_{suffix}")
+        self.shadow = Signal(shape, name=f"shadow_{suffix}")
+
+        self.done_in = Signal(name=f"done_in_{suffix}")
+        self.done_out = Signal(name=f"done_out_{suffix}")
+        self.load = Signal(name=f"load_{suffix}")
+
+    def elaborate(self, platform):
         m = Module()
 
-        if depth == 0:
-            m.d.comb += self.r_data.eq(self.w_data)
-        elif depth == 1:
-            m.d.sync += self.r_data.eq(self.w_data)
-        else:
-            buffer = [Signal.like(self.w_data, name=f"buf_{n}") for n in range(depth)]
-            m.d.sync += buffer[0].eq(self.w_data)
-            m.d.comb += self.r_data.eq(buffer[-1])
-            for i in range(1, depth):
-                m.d.sync += buffer[i].eq(buffer[i - 1])
+        weight = Signal(self.shape)
+        m.d.comb += [
+            weight.eq(Mux(self.done_in, self.shadow, self.weight)),
+            self.bottom_out.eq(self.shadow),
+        ]
+
+        m.d.sync += [
+            self.sum_out.eq(self.sum_in + self.left_in * weight),
+            self.right_out.eq(self.left_in),
+            self.done_out.eq(self.done_in),
+        ]
+        with m.If(self.done_in):
+            m.d.sync += self.weight.eq(self.shadow)
+        with m.If(self.load):
+            m.d.sync += self.shadow.eq(self.top_in)
 
         return m
 
+
 class SystolicMatMul(Elaboratable):
     """Matrix Multiplication using systolic arrays
 
@@ -105,20 +333,75 @@ class SystolicMatMul(Elaboratable):
 
     Uses n*n multipliers and accumulators.
 
-    TODO:
-
-    Improve utilization with better pipelining. Currently it takes 2n+1 cycles to multiply two n x n matrices.
-
-    Add support for mixed precision. Accumulate and pass signals with more bits, but muliply with fewer.
-
-    Add support for various floating point data types. bfloat16 or tf32 (19 bits) would be suitable.
+    When `pipelined` is set, the processing units have double buffered accumulators and the
+    results are shifted out on a separate chain. Matrices can then be shifted in back to back,
+    one n x n product every n cycles. `done_in` is asserted together with the first column and
+    row of the next pair of matrices, or with zeros after the last one. The results arrive
+    rows + cols + `latency` cycles after `done_in` (with `buffered`), one column per cycle and
+    the last column first. The inner dimension must not be smaller than `cols`.
+
+    Mixed precision: `shape` is the shape of the operands and `acc_shape` the shape of the
+    accumulators and results, `shape` by default. Signed shapes multiply and accumulate signed.
+
+    The multipliers map to the MULT18X18D blocks of the ECP5 sysDSP, the accumulators to logic.
+    Yosys only infers MULT18X18D, so narrower operands still use a whole one. The LFE5U-12F
+    (like the 25F) has 28 of them:
+
+        shape       acc_shape   MULT18X18D per PE   PEs on LFE5U-12F
+        signed(8)   signed(32)  1                   28, e.g. 5 x 5
+        signed(16)  signed(40)  1                   28, e.g. 5 x 5
+        signed(18)  signed(48)  1                   28, e.g. 5 x 5
+        signed(32)  signed(32)  4                   7, e.g. 2 x 2
+
+    Larger arrays spill into LUT multipliers. For n products of m-bit operands, acc_shape
+    needs 2m + log2(n) bits to never overflow.
+
+    Floating point: when `dtype` is a FloatFormat, the operands are bit patterns in that format
+    and FloatProcessingUnits are used, which needs `pipelined`. They accumulate in signed fixed
+    point with `acc_shape`, signed(64) by default, and `frac_bits` fraction bits, which saturates
+    instead of wrapping, and `right_out` is FP32, rounded to nearest even. The mantissa products of bfloat16 (8 x 8 bits)
+    and tf32 (11 x 11 bits) each take one MULT18X18D, so the table above applies, but the
+    shifters and the wide accumulators need more logic than the integer PEs.
+
+    Weight stationary: the dataflow above is output stationary, both matrices are streamed in
+    and the sums stay in the PEs. When `weight_stationary` is set, WeightStationaryUnits keep a
+    rows x cols matrix of weights W instead, and compute X @ W for a stream of rows of X, one
+    per cycle. Only `left_in` is streamed, so for a fixed right-hand matrix, like the weights
+    of a layer, half of the input bandwidth is needed. The sums flow down the columns and
+    leave on `bottom_out`, which has `acc_shape`, all columns of a row of X @ W together
+    rows + cols - 1 cycles after the row of X was on `left_in` (with `buffered`).
+
+    The weights are shifted in through `top_in` while `load` is asserted, the last row of W
+    first, which takes `rows` cycles. They are used from the row of X where `done_in` is
+    asserted, and can be loaded while the previous weights are in use, but not in the
+    rows + cols - 1 cycles after `done_in`. Not supported with `pipelined` or `dtype`.
+
+    The delays of `buffered` that are longer than `delay_threshold` cycles are circular
+    buffers in distributed RAM instead of registers, see Delay. None uses registers only.
 
     """
-    def __init__(self, rows, cols, shape, buffered=True):
+    def __init__(self, rows, cols, shape=None, buffered=True, pipelined=False, acc_shape=None,
+                 dtype=None, frac_bits=32, weight_stationary=False, delay_threshold=2):
+        if weight_stationary:
+            assert not pipelined and dtype is None, \
+                "Weight stationary is not supported with pipelined or dtype"
+        if dtype is not None:
+            assert pipelined, "Floating point needs pipelined=True"
+            shape = unsigned(dtype.width)
+            if acc_shape is None:
+                acc_shape = signed(64)
+        if acc_shape is None:
+            acc_shape = shape
         self.rows = rows
         self.cols = cols
         self.shape = shape
+        self.acc_shape = acc_shape
         self.buffered = buffered
+        self.pipelined = pipelined
+        self.dtype = dtype
+        self.frac_bits = frac_bits
+        self.weight_stationary = weight_stationary
+        self.delay_threshold = delay_threshold
 
         self.left_in = []
         self.done_in = []
@@ -126,21 +409,35 @@ class SystolicMatMul(Elaboratable):
         for n in range(rows):
             self.left_in.append(Signal(shape, name=f"matmul_left_in_{n}"))
             self.done_in.append(Signal(shape, name=f"matmul_done_in_{n}"))
-            self.right_out.append(Signal(shape, name=f"matmul_right_out_{n}"))
+            self.right_out.append(Signal(acc_shape if dtype is None else 32,
+                                         name=f"matmul_right_out_{n}"))
 
         self.top_in = []
         for n in range(cols):
             self.top_in.append(Signal(shape, name=f"matmul_top_in_{n}"))
 
+        if weight_stationary:
+            self.load = Signal(name="matmul_load")
+            self.bottom_out = []
+            for n in range(cols):
+                self.bottom_out.append(Signal(acc_shape, name=f"matmul_bottom_out_{n}"))
+
         # Create the processing units
         self.pu = []
         for r in range(rows):
             temp = []
             for c in range(cols):
-                pu = ProcessingUnit(shape, f"r{r}_c{c}")
+                if weight_stationary:
+                    pu = WeightStationaryUnit(shape, f"r{r}_c{c}", acc_shape)
+                elif dtype is None:
+                    pu = ProcessingUnit(shape, f"r{r}_c{c}", pipelined, acc_shape)
+                else:
+                    pu = FloatProcessingUnit(dtype, f"r{r}_c{c}", acc_shape, frac_bits)
                 temp.append(pu)
             self.pu.append(temp)
 
+        self.latency = self.pu[0][0].latency
+
 
     def elaborate(self, platform):
         rows = self.rows
@@ -159,42 +456,96 @@ class SystolicMatMul(Elaboratable):
                     m.d.comb += pu[r][c].left_in.eq(pu[r][c-1].right_out)
                 if r > 0:
                     m.d.comb += pu[r][c].top_in.eq(pu[r-1][c].bottom_out)
+                if self.pipelined and c > 0:
+                    m.d.comb += pu[r][c].result_in.eq(pu[r][c-1].result_out)
+                if self.weight_stationary:
+                    m.d.comb += pu[r][c].load.eq(self.load)
+                    if r > 0:
+                        m.d.comb += pu[r][c].sum_in.eq(pu[r-1][c].sum_out)
+
+        top_delay = list(range(cols))
+        col_out = []
+
+        if self.weight_stationary:
+            # The weights are shifted in all columns at once, the sums
+            # leave the bottom row skewed like the inputs
+            top_delay = [0] * cols
+            col_out = [pu[-1][c].sum_out for c in range(cols)]
+            row_out = []
+        elif self.pipelined:
+            # The results are loaded when the accumulator of the right-most PE is done
+            for r in range(rows):
+                delay_load = Delay(1, self.latency)
+                setattr(m.submodules, f"delay_load_{r}", delay_load)
+                m.d.comb += delay_load.w_data.eq(pu[r][-1].done_out)
+                for c in range(cols):
+                    m.d.comb += pu[r][c].load.eq(delay_load.r_data)
+
+            # Results are shifted out on the result chain, one cycle after the
+            # right-most PE is done instead of right after it.
+            row_out = [pu[r][-1].result_out for r in range(rows)]
+            right_delay = [rows - 1 - r for r in range(rows)]
+        else:
+            row_out = [pu[r][-1].right_out for r in range(rows)]
+            right_delay = [rows - r for r in range(rows)]
+
+        if self.dtype is not None:
+            # Convert the results to FP32 at the edge of the array
+            fixed_out = row_out
+            row_out = []
+            for r in range(rows):
+                conv = FixedToFloat(Shape.cast(self.acc_shape).width, self.frac_bits)
+                setattr(m.submodules, f"to_float_{r}", conv)
+                m.d.comb += conv.i.eq(fixed_out[r])
+                row_out.append(conv.o)
 
         if self.buffered:
             # Inputs and outputs are delayed so that rows and columns
             # can be shifted in and out one full row/column per cycle.
             for r in range(rows):
-                delay = Delay(shape, r)
+                delay = Delay(shape, r, self.delay_threshold)
                 setattr(m.submodules, f"delay_left_row_{r}", delay)
                 m.d.comb += delay.w_data.eq(self.left_in[r])
                 m.d.comb += pu[r][0].left_in.eq(delay.r_data)
 
-                delay_final = Delay(shape, r)
+                delay_final = Delay(1, r)
                 setattr(m.submodules, f"delay_final_{r}", delay_final)
                 m.d.comb += delay_final.w_data.eq(self.done_in[r])
                 m.d.comb += pu[r][0].done_in.eq(delay_final.r_data)
 
-                delay_right = Delay(shape, rows - r)
+            for r, out in enumerate(row_out):
+                delay_right = Delay(self.right_out[r].shape(), right_delay[r], self.delay_threshold)
                 setattr(m.submodules, f"delay_right_{r}", delay_right)
-                m.d.comb += delay_right.w_data.eq(pu[r][-1].right_out)
+                m.d.comb += delay_right.w_data.eq(out)
                 m.d.comb += self.right_out[r].eq(delay_right.r_data)
 
             for c in range(cols):
-                delay = Delay(shape, c)
+                delay = Delay(shape, top_delay[c], self.delay_threshold)
                 setattr(m.submodules,f"delay_top_col_{c}", delay)
                 m.d.comb += delay.w_data.eq(self.top_in[c])
                 m.d.comb += pu[0][c].top_in.eq(delay.r_data)
+
+            for c, out in enumerate(col_out):
+                delay_bottom = Delay(self.acc_shape, cols - 1 - c, self.delay_threshold)
+                setattr(m.submodules, f"delay_bottom_{c}", delay_bottom)
+                m.d.comb += delay_bottom.w_data.eq(out)
+                m.d.comb += self.bottom_out[c].eq(delay_bottom.r_data)
         else:
             # No delays. Uses fewer registers, but requires the user to
             # order the data accordingly.
             for r in range(rows):
                 m.d.comb += pu[r][0].left_in.eq(self.left_in[r])
                 m.d.comb += pu[r][0].done_in.eq(self.done_in[r])
-                m.d.comb += self.right_out[r].eq(pu[r][-1].right_out)
+
+            for r, out in enumerate(row_out):
+                m.d.comb += self.right_out[r].eq(out)
 
             for c in range(cols):
                 m.d.comb += pu[0][c].top_in.eq(self.top_in[c])
 
+            for c, out in enumerate(col_out):
+                m.d.comb += self.bottom_out[c].eq(out)
+
         return m
 
 
@@ -205,43 +556,6 @@ if importlib.util.find_spec("numpy") is not None:
 
 class MatMulTest(FHDLTestCase):
 
-    def test_delay(self):
-        # Tests the Delay() class
-
-        m = Module()
-
-        bits = 8
-        max_depth = 8
-
-        shape = unsigned(bits)
-        counter = Signal(shape)
-        delays_mem = []
-        for i in range(max_depth):
-            delays_mem.append(Delay(shape, i))
-            setattr(m.submodules, f"delay_{i}", delays_mem[-1])
-            m.d.comb += delays_mem[-1].w_data.eq(counter)
-
-        sim = Simulator(m)
-        sim.add_clock(1/10e6, domain="sync")
-
-        def process():
-            for i in range(100):
-                yield counter.eq(i)
-                yield
-                if i > max_depth:
-                    for n in range(len(delays_mem)):
-                        value_mem = (yield delays_mem[n].r_data)
-                        value_no_mem = (yield delays_mem[n].r_data)
-                        # Check that the output of the buffer is delayed correctly
-                        # print(value_mem, i, n)
-                        # print(value_no_mem, i, n)
-                        assert value_mem == i - n
-                        assert value_no_mem == i - n
-
-        sim.add_sync_process(process)
-        with sim.write_vcd("test.vcd"):
-            sim.run()
-
     def test_pe_chained(self):
         # Test multiple ProcessingUnits that are chained together horizontally.
 
@@ -317,7 +631,7 @@ class MatMulTest(FHDLTestCase):
 
         m = Module()
 
-        bits = 32
+        bits = 8
         rows = 8
         cols = 8
 
@@ -325,7 +639,7 @@ class MatMulTest(FHDLTestCase):
         counter = Signal(32)
         m.d.sync += counter.eq(counter + 1)
 
-        m.submodules.matmul = matmul = SystolicMatMul(rows, cols, shape)
+        m.submodules.matmul = matmul = SystolicMatMul(rows, cols, shape, acc_shape=unsigned(32))
 
         np.random.seed(1234)
         M = np.random.randint(1, 255, size=(rows, cols))
@@ -417,7 +731,7 @@ class MatMulTest(FHDLTestCase):
 
         m = Module()
 
-        bits = 32
+        bits = 8
         rows = 8
         cols = 8
 
@@ -425,7 +739,7 @@ class MatMulTest(FHDLTestCase):
         counter = Signal(32)
         m.d.sync += counter.eq(counter + 1)
 
-        m.submodules.matmul = matmul = SystolicMatMul(rows, cols, shape)
+        m.submodules.matmul = matmul = SystolicMatMul(rows, cols, shape, acc_shape=unsigned(32))
 
         # M = np.array([[1, 2], [3, 4]])
         # N = np.array([[5, 6], [7, 8]])
@@ -535,3 +849,313 @@ class MatMulTest(FHDLTestCase):
         sim.add_sync_process(proc_checker)
         with sim.write_vcd("test.vcd", traces=[counter]):
             sim.run()
+
+    def test_matmul_pipelined(self):
+        # Test a long stream of back to back matrix multiplications
+        m = Module()
+
+        bits = 8
+        rows = 8
+        cols = 8
+        count = 16
+
+        shape = unsigned(bits)
+        counter = Signal(32)
+        m.d.sync += counter.eq(counter + 1)
+
+        m.submodules.matmul = matmul = SystolicMatMul(rows, cols, shape, pipelined=True,
+                                                      acc_shape=unsigned(32))
+
+        np.random.seed(1234)
+        pairs = [(np.random.randint(1, 255, size=(rows, cols)),
+                  np.random.randint(1, 255, size=(rows, cols))) for _ in range(count)]
+
+        sim = Simulator(m)
+        sim.add_clock(1/10e6, domain="sync")
+
+        def proc_matmul():
+            # done_in is strobed together with the first column and row of the next pair
+            for i, (M, N) in enumerate(pairs):
+                for k in range(cols):
+                    for c in range(cols):
+                        yield matmul.top_in[c].eq(int(N[k][c].item()))
+                    for r in range(rows):
+                        yield matmul.left_in[r].eq(int(M[r][k].item()))
+                        yield matmul.done_in[r].eq(k == 0 and i > 0)
+                    yield
+
+            # Clear inputs and strobe final flags
+            for c in range(cols):
+                yield matmul.top_in[c].eq(0)
+            for r in range(rows):
+                yield matmul.left_in[r].eq(0)
+                yield matmul.done_in[r].eq(1)
+
+            yield
+
+            # Deassert final flags
+            for r in range(rows):
+                yield matmul.done_in[r].eq(0)
+
+        def proc_checker():
+            # The first results arrive rows + cols cycles after the first done_in,
+            # and are read one cycle late
+            for _ in range(cols + rows + cols + 1):
+                yield
+
+            t0 = None
+            for (M, N) in pairs:
+                # The last column arrives first
+                C = np.zeros((rows, cols), dtype=np.int64)
+                for c in range(cols - 1, -1, -1):
+                    for r in range(rows):
+                        C[r][c] = (yield matmul.right_out[r])
+                    yield
+
+                assert np.array_equal(M @ N, C)
+
+                # One product every cols cycles
+                t1 = (yield counter)
+                if t0 is not None:
+                    assert t1 - t0 == cols
+                t0 = t1
+
+        sim.add_sync_process(proc_matmul)
+        sim.add_sync_process(proc_checker)
+        with sim.write_vcd("test.vcd", traces=[counter]):
+            sim.run()
+
+    def test_matmul_signed(self):
+        # Test signed mixed precision, with and without pipelining
+        rows = 4
+        cols = 4
+
+        for shape, acc_shape in [(signed(8), signed(32)), (signed(16), signed(40))]:
+            for pipelined in [False, True]:
+                with self.subTest(shape=shape, acc_shape=acc_shape, pipelined=pipelined):
+                    self.check_signed(rows, cols, shape, acc_shape, pipelined)
+
+    def check_signed(self, rows, cols, shape, acc_shape, pipelined):
+        m = Module()
+        m.submodules.matmul = matmul = SystolicMatMul(rows, cols, shape, pipelined=pipelined,
+                                                      acc_shape=acc_shape)
+
+        # The extremes of the operand range, so that the products need all bits
+        bits = shape.width
+        np.random.seed(1234)
+        M = np.random.randint(-(1 << (bits - 1)), 1 << (bits - 1), size=(rows, cols))
+        N = np.random.randint(-(1 << (bits - 1)), 1 << (bits - 1), size=(rows, cols))
+        M[0][0] = N[0][0] = -(1 << (bits - 1))
+
+        sim = Simulator(m)
+        sim.add_clock(1/10e6, domain="sync")
+
+        def process():
+            for k in range(rows - 1, -1, -1):
+                for c in range(cols):
+                    yield matmul.top_in[c].eq(int(N[k][c].item()))
+                for r in range(rows):
+                    yield matmul.left_in[r].eq(int(M[r][k].item()))
+                yield
+
+            # Clear inputs and strobe final flags
+            for c in range(cols):
+                yield matmul.top_in[c].eq(0)
+            for r in range(rows):
+                yield matmul.left_in[r].eq(0)
+                yield matmul.done_in[r].eq(1)
+
+            yield
+
+            # Deassert final flags
+            for r in range(rows):
+                yield matmul.done_in[r].eq(0)
+
+            # Wait for the signals to propagate
+            for _ in range(rows + cols if pipelined else rows * 2):
+                yield
+
+            # Pipelined, the last column arrives first
+            C = np.zeros((rows, cols), dtype=np.int64)
+            order = range(cols - 1, -1, -1) if pipelined else range(cols)
+            for c in order:
+                for r in range(rows):
+                    C[r][c] = (yield matmul.right_out[r])
+                yield
+
+            assert np.array_equal(M @ N, C)
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("test.vcd"):
+            sim.run()
+
+    def test_matmul_float(self):
+        # Test back to back bfloat16 and tf32 matrix multiplications
+        for dtype in [FloatFormat.BFLOAT16, FloatFormat.TF32]:
+            with self.subTest(dtype=dtype):
+                self.check_float(4, 4, dtype)
+
+    def check_float(self, rows, cols, dtype):
+        from .fp import to_bits, from_bits
+
+        m = Module()
+        m.submodules.matmul = matmul = SystolicMatMul(rows, cols, pipelined=True, dtype=dtype)
+
+        # Magnitudes from 2**-6 to 2**3, so that no product is truncated, and some zeros
+        np.random.seed(1234)
+        pairs = []
+        for _ in range(3):
+            pair = []
+            for _ in range(2):
+                values = np.random.choice([-1, 1], size=(rows, cols)) * 2 ** np.random.uniform(-6, 3, size=(rows, cols))
+                values[np.random.randint(rows)][np.random.randint(cols)] = 0
+                pair.append(to_bits(values.astype(np.float32), dtype))
+            pairs.append(pair)
+
+        sim = Simulator(m)
+        sim.add_clock(1/10e6, domain="sync")
+
+        def proc_matmul():
+            for i, (M, N) in enumerate(pairs):
+                for k in range(cols):
+                    for c in range(cols):
+                        yield matmul.top_in[c].eq(int(N[k][c]))
+                    for r in range(rows):
+                        yield matmul.left_in[r].eq(int(M[r][k]))
+                        yield matmul.done_in[r].eq(k == 0 and i > 0)
+                    yield
+
+            for c in range(cols):
+                yield matmul.top_in[c].eq(0)
+            for r in range(rows):
+                yield matmul.left_in[r].eq(0)
+                yield matmul.done_in[r].eq(1)
+            yield
+            for r in range(rows):
+                yield matmul.done_in[r].eq(0)
+
+        def proc_checker():
+            for _ in range(cols + rows + cols + matmul.latency + 1):
+                yield
+
+            for (M, N) in pairs:
+                C = np.zeros((rows, cols), dtype=np.uint32)
+                for c in range(cols - 1, -1, -1):
+                    for r in range(rows):
+                        C[r][c] = (yield matmul.right_out[r])
+                    yield
+                C = from_bits(C, FloatFormat.FP32)
+
+                # The accumulation is exact, so the result is the exact sum rounded once
+                A = from_bits(M, dtype)
+                B = from_bits(N, dtype)
+                exact = (A.astype(np.float64) @ B.astype(np.float64)).astype(np.float32)
+                np.testing.assert_array_equal(C, exact)
+
+                # NumPy rounds after every step
+                np.testing.assert_array_max_ulp(C, A @ B, maxulp=4)
+
+        sim.add_sync_process(proc_matmul)
+        sim.add_sync_process(proc_checker)
+        with sim.write_vcd("test.vcd"):
+            sim.run()
+
+    def test_float_saturation(self):
+        from .fp import to_bits
+
+        fmt = FloatFormat.BFLOAT16
+        m = Module()
+        m.submodules.pe = pe = FloatProcessingUnit(fmt, "0")
+
+        # acc is signed(64) with 32 fraction bits, so magnitudes up to 2**31 fit
+        limit = 2**63 - 1
+        sets = [
+            # Products far out of range, just out of range and just in range
+            ([(2.0**40, 2.0**40)], limit),
+            ([(-2.0**40, 2.0**40)], -limit),
+            ([(2.0**20, 2.0**11)], limit),
+            ([(1.5 * 2**20, 2.0**10)], 3 * 2**61),
+            # Sums out of range, later products are added to the saturated value
+            ([(1.5 * 2**20, 2.0**10), (1.5 * 2**20, 2.0**10)], limit),
+            ([(-1.5 * 2**20, 2.0**10), (-1.5 * 2**20, 2.0**10), (2.0, 2.0)], -2**63 + 4 * 2**32),
+            ([(2.0**40, 2.0**40), (-2.0**20, 2.0**10)], limit - 2**62),
+        ]
+
+        sim = Simulator(m)
+        sim.add_clock(1/10e6, domain="sync")
+
+        def process():
+            for pairs, expected in sets:
+                for i, (a, b) in enumerate(pairs + [(0, 0)]):
+                    yield pe.top_in.eq(int(to_bits(np.array([a], dtype=np.float32), fmt)[0]))
+                    yield pe.left_in.eq(int(to_bits(np.array([b], dtype=np.float32), fmt)[0]))
+                    yield pe.done_in.eq(i == 0 or i == len(pairs))
+                    yield
+                yield pe.done_in.eq(0)
+                for _ in range(pe.latency + 2):
+                    yield
+                self.assertEqual((yield pe.result), expected, pairs)
+
+        sim.add_sync_process(process)
+        sim.run()
+
+    def test_matmul_weight_stationary(self):
+        # Stream two batches through the array back to back, the weights of the
+        # second batch are loaded while the first one is computed
+        rows = 4
+        cols = 3
+
+        m = Module()
+        m.submodules.matmul = matmul = SystolicMatMul(rows, cols, signed(8), acc_shape=signed(32),
+                                                      weight_stationary=True)
+
+        np.random.seed(1234)
+        W1 = np.random.randint(-128, 128, size=(rows, cols))
+        W2 = np.random.randint(-128, 128, size=(rows, cols))
+        X1 = np.random.randint(-128, 128, size=(10, rows))
+        X2 = np.random.randint(-128, 128, size=(5, rows))
+        expected = np.concatenate([X1 @ W1, X2 @ W2])
+
+        sim = Simulator(m)
+        sim.add_clock(1/10e6, domain="sync")
+
+        def process():
+            def load(W, i):
+                # The last row of W first
+                for c in range(cols):
+                    yield matmul.top_in[c].eq(int(W[rows - 1 - i][c]))
+                yield matmul.load.eq(1)
+
+            for i in range(rows):
+                yield from load(W1, i)
+                yield
+            yield matmul.load.eq(0)
+
+            X = np.concatenate([X1, X2])
+            latency = rows + cols - 1
+            results = []
+            for t in range(len(X) + latency):
+                for r in range(rows):
+                    yield matmul.left_in[r].eq(int(X[t][r]) if t < len(X) else 0)
+                    yield matmul.done_in[r].eq(t in (0, len(X1)))
+
+                # Load W2 once W1 has reached all PEs
+                if latency <= t < latency + rows:
+                    yield from load(W2, t - latency)
+                else:
+                    yield matmul.load.eq(0)
+
+                yield Settle()
+                if t >= latency:
+                    row = []
+                    for c in range(cols):
+                        row.append((yield matmul.bottom_out[c]))
+                    results.append(row)
+                yield
+
+            self.assertTrue(np.array_equal(np.array(results), expected),
+                            f"\n{np.array(results)}\n{expected}")
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("test.vcd"):
+            sim.run()
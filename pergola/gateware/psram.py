@@ -0,0 +1,806 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+from nmigen.utils import log2_int
+
+from enum import IntEnum
+
+from ..util.test import FHDLTestCase
+from .bus.wb import get_layout
+
+"""
+QSPI/QPI PSRAM controller for APS6404L-like parts, as found on the Pergola board.
+
+The chips are put in QPI mode during initialization. Every transfer then starts
+with a command and a 24-bit address, 4 bits per clock, followed by the data.
+Reads have a fixed number of wait cycles between the address and the data.
+
+Bursts wrap around at 1K page boundaries. Optionally the wrap boundary is set to
+32 bytes, which allows critical word first cache line fills. The APS6404L only
+supports single data rate transfers, so there is no DDR mode.
+
+Several chips can be used in parallel. They share the same command and address and
+each chip stores one byte of every data word, which multiplies the bandwidth by
+the number of chips. With two chips a 16-bit word is stored with the low byte in
+chip 0 and the high byte in chip 1, at the same chip address.
+"""
+
+
+class PSRAMCommand(IntEnum):
+    RESET_ENABLE = 0x66
+    RESET        = 0x99
+    ENTER_QPI    = 0x35
+    EXIT_QPI     = 0xF5
+    WRAP_TOGGLE  = 0xC0
+    QUAD_READ    = 0xEB
+    QUAD_WRITE   = 0x38
+
+
+def psram_layout():
+    """
+    Layout of the pins of one PSRAM chip, matches the `spi_flash_4x` resource.
+    """
+    return [
+        ("cs",  [("o", 1)]),
+        ("clk", [("o", 1)]),
+        ("dq",  [("i", 4), ("o", 4), ("oe", 1)]),
+    ]
+
+
+class PSRAMController(Elaboratable):
+    """
+    pins:       List of pin records, one per chip, see psram_layout
+
+    ready:      Initialization is done, commands are accepted
+
+    cmd_valid:  A command is available
+    cmd_ready:  The command is accepted
+    cmd_write:  1 = write, 0 = read
+    cmd_addr:   Chip address, in words
+    cmd_len:    Number of words to transfer, 1..max_burst
+
+    rd_valid:   Strobed for every word that has been read
+    rd_data:    Read word
+
+    wr_data:    Word to write. The first word must be valid when the write command
+                is issued, the next one after every wr_ready
+    wr_ready:   wr_data has been consumed
+
+    read_wait:    Number of wait clocks between the address and read data
+    read_latency: Number of cycles from the rising edge of the PSRAM clock to the
+                  cycle where the read data is sampled. 0 or 1 work with the model,
+                  1 gives more margin on hardware.
+    max_burst:    Maximum number of words in one command. The PSRAM must be
+                  deselected at least every 8us for refresh, keep
+                  max_burst * 4 cycles well below that.
+    init_delay:   Cycles to wait after power-up before the chips are initialized,
+                  150us is required by the datasheet.
+    wrap:         Wrap bursts at 32 byte boundaries instead of 1K pages
+
+    The PSRAM clock is half of the `sync` clock. One word takes two PSRAM clocks,
+    i.e. 4 cycles, and carries 8 bits per chip.
+    """
+
+    def __init__(self, pins, read_wait=6, read_latency=1, max_burst=256, init_delay=20000, wrap=False):
+        self.pins = pins
+        self.chips = len(pins)
+        self.data_width = 8 * self.chips
+
+        self.read_wait = read_wait
+        self.read_latency = read_latency
+        self.max_burst = max_burst
+        self.init_delay = init_delay
+        self.wrap = wrap
+
+        self.ready = Signal()
+
+        self.cmd_valid = Signal()
+        self.cmd_ready = Signal()
+        self.cmd_write = Signal()
+        self.cmd_addr = Signal(24)
+        self.cmd_len = Signal(range(max_burst + 1))
+
+        self.rd_valid = Signal()
+        self.rd_data = Signal(self.data_width)
+
+        self.wr_data = Signal(self.data_width)
+        self.wr_ready = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pins = self.pins
+        chips = self.chips
+
+        cs = Signal()
+        clk = Signal()
+        dq_o = [Signal(4, name=f"dq_o{k}") for k in range(chips)]
+        dq_oe = Signal()
+        for k in range(chips):
+            m.d.comb += [
+                pins[k].cs.o.eq(cs),
+                pins[k].clk.o.eq(clk),
+                pins[k].dq.o.eq(dq_o[k]),
+                pins[k].dq.oe.eq(dq_oe),
+            ]
+
+        # Every PSRAM clock is two cycles: data is updated with the clock low in
+        # the first half and sampled by the chip on the rising edge.
+        half = Signal()
+
+        # Command and address, shifted out from the top
+        cmd_sr = Signal(32)
+        # Number of clocks left in the current phase
+        ctr = Signal(range(max(2 * self.max_burst, self.init_delay, 32) + 1))
+        write = Signal()
+        length = Signal.like(self.cmd_len)
+
+        init_cmds = [PSRAMCommand.RESET_ENABLE, PSRAMCommand.RESET]
+        if self.wrap:
+            init_cmds.append(PSRAMCommand.WRAP_TOGGLE)
+        init_cmds.append(PSRAMCommand.ENTER_QPI)
+        init_idx = Signal(range(len(init_cmds)))
+        init_cmd = Array(Const(c, 8) for c in init_cmds)[init_idx]
+
+        # Even clocks of a data word carry the high nibble of each chip's byte
+        nibble = Signal()
+
+        wr_nibbles = [Mux(nibble, self.wr_data[8 * k:8 * k + 4], self.wr_data[8 * k + 4:8 * k + 8])
+                      for k in range(chips)]
+
+        # Read data is sampled `read_latency` cycles after the rising edge
+        sample = Signal()
+        sample_d = Signal(self.read_latency + 1)
+        m.d.sync += sample_d.eq(Cat(sample, sample_d))
+
+        rd_sr = [Signal(8, name=f"rd_sr{k}") for k in range(chips)]
+        rd_nibble = Signal()
+        rd_done = Signal()
+        m.d.sync += rd_done.eq(0)
+        with m.If(sample_d[self.read_latency]):
+            for k in range(chips):
+                m.d.sync += rd_sr[k].eq(Cat(pins[k].dq.i, rd_sr[k][:4]))
+            m.d.sync += [
+                rd_nibble.eq(~rd_nibble),
+                rd_done.eq(rd_nibble),
+            ]
+        m.d.comb += [
+            self.rd_valid.eq(rd_done),
+            self.rd_data.eq(Cat(*rd_sr)),
+        ]
+
+        with m.FSM(name="psram"):
+            with m.State("POWER_UP"):
+                m.d.sync += ctr.eq(ctr + 1)
+                with m.If(ctr == self.init_delay):
+                    m.next = "SPI_LOAD"
+
+            with m.State("SPI_LOAD"):
+                m.d.sync += [
+                    ctr.eq(0),
+                    half.eq(0),
+                    cmd_sr.eq(init_cmd << 24),
+                ]
+                m.next = "SPI_CMD"
+
+            with m.State("SPI_CMD"):
+                # Initialization commands are sent in SPI mode, one bit per clock on dq0.
+                # wp_n and hold_n are kept high.
+                m.d.sync += half.eq(~half)
+                with m.If(~half):
+                    m.d.sync += [
+                        cs.eq(1),
+                        clk.eq(0),
+                        dq_oe.eq(1),
+                        cmd_sr.eq(cmd_sr << 1),
+                    ]
+                    m.d.sync += [dq_o[k].eq(Cat(cmd_sr[31], 0, 1, 1)) for k in range(chips)]
+                with m.Else():
+                    m.d.sync += [
+                        clk.eq(1),
+                        ctr.eq(ctr + 1),
+                    ]
+                    with m.If(ctr == 7):
+                        m.next = "SPI_DESELECT"
+
+            with m.State("SPI_DESELECT"):
+                m.d.sync += [
+                    cs.eq(0),
+                    clk.eq(0),
+                    init_idx.eq(init_idx + 1),
+                ]
+                with m.If(init_idx == len(init_cmds) - 1):
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "SPI_LOAD"
+
+            with m.State("IDLE"):
+                m.d.comb += [
+                    self.ready.eq(1),
+                    self.cmd_ready.eq(1),
+                ]
+                m.d.sync += [
+                    cs.eq(0),
+                    clk.eq(0),
+                    dq_oe.eq(0),
+                    half.eq(0),
+                    rd_nibble.eq(0),
+                ]
+                with m.If(self.cmd_valid):
+                    m.d.sync += [
+                        write.eq(self.cmd_write),
+                        cmd_sr.eq(Cat(self.cmd_addr,
+                            Mux(self.cmd_write, PSRAMCommand.QUAD_WRITE, PSRAMCommand.QUAD_READ))),
+                        ctr.eq(7),
+                        length.eq(self.cmd_len),
+                    ]
+                    m.next = "COMMAND"
+
+            with m.State("COMMAND"):
+                m.d.sync += half.eq(~half)
+                with m.If(~half):
+                    m.d.sync += [
+                        cs.eq(1),
+                        clk.eq(0),
+                        dq_oe.eq(1),
+                        cmd_sr.eq(cmd_sr << 4),
+                    ]
+                    m.d.sync += [dq_o[k].eq(cmd_sr[28:]) for k in range(chips)]
+                with m.Else():
+                    m.d.sync += [
+                        clk.eq(1),
+                        ctr.eq(ctr - 1),
+                    ]
+                    with m.If(ctr == 0):
+                        m.d.sync += nibble.eq(0)
+                        with m.If(write):
+                            m.d.sync += ctr.eq(2 * length - 1)
+                            m.next = "WRITE"
+                        with m.Else():
+                            m.d.sync += ctr.eq(self.read_wait - 1)
+                            m.next = "WAIT"
+
+            with m.State("WAIT"):
+                m.d.sync += half.eq(~half)
+                with m.If(~half):
+                    m.d.sync += [
+                        clk.eq(0),
+                        dq_oe.eq(0),
+                    ]
+                with m.Else():
+                    m.d.sync += [
+                        clk.eq(1),
+                        ctr.eq(ctr - 1),
+                    ]
+                    with m.If(ctr == 0):
+                        m.d.sync += ctr.eq(2 * length - 1)
+                        m.next = "READ"
+
+            with m.State("READ"):
+                m.d.sync += half.eq(~half)
+                with m.If(~half):
+                    m.d.sync += clk.eq(0)
+                with m.Else():
+                    m.d.sync += [
+                        clk.eq(1),
+                        ctr.eq(ctr - 1),
+                    ]
+                    m.d.comb += sample.eq(1)
+                    with m.If(ctr == 0):
+                        m.next = "DESELECT"
+
+            with m.State("WRITE"):
+                m.d.sync += half.eq(~half)
+                with m.If(~half):
+                    m.d.sync += [
+                        clk.eq(0),
+                        nibble.eq(~nibble),
+                    ]
+                    m.d.sync += [dq_o[k].eq(wr_nibbles[k]) for k in range(chips)]
+                    m.d.comb += self.wr_ready.eq(nibble)
+                with m.Else():
+                    m.d.sync += [
+                        clk.eq(1),
+                        ctr.eq(ctr - 1),
+                    ]
+                    with m.If(ctr == 0):
+                        m.next = "DESELECT"
+
+            with m.State("DESELECT"):
+                # Keep the chip deselected until the last read data has been sampled
+                m.d.sync += [
+                    cs.eq(0),
+                    clk.eq(0),
+                    dq_oe.eq(0),
+                ]
+                with m.If(~sample_d.any()):
+                    m.next = "IDLE"
+
+        return m
+
+
+class PSRAMWishbone(Elaboratable):
+    """
+    Wishbone slave in front of a PSRAMController.
+
+    Reads are served from a line buffer of `line_words` PSRAM words. A miss fills
+    the whole line with a single burst and acks as soon as the requested word has
+    arrived. If the controller wraps at 32 byte boundaries, the fill starts at the
+    requested word (critical word first), otherwise at the start of the line.
+
+    Writes go straight to the PSRAM and update the line buffer on a hit. Full words
+    are written in a single burst, partial writes (sel) one PSRAM word at a time.
+
+    bus:        Wishbone bus, 32-bit data, byte addresses, sel per PSRAM word.
+                Only the address bits that fit in the PSRAM are decoded.
+
+    psram:      PSRAMController, must not be used by anything else
+    line_words: Size of the line buffer in PSRAM words, forced to 32 when the
+                controller wraps at 32 bytes
+    """
+
+    def __init__(self, psram, line_words=32):
+        assert(32 % psram.data_width == 0)
+
+        self.psram = psram
+        self.line_words = 32 if psram.wrap else line_words
+        assert(self.line_words & (self.line_words - 1) == 0)
+        assert(self.line_words <= psram.max_burst)
+
+        self.bus = Record(get_layout(granularity=psram.data_width))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        bus = self.bus
+        psram = self.psram
+        dw = psram.data_width
+        line_words = self.line_words
+        # PSRAM words per bus word
+        wpw = 32 // dw
+
+        offset_bits = log2_int(line_words)
+
+        # Line buffer, one bus word per entry
+        line = Memory(width=32, depth=line_words // wpw)
+        m.submodules.line_rd = line_rd = line.read_port(transparent=False)
+        m.submodules.line_wr = line_wr = line.write_port(granularity=dw)
+
+        line_tag = Signal(24 - offset_bits)
+        line_valid = Signal()
+
+        # Address of the first PSRAM word of the bus word
+        addr = Signal(24)
+        m.d.comb += addr.eq(bus.adr[2:] * wpw)
+        tag = addr[offset_bits:]
+        offset = addr[:offset_bits]
+        hit = Signal()
+        m.d.comb += hit.eq(line_valid & (line_tag == tag))
+
+        m.d.comb += line_rd.addr.eq(offset // wpw)
+
+        # Read fill
+        fill_idx = Signal(offset_bits)
+        dat_r = Signal(32)
+        dat_r_count = Signal(range(wpw + 1))
+
+        # Write
+        word_idx = Signal(range(wpw))
+        m.d.comb += psram.wr_data.eq(bus.dat_w.word_select(word_idx, dw))
+
+        m.d.sync += bus.ack.eq(0)
+
+        with m.FSM(name="psram_wb"):
+            with m.State("IDLE"):
+                with m.If(bus.cyc & bus.stb & ~bus.ack):
+                    with m.If(bus.we):
+                        with m.If(hit):
+                            m.d.comb += [
+                                line_wr.addr.eq(offset // wpw),
+                                line_wr.data.eq(bus.dat_w),
+                                line_wr.en.eq(bus.sel),
+                            ]
+                        m.d.sync += word_idx.eq(0)
+                        with m.If(bus.sel.all()):
+                            m.next = "WRITE_BURST"
+                        with m.Else():
+                            m.next = "WRITE_PARTIAL"
+                    with m.Elif(hit):
+                        m.next = "READ_HIT"
+                    with m.Else():
+                        m.d.sync += [
+                            line_valid.eq(0),
+                            line_tag.eq(tag),
+                            dat_r_count.eq(0),
+                        ]
+                        m.next = "FILL"
+
+            with m.State("READ_HIT"):
+                m.d.sync += [
+                    bus.dat_r.eq(line_rd.data),
+                    bus.ack.eq(1),
+                ]
+                m.next = "IDLE"
+
+            with m.State("FILL"):
+                start = offset if psram.wrap else Const(0, offset_bits)
+                m.d.comb += [
+                    psram.cmd_valid.eq(1),
+                    psram.cmd_write.eq(0),
+                    psram.cmd_addr.eq(Cat(start, tag)),
+                    psram.cmd_len.eq(line_words),
+                ]
+                with m.If(psram.cmd_ready):
+                    m.d.sync += fill_idx.eq(start)
+                    m.next = "FILL_DATA"
+
+            with m.State("FILL_DATA"):
+                with m.If(psram.rd_valid):
+                    m.d.comb += [
+                        line_wr.addr.eq(fill_idx // wpw),
+                        line_wr.data.eq(Repl(psram.rd_data, wpw)),
+                        line_wr.en.eq(1 << (fill_idx % wpw)),
+                    ]
+                    m.d.sync += fill_idx.eq(fill_idx + 1)
+
+                    # Collect the requested bus word on the way
+                    with m.If((tag == line_tag) & (fill_idx // wpw == offset // wpw)):
+                        m.d.sync += [
+                            dat_r.word_select(fill_idx % wpw, dw).eq(psram.rd_data),
+                            dat_r_count.eq(dat_r_count + 1),
+                        ]
+
+                with m.If((dat_r_count == wpw) & bus.cyc & bus.stb & ~bus.we & ~bus.ack):
+                    m.d.sync += [
+                        bus.dat_r.eq(dat_r),
+                        bus.ack.eq(1),
+                        dat_r_count.eq(0),
+                    ]
+
+                # The controller is ready again once the whole line has been read
+                with m.If(psram.cmd_ready):
+                    m.d.sync += line_valid.eq(1)
+                    m.next = "IDLE"
+
+            with m.State("WRITE_BURST"):
+                m.d.comb += [
+                    psram.cmd_valid.eq(1),
+                    psram.cmd_write.eq(1),
+                    psram.cmd_addr.eq(addr),
+                    psram.cmd_len.eq(wpw),
+                ]
+                with m.If(psram.cmd_ready):
+                    m.next = "WRITE_DATA"
+
+            with m.State("WRITE_DATA"):
+                with m.If(psram.wr_ready):
+                    m.d.sync += word_idx.eq(word_idx + 1)
+                with m.If(psram.cmd_ready):
+                    m.d.sync += bus.ack.eq(1)
+                    m.next = "IDLE"
+
+            with m.State("WRITE_PARTIAL"):
+                with m.If(bus.sel.bit_select(word_idx, 1)):
+                    m.d.comb += [
+                        psram.cmd_valid.eq(1),
+                        psram.cmd_write.eq(1),
+                        psram.cmd_addr.eq(addr + word_idx),
+                        psram.cmd_len.eq(1),
+                    ]
+                    with m.If(psram.cmd_ready):
+                        m.next = "WRITE_PARTIAL_WAIT"
+                with m.Elif(word_idx == wpw - 1):
+                    m.next = "WRITE_PARTIAL_DONE"
+                with m.Else():
+                    m.d.sync += word_idx.eq(word_idx + 1)
+
+            with m.State("WRITE_PARTIAL_WAIT"):
+                with m.If(psram.cmd_ready):
+                    with m.If(word_idx == wpw - 1):
+                        m.d.sync += bus.ack.eq(1)
+                        m.next = "IDLE"
+                    with m.Else():
+                        m.d.sync += word_idx.eq(word_idx + 1)
+                        m.next = "WRITE_PARTIAL"
+
+            with m.State("WRITE_PARTIAL_DONE"):
+                with m.If(psram.cmd_ready):
+                    m.d.sync += bus.ack.eq(1)
+                    m.next = "IDLE"
+
+        return m
+
+
+class PSRAMModel(Elaboratable):
+    """
+    Behavioural model of a PSRAM chip for simulation, in the `sync` domain of the
+    controller. Supports the reset, wrap toggle and QPI entry commands in SPI mode,
+    and quad read/write in QPI mode. Bursts wrap at 1K or 32 bytes like the real part.
+
+    pins:      Pin record, see psram_layout
+    size:      Size in bytes, power of 2
+    init:      Initial memory contents
+    read_wait: Number of wait clocks for reads
+    """
+
+    def __init__(self, pins, size=1024, init=None, read_wait=6):
+        assert(size & (size - 1) == 0)
+
+        self.pins = pins
+        self.size = size
+        self.read_wait = read_wait
+
+        self.mem = Memory(width=8, depth=size, init=init)
+        self.qpi = Signal()
+        self.wrap32 = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        pins = self.pins
+
+        m.submodules.rd = rd = self.mem.read_port(domain="comb")
+        m.submodules.wr = wr = self.mem.write_port()
+
+        clk_r = Signal()
+        m.d.sync += clk_r.eq(pins.clk.o)
+        rising = pins.cs.o & pins.clk.o & ~clk_r
+        falling = pins.cs.o & ~pins.clk.o & clk_r
+
+        # Number of clocks since the chip was selected
+        clocks = Signal(16)
+        cmd = Signal(8)
+        addr = Signal(range(self.size))
+        high = Signal(4)
+        data_start = 8 + self.read_wait
+
+        m.d.comb += rd.addr.eq(addr)
+
+        addr_next = Signal.like(addr)
+        page_bits = min(10, len(addr))
+        with m.If(self.wrap32):
+            m.d.comb += addr_next.eq(Cat((addr + 1)[:5], addr[5:]))
+        with m.Else():
+            m.d.comb += addr_next.eq(Cat((addr + 1)[:page_bits], addr[page_bits:]))
+
+        with m.If(~pins.cs.o):
+            m.d.sync += clocks.eq(0)
+
+        with m.If(rising):
+            m.d.sync += clocks.eq(clocks + 1)
+
+            with m.If(~self.qpi):
+                with m.If(clocks < 8):
+                    m.d.sync += cmd.eq(Cat(pins.dq.o[0], cmd))
+                with m.If(clocks == 7):
+                    with m.Switch(Cat(pins.dq.o[0], cmd)[:8]):
+                        with m.Case(PSRAMCommand.ENTER_QPI):
+                            m.d.sync += self.qpi.eq(1)
+                        with m.Case(PSRAMCommand.RESET):
+                            m.d.sync += self.wrap32.eq(0)
+                        with m.Case(PSRAMCommand.WRAP_TOGGLE):
+                            m.d.sync += self.wrap32.eq(~self.wrap32)
+            with m.Else():
+                with m.If(clocks < 2):
+                    m.d.sync += cmd.eq(Cat(pins.dq.o, cmd))
+                with m.Elif(clocks < 8):
+                    m.d.sync += addr.eq(Cat(pins.dq.o, addr))
+                with m.If(clocks == 1):
+                    with m.Switch(Cat(pins.dq.o, cmd)[:8]):
+                        with m.Case(PSRAMCommand.EXIT_QPI):
+                            m.d.sync += self.qpi.eq(0)
+                        with m.Case(PSRAMCommand.WRAP_TOGGLE):
+                            m.d.sync += self.wrap32.eq(~self.wrap32)
+                with m.If((cmd == PSRAMCommand.QUAD_WRITE) & (clocks >= 8)):
+                    with m.If(~clocks[0]):
+                        m.d.sync += high.eq(pins.dq.o)
+                    with m.Else():
+                        m.d.comb += [
+                            wr.addr.eq(addr),
+                            wr.data.eq(Cat(pins.dq.o, high)),
+                            wr.en.eq(1),
+                        ]
+                        m.d.sync += addr.eq(addr_next)
+                with m.If((cmd == PSRAMCommand.QUAD_READ) & (clocks >= data_start) & clocks[0]):
+                    m.d.sync += addr.eq(addr_next)
+
+        # Read data is driven after the falling edge
+        with m.If(falling & self.qpi & (cmd == PSRAMCommand.QUAD_READ) & (clocks >= data_start)):
+            m.d.sync += pins.dq.i.eq(Mux(clocks[0], rd.data[:4], rd.data[4:]))
+
+        return m
+
+
+class PSRAMControllerTest(FHDLTestCase):
+
+    def _run(self, chips, read_latency):
+        import random
+
+        random.seed(chips * 10 + read_latency)
+
+        m = Module()
+
+        pins = [Record(psram_layout(), name=f"psram{k}") for k in range(chips)]
+        m.submodules.psram = psram = PSRAMController(
+            pins, read_latency=read_latency, max_burst=16, init_delay=10)
+        models = []
+        for k in range(chips):
+            model = PSRAMModel(pins[k], size=256)
+            setattr(m.submodules, f"model{k}", model)
+            models.append(model)
+
+        mask = (1 << psram.data_width) - 1
+        words = {}
+        bursts = [(0, 4), (10, 16), (40, 1), (4, 8)]
+
+        sim = Simulator(m)
+        sim.add_clock(1/100e6, domain="sync")
+
+        def process():
+            while not (yield psram.ready):
+                yield
+
+            for k in range(chips):
+                self.assertEqual((yield models[k].qpi), 1)
+
+            # Write all bursts
+            for addr, length in bursts:
+                data = [random.randrange(mask + 1) for _ in range(length)]
+                for i, d in enumerate(data):
+                    words[addr + i] = d
+
+                yield psram.cmd_valid.eq(1)
+                yield psram.cmd_write.eq(1)
+                yield psram.cmd_addr.eq(addr)
+                yield psram.cmd_len.eq(length)
+                yield psram.wr_data.eq(data[0])
+                yield
+                yield psram.cmd_valid.eq(0)
+                i = 0
+                while i < length:
+                    if (yield psram.wr_ready):
+                        i += 1
+                        if i < length:
+                            yield psram.wr_data.eq(data[i])
+                    yield
+                while not (yield psram.cmd_ready):
+                    yield
+
+            # The model stores the low byte of each word in chip 0
+            for addr, d in words.items():
+                for k in range(chips):
+                    self.assertEqual((yield models[k].mem[addr]), (d >> (8 * k)) & 0xff)
+
+            # Read everything back
+            for addr, length in bursts:
+                yield psram.cmd_valid.eq(1)
+                yield psram.cmd_write.eq(0)
+                yield psram.cmd_addr.eq(addr)
+                yield psram.cmd_len.eq(length)
+                yield
+                yield psram.cmd_valid.eq(0)
+                data = []
+                while len(data) < length:
+                    if (yield psram.rd_valid):
+                        data.append((yield psram.rd_data))
+                    yield
+                self.assertEqual(data, [words[addr + i] for i in range(length)])
+                while not (yield psram.cmd_ready):
+                    yield
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("psram.vcd"):
+            sim.run()
+
+    def test_single_chip(self):
+        self._run(chips=1, read_latency=0)
+        self._run(chips=1, read_latency=1)
+
+    def test_dual_chip(self):
+        self._run(chips=2, read_latency=1)
+
+
+class PSRAMWishboneTest(FHDLTestCase):
+
+    def _run(self, chips, wrap):
+        """
+        Returns the number of bytes per cycle for sequential writes and reads.
+        """
+        import random
+
+        random.seed(chips * 2 + wrap)
+
+        m = Module()
+
+        pins = [Record(psram_layout(), name=f"psram{k}") for k in range(chips)]
+        m.submodules.psram = psram = PSRAMController(pins, max_burst=32, init_delay=10, wrap=wrap)
+        for k in range(chips):
+            setattr(m.submodules, f"model{k}", PSRAMModel(pins[k], size=1024))
+        m.submodules.wb = wb = PSRAMWishbone(psram)
+        bus = wb.bus
+
+        wpw = 32 // psram.data_width
+        sel_all = (1 << wpw) - 1
+        cycles = [0]
+        result = {}
+
+        sim = Simulator(m)
+        sim.add_clock(1/100e6, domain="sync")
+
+        def access(adr, we=0, dat_w=0, sel=sel_all):
+            # Classic Wishbone cycle with one idle cycle in between, like BusController
+            yield bus.adr.eq(adr)
+            yield bus.we.eq(we)
+            yield bus.dat_w.eq(dat_w)
+            yield bus.sel.eq(sel)
+            yield bus.cyc.eq(1)
+            yield bus.stb.eq(1)
+            yield
+            cycles[0] += 1
+            while not (yield bus.ack):
+                yield
+                cycles[0] += 1
+            data = (yield bus.dat_r)
+            yield bus.cyc.eq(0)
+            yield bus.stb.eq(0)
+            yield
+            cycles[0] += 1
+            return data
+
+        def process():
+            while not (yield psram.ready):
+                yield
+
+            n = 128
+            ref = [random.randrange(1 << 32) for _ in range(n)]
+
+            # Sequential writes
+            cycles[0] = 0
+            for i in range(n):
+                yield from access(4 * i, we=1, dat_w=ref[i])
+            result["write"] = 4 * n / cycles[0]
+
+            # Partial writes only touch the selected PSRAM words
+            mask = (1 << psram.data_width) - 1
+            for i in range(0, n, 7):
+                sel = random.randrange(1 << wpw)
+                value = random.randrange(1 << 32)
+                yield from access(4 * i, we=1, dat_w=value, sel=sel)
+                for w in range(wpw):
+                    if sel & (1 << w):
+                        shift = w * psram.data_width
+                        ref[i] = (ref[i] & ~(mask << shift)) | (value & (mask << shift))
+
+            # Random reads, misses and hits
+            for _ in range(64):
+                i = random.randrange(n)
+                self.assertEqual((yield from access(4 * i)), ref[i], i)
+
+            # Write to a cached line
+            i = random.randrange(n)
+            yield from access(4 * i)
+            ref[i] = random.randrange(1 << 32)
+            yield from access(4 * i, we=1, dat_w=ref[i])
+            self.assertEqual((yield from access(4 * i)), ref[i])
+
+            # Sequential reads
+            cycles[0] = 0
+            for i in range(n):
+                self.assertEqual((yield from access(4 * i)), ref[i], i)
+            result["read"] = 4 * n / cycles[0]
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("psram_wb.vcd"):
+            sim.run()
+
+        return result
+
+    def test_throughput(self):
+        single = self._run(chips=1, wrap=False)
+        dual = self._run(chips=2, wrap=False)
+        dual_wrap = self._run(chips=2, wrap=True)
+
+        # Both chips in parallel double the bandwidth of line fills
+        self.assertGreater(dual["read"], 1.8 * single["read"])
+        self.assertGreater(dual["write"], 1.2 * single["write"])
+        # Critical word first doesn't cost anything for sequential reads
+        self.assertGreaterEqual(dual_wrap["read"], 0.95 * dual["read"])
@@ -0,0 +1,404 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+from nmigen.utils import bits_for
+
+from ..util.test import FHDLTestCase
+
+
+class Scaler(Elaboratable):
+    """
+    Streaming video scaler with a ring of line buffers in block RAM.
+
+    The input side stores the active pixels of the last `lines` input lines. The
+    output side computes the source position of every output pixel with a DDA in
+    16.16 fixed point, src = dst * in_size / out_size, and either picks the pixel
+    at floor(src) (nearest) or interpolates between the four surrounding pixels with
+    8-bit weights (bilinear). Every pixel is stored once. In bilinear mode a line
+    buffer is split into a memory for the even and one for the odd pixels, so that
+    a pixel and its right neighbour are read in the same cycle. A 1920 pixel line
+    takes 3 DP16KD in nearest mode (2048x9) and 4 in bilinear mode (2x 1024x18).
+
+    The output timing has to run at the input frame rate and be locked to it, such
+    that the input lines an output line needs are in the buffers while it is
+    displayed, e.g. by starting the output frame a few input lines after the input
+    frame. With lines=4 there are two lines of slack for a 2:1 downscale.
+
+    in_width, in_height:    Input active size
+    out_width, out_height:  Output active size
+    bilinear:               Bilinear interpolation instead of nearest neighbour
+    lines:                  Number of line buffers, power of two
+
+    in_de:          Input data enable
+    in_frame_start: Strobe on the first input pixel of a frame, e.g. from
+                    VGATimingAnalyzer
+    in_r/g/b:       Input pixel
+    out_x, out_y:   Position of the output pixel, e.g. h_ctr/v_ctr from
+                    VGAOutputSubtarget in out_domain
+    out_r/g/b:      Output pixel, `latency` cycles after out_x/out_y
+    """
+
+    latency = 4
+
+    def __init__(self, in_width, in_height, out_width, out_height, bilinear=True, lines=4,
+                 in_domain="sync", out_domain="sync"):
+        assert(lines & (lines - 1) == 0)
+
+        self.in_width = in_width
+        self.in_height = in_height
+        self.out_width = out_width
+        self.out_height = out_height
+        self.bilinear = bilinear
+        self.lines = lines
+        self.in_domain = in_domain
+        self.out_domain = out_domain
+
+        self.step_x = (in_width << 16) // out_width
+        self.step_y = (in_height << 16) // out_height
+
+        self.in_de = Signal()
+        self.in_frame_start = Signal()
+        self.in_r = Signal(8)
+        self.in_g = Signal(8)
+        self.in_b = Signal(8)
+
+        self.out_x = Signal(12)
+        self.out_y = Signal(12)
+        self.out_r = Signal(8)
+        self.out_g = Signal(8)
+        self.out_b = Signal(8)
+
+        # Even and odd pixels of every line in bilinear mode, all pixels otherwise
+        if bilinear:
+            self.buffers = [(Memory(width=24, depth=in_width // 2 + 1),
+                             Memory(width=24, depth=(in_width + 1) // 2)) for _ in range(lines)]
+        else:
+            self.buffers = [(Memory(width=24, depth=in_width),) for _ in range(lines)]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        slot_bits = bits_for(self.lines - 1) if self.lines > 1 else 0
+
+        # Input side
+        i_d = m.d[self.in_domain]
+
+        in_x = Signal(range(self.in_width + 1))
+        in_y = Signal(12)
+        in_y_eff = Signal(12)
+        in_de_r = Signal()
+        pixel = Signal(24)
+
+        m.d.comb += [
+            pixel.eq(Cat(self.in_r, self.in_g, self.in_b)),
+            in_y_eff.eq(Mux(self.in_frame_start, 0, in_y)),
+        ]
+        i_d += in_de_r.eq(self.in_de)
+
+        with m.If(self.in_de):
+            i_d += [
+                in_x.eq(in_x + 1),
+                in_y.eq(in_y_eff),
+            ]
+        with m.Elif(in_de_r):
+            i_d += [
+                in_x.eq(0),
+                in_y.eq(in_y + 1),
+            ]
+
+        slot = Signal(max(slot_bits, 1))
+        m.d.comb += slot.eq(in_y_eff[:slot_bits] if slot_bits else 0)
+        for i, banks in enumerate(self.buffers):
+            for j, buf in enumerate(banks):
+                m.submodules[f"buf{i}_{j}_wr"] = wr = buf.write_port(domain=self.in_domain)
+                m.d.comb += [
+                    wr.addr.eq(in_x[1:] if self.bilinear else in_x),
+                    wr.data.eq(pixel),
+                    wr.en.eq(self.in_de & (slot == i) & (in_x[0] == j if self.bilinear else 1)),
+                ]
+
+        # Output side
+        o_d = m.d[self.out_domain]
+
+        # Stage 1: Source position
+        src_x = Signal(28)
+        src_y = Signal(28)
+        with m.If(self.out_x == 0):
+            o_d += src_x.eq(0)
+            with m.If(self.out_y == 0):
+                o_d += src_y.eq(0)
+            with m.Else():
+                o_d += src_y.eq(src_y + self.step_y)
+        with m.Else():
+            o_d += src_x.eq(src_x + self.step_x)
+
+        # Stage 2: Read both lines
+        x0 = Signal(12)
+        y0 = Signal(12)
+        y1 = Signal(12)
+        m.d.comb += [
+            x0.eq(src_x[16:]),
+            y0.eq(src_y[16:]),
+            y1.eq(Mux(y0 == self.in_height - 1, y0, y0 + 1)),
+        ]
+
+        fx = Signal(8)
+        fy = Signal(8)
+        slot0 = Signal(max(slot_bits, 1))
+        slot1 = Signal(max(slot_bits, 1))
+        o_d += [
+            fx.eq(src_x[8:16]),
+            fy.eq(src_y[8:16]),
+            slot0.eq(y0[:slot_bits] if slot_bits else 0),
+            slot1.eq(y1[:slot_bits] if slot_bits else 0),
+        ]
+
+        # Bank j of every line, the even bank is read at the pixel right of x0 when x0
+        # is odd. The right neighbour of the last pixel is the last pixel.
+        data = [Array(Signal(24, name=f"buf{i}_{j}_data") for i in range(self.lines))
+                for j in range(len(self.buffers[0]))]
+        for i, banks in enumerate(self.buffers):
+            for j, buf in enumerate(banks):
+                m.submodules[f"buf{i}_{j}_rd"] = rd = buf.read_port(domain=self.out_domain)
+                if not self.bilinear:
+                    addr = x0
+                elif j == 0:
+                    addr = (x0 + 1)[1:]
+                else:
+                    addr = x0[1:]
+                m.d.comb += [
+                    rd.addr.eq(addr),
+                    data[j][i].eq(rd.data),
+                ]
+
+        x_odd = Signal()
+        x_last = Signal()
+        o_d += [
+            x_odd.eq(x0[0]),
+            x_last.eq(x0 == self.in_width - 1),
+        ]
+
+        def pixels(slot):
+            if not self.bilinear:
+                return data[0][slot]
+            left = Mux(x_odd, data[1][slot], data[0][slot])
+            right = Mux(x_odd, data[0][slot], data[1][slot])
+            return Cat(left, Mux(x_last, left, right))
+
+        def lerp(a, b, f, name):
+            diff = Signal(signed(9), name=f"{name}_diff")
+            m.d.comb += diff.eq(b - a)
+            return a + ((diff * f) >> 8)
+
+        p0 = pixels(slot0)
+        p1 = pixels(slot1)
+
+        if self.bilinear:
+            # Stage 3: Horizontal interpolation
+            h0 = Signal(24)
+            h1 = Signal(24)
+            fy_r = Signal(8)
+            o_d += fy_r.eq(fy)
+            for c in range(3):
+                o_d += [
+                    h0[8 * c:8 * c + 8].eq(lerp(p0[8 * c:8 * c + 8], p0[24 + 8 * c:32 + 8 * c], fx, f"h0_{c}")),
+                    h1[8 * c:8 * c + 8].eq(lerp(p1[8 * c:8 * c + 8], p1[24 + 8 * c:32 + 8 * c], fx, f"h1_{c}")),
+                ]
+
+            # Stage 4: Vertical interpolation
+            out = Signal(24)
+            for c in range(3):
+                o_d += out[8 * c:8 * c + 8].eq(lerp(h0[8 * c:8 * c + 8], h1[8 * c:8 * c + 8], fy_r, f"v_{c}"))
+        else:
+            p0_r = Signal(24)
+            out = Signal(24)
+            o_d += [
+                p0_r.eq(p0[:24]),
+                out.eq(p0_r),
+            ]
+
+        m.d.comb += Cat(self.out_r, self.out_g, self.out_b).eq(out)
+
+        return m
+
+
+# Only used for testing
+import importlib
+if importlib.util.find_spec("numpy") is not None:
+    import numpy as np
+
+class ScalerTest(FHDLTestCase):
+
+    def reference(self, image, out_width, out_height, bilinear):
+        """
+        NumPy model of the scaler, with the same fixed point arithmetic
+        """
+        in_height, in_width, _ = image.shape
+        step_x = (in_width << 16) // out_width
+        step_y = (in_height << 16) // out_height
+
+        src_x = np.arange(out_width, dtype=np.int64) * step_x
+        src_y = np.arange(out_height, dtype=np.int64) * step_y
+        x0 = src_x >> 16
+        y0 = src_y >> 16
+        x1 = np.minimum(x0 + 1, in_width - 1)
+        y1 = np.minimum(y0 + 1, in_height - 1)
+        fx = ((src_x >> 8) & 0xff)[None, :, None]
+        fy = ((src_y >> 8) & 0xff)[:, None, None]
+
+        img = image.astype(np.int64)
+        p00 = img[y0[:, None], x0[None, :]]
+        if not bilinear:
+            return p00
+
+        def lerp(a, b, f):
+            return a + (((b - a) * f) >> 8)
+
+        h0 = lerp(p00, img[y0[:, None], x1[None, :]], fx)
+        h1 = lerp(img[y1[:, None], x0[None, :]], img[y1[:, None], x1[None, :]], fx)
+        return lerp(h0, h1, fy)
+
+    def _run(self, in_size, out_size, bilinear):
+        if importlib.util.find_spec("numpy") is None:
+            self.skipTest("numpy is not installed")
+
+        in_width, in_height = in_size
+        out_width, out_height = out_size
+
+        rng = np.random.default_rng(in_width * out_width + bilinear)
+        image = rng.integers(0, 256, size=(in_height, in_width, 3))
+        expected = self.reference(image, out_width, out_height, bilinear)
+
+        # The test writes the whole frame before reading it, so all lines are buffered
+        m = Module()
+        m.submodules.scaler = scaler = Scaler(in_width, in_height, out_width, out_height,
+                                              bilinear=bilinear, lines=16,
+                                              in_domain="sync", out_domain="out")
+        m.domains.out = ClockDomain()
+
+        sim = Simulator(m)
+        sim.add_clock(1/100e6, domain="sync")
+        sim.add_clock(1/75e6, domain="out")
+
+        input_done = [False]
+
+        def input_process():
+            # Blanking between lines
+            for y in range(in_height):
+                for x in range(in_width):
+                    yield scaler.in_de.eq(1)
+                    yield scaler.in_frame_start.eq((x == 0) & (y == 0))
+                    yield scaler.in_r.eq(int(image[y, x, 0]))
+                    yield scaler.in_g.eq(int(image[y, x, 1]))
+                    yield scaler.in_b.eq(int(image[y, x, 2]))
+                    yield
+                yield scaler.in_de.eq(0)
+                yield scaler.in_frame_start.eq(0)
+                for _ in range(3):
+                    yield
+            input_done[0] = True
+
+        def output_process():
+            while not input_done[0]:
+                yield
+
+            h_total = out_width + 6
+            results = {}
+            for y in range(out_height):
+                for x in range(h_total):
+                    yield scaler.out_x.eq(x)
+                    yield scaler.out_y.eq(y)
+                    yield
+                    # Outputs are read one cycle late
+                    x_out = x - scaler.latency
+                    if 0 <= x_out < out_width:
+                        results[x_out, y] = ((yield scaler.out_r), (yield scaler.out_g), (yield scaler.out_b))
+
+            for y in range(out_height):
+                for x in range(out_width):
+                    self.assertEqual(results[x, y], tuple(int(v) for v in expected[y, x]), (x, y))
+
+        sim.add_sync_process(input_process, domain="sync")
+        sim.add_sync_process(output_process, domain="out")
+        with sim.write_vcd("scaler.vcd"):
+            sim.run()
+
+    def test_nearest_downscale(self):
+        self._run((16, 12), (8, 6), bilinear=False)
+
+    def test_nearest_upscale_fractional(self):
+        self._run((16, 12), (24, 18), bilinear=False)
+
+    def test_bilinear_downscale_fractional(self):
+        # Like 1080p to 720p
+        self._run((18, 12), (12, 8), bilinear=True)
+
+    def test_bilinear_upscale_fractional(self):
+        # Like 720p to 1080p
+        self._run((12, 8), (18, 12), bilinear=True)
+
+    def test_bilinear_downscale_streaming(self):
+        if importlib.util.find_spec("numpy") is None:
+            self.skipTest("numpy is not installed")
+
+        # 2:1 with the default 4 line buffers, input and output at the same time and
+        # at the same frame rate. The input height is not a multiple of the number of
+        # line buffers, so the slots after in_frame_start differ from the last frame.
+        in_width, in_height = 20, 10
+        out_width, out_height = 10, 5
+        in_h_total = in_width + 8
+        out_h_total = 2 * in_h_total
+        frame_cycles = (in_height + 2) * in_h_total
+        frames = 2
+
+        rng = np.random.default_rng(34)
+        images = [rng.integers(0, 256, size=(in_height, in_width, 3)) for _ in range(frames)]
+        expected = [self.reference(image, out_width, out_height, True) for image in images]
+
+        for delay_lines in [2, 3]:
+            with self.subTest(delay_lines=delay_lines):
+                m = Module()
+                m.submodules.scaler = scaler = Scaler(in_width, in_height, out_width, out_height)
+
+                sim = Simulator(m)
+                sim.add_clock(1/100e6, domain="sync")
+
+                results = {}
+
+                def process():
+                    # The output frame starts delay_lines input lines after the input frame
+                    delay = delay_lines * in_h_total
+                    for t in range(frames * frame_cycles + delay + scaler.latency + 1):
+                        frame, pos = divmod(t, frame_cycles)
+                        y, x = divmod(pos, in_h_total)
+                        de = frame < frames and y < in_height and x < in_width
+                        yield scaler.in_de.eq(de)
+                        yield scaler.in_frame_start.eq(de and x == 0 and y == 0)
+                        if de:
+                            yield scaler.in_r.eq(int(images[frame][y, x, 0]))
+                            yield scaler.in_g.eq(int(images[frame][y, x, 1]))
+                            yield scaler.in_b.eq(int(images[frame][y, x, 2]))
+
+                        out_y, out_x = divmod(max(t - delay, 0) % frame_cycles, out_h_total)
+                        yield scaler.out_x.eq(out_x)
+                        yield scaler.out_y.eq(out_y)
+                        yield
+
+                        # Outputs are read one cycle late
+                        t_out = t - delay - scaler.latency
+                        if t_out >= 0:
+                            frame, pos = divmod(t_out, frame_cycles)
+                            y, x = divmod(pos, out_h_total)
+                            if frame < frames and y < out_height and x < out_width:
+                                results[frame, x, y] = ((yield scaler.out_r),
+                                                        (yield scaler.out_g),
+                                                        (yield scaler.out_b))
+
+                sim.add_sync_process(process)
+                sim.run()
+
+                for frame in range(frames):
+                    for y in range(out_height):
+                        for x in range(out_width):
+                            self.assertEqual(results[frame, x, y],
+                                             tuple(int(v) for v in expected[frame][y, x]),
+                                             (frame, x, y))
@@ -0,0 +1,255 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+from nmigen.utils import bits_for
+
+from .bus.buswrapper import BusWrapper
+from .bus.wb import get_layout
+from ..util.test import FHDLTestCase, wb_write
+
+
+class ScanlineRenderer(Elaboratable):
+    """
+    Renders a line of indexed pixels from a double buffered line RAM.
+
+    The line RAM has two banks. The front bank is displayed while the bus writes go
+    to the back bank. At the end of the active part of a line, h_ctr == width, the
+    banks are swapped if the back bank has been written since the last swap. Software
+    can then fill the next line while the current one is displayed, and a line that
+    is written once stays on screen. The back bank holds what was displayed before
+    the last swap, so a line has to be written completely or not at all.
+
+    Pixels are packed LSB first, 1, 2, 4 or 8 bits per pixel, and are looked up in a
+    palette of 256 entries. Every pixel is repeated `scale` times horizontally. The
+    mode and the palette are not double buffered and take effect immediately.
+
+    h_ctr:          Horizontal position, e.g. from VGAOutputSubtarget
+    r, g, b:        Output pixel, `latency` cycles after h_ctr
+    width:          Active width, the line RAM holds width pixels at 8 bits per pixel
+    base_addr:      Base address of `wb`
+
+    wb:             Wishbone bus with byte addresses. Only the control register can
+                    be read back. Offsets from base_addr are in memory_map:
+        "line":     Back bank of the line RAM, 32-bit words
+        "palette":  Palette entry i at 4 * i, r [0:8], g [8:16], b [16:24]. Entry 0
+                    is black and entry 1 is white after reset.
+        "control":  bits per pixel, log2 [0:2], scale [8:12]
+    """
+
+    latency = 3
+
+    def __init__(self, h_ctr, width=640, base_addr=0):
+        self.h_ctr = h_ctr
+        self.width = width
+        self.base_addr = base_addr
+
+        self.bank_bits = bits_for(width * 8 // 32 - 1)
+        self.region_bits = 2 + max(self.bank_bits, 8)
+        self.memory_map = {name: base_addr + (i << self.region_bits)
+                           for i, name in enumerate(["line", "palette", "control"])}
+        self.size = 3 << self.region_bits
+
+        self.r = Signal(8)
+        self.g = Signal(8)
+        self.b = Signal(8)
+
+        # Reset to 1 bpp and 2x scaling
+        self.control = Signal(12, reset=0x200)
+        self.front = Signal()
+
+        self.line = Memory(width=32, depth=2 << self.bank_bits)
+        self.palette = Memory(width=24, depth=256, init=[0x000000, 0xffffff])
+
+        self.wb = Record(get_layout())
+
+    def elaborate(self, platform):
+        m = Module()
+
+        wb = self.wb
+        h_ctr = self.h_ctr
+
+        bpp_log2 = Signal(2)
+        scale = Signal(4)
+        m.d.comb += [
+            bpp_log2.eq(self.control[0:2]),
+            scale.eq(self.control[8:12]),
+        ]
+
+        # Bus
+        m.submodules.regs = regs = BusWrapper(address_width=1, signals_rw=[self.control])
+
+        offset = Signal(32)
+        region = Signal(2)
+        access = Signal()
+        ack_r = Signal()
+        m.d.comb += [
+            offset.eq(wb.adr - self.base_addr),
+            region.eq(offset[self.region_bits:]),
+            access.eq(wb.cyc & wb.stb & ~ack_r),
+            regs.we.eq(wb.we),
+            regs.write_data.eq(wb.dat_w),
+            wb.dat_r.eq(regs.read_data),
+        ]
+        with m.If(wb.cyc & wb.stb):
+            m.d.sync += wb.ack.eq(ack_r)
+            m.d.sync += ack_r.eq(0)
+            with m.If(region == 2):
+                m.d.comb += regs.cs.eq(~ack_r)
+        with m.Else():
+            m.d.sync += ack_r.eq(1)
+
+        m.submodules.line_wr = line_wr = self.line.write_port()
+        m.d.comb += [
+            line_wr.addr.eq(Cat(offset[2:2 + self.bank_bits], ~self.front)),
+            line_wr.data.eq(wb.dat_w),
+            line_wr.en.eq(access & wb.we & (region == 0)),
+        ]
+
+        m.submodules.palette_wr = palette_wr = self.palette.write_port()
+        m.d.comb += [
+            palette_wr.addr.eq(offset[2:10]),
+            palette_wr.data.eq(wb.dat_w),
+            palette_wr.en.eq(access & wb.we & (region == 1)),
+        ]
+
+        # Swap the banks
+        dirty = Signal()
+        with m.If(h_ctr == self.width):
+            with m.If(dirty):
+                m.d.sync += self.front.eq(~self.front)
+            m.d.sync += dirty.eq(0)
+        with m.If(line_wr.en):
+            m.d.sync += dirty.eq(1)
+
+        # Stage 0: Source pixel
+        pixel = Signal(12)
+        repeat = Signal(4)
+        with m.If(h_ctr == 0):
+            m.d.sync += [
+                pixel.eq(0),
+                repeat.eq(1),
+            ]
+        with m.Elif(repeat >= scale):
+            m.d.sync += [
+                pixel.eq(pixel + 1),
+                repeat.eq(1),
+            ]
+        with m.Else():
+            m.d.sync += repeat.eq(repeat + 1)
+
+        # Stage 1: Read the word
+        m.submodules.line_rd = line_rd = self.line.read_port()
+        bit = Signal(15)
+        shift = Signal(5)
+        m.d.comb += [
+            bit.eq(pixel << bpp_log2),
+            line_rd.addr.eq(Cat(bit[5:5 + self.bank_bits], self.front)),
+        ]
+        m.d.sync += shift.eq(bit[0:5])
+
+        # Stage 2: Look up the color
+        m.submodules.palette_rd = palette_rd = self.palette.read_port()
+        index = Signal(8)
+        mask = Signal(8)
+        m.d.comb += [
+            mask.eq((1 << (1 << bpp_log2)) - 1),
+            index.eq((line_rd.data >> shift) & mask),
+            palette_rd.addr.eq(index),
+        ]
+
+        m.d.comb += Cat(self.r, self.g, self.b).eq(palette_rd.data)
+
+        return m
+
+
+class ScanlineRendererTest(FHDLTestCase):
+
+    def test_modes(self):
+        width = 32
+        h_total = 160
+        lines = 24
+
+        m = Module()
+
+        h_ctr = Signal(12)
+        m.submodules.renderer = renderer = ScanlineRenderer(h_ctr, width=width)
+        wb = renderer.wb
+        memory_map = renderer.memory_map
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        state = {"line": 0, "x": 0}
+        shown = [[None] * width for _ in range(lines)]
+
+        def video_process():
+            for line in range(lines):
+                state["line"] = line
+                for x in range(h_total):
+                    state["x"] = x
+                    yield h_ctr.eq(x)
+                    yield
+                    # Outputs are read one cycle late
+                    x_out = x - renderer.latency
+                    if 0 <= x_out < width:
+                        shown[line][x_out] = (yield Cat(renderer.r, renderer.g, renderer.b))
+
+        def next_line():
+            # Returns the current line after its banks have been swapped
+            line = state["line"]
+            while state["line"] == line:
+                yield
+            while state["x"] <= width + renderer.latency:
+                yield
+            return state["line"]
+
+        def expected(words, palette, bpp_log2, scale):
+            bpp = 1 << bpp_log2
+            image = []
+            for x in range(width):
+                bit = (x // scale) * bpp
+                index = (words[bit >> 5] >> (bit & 31)) & ((1 << bpp) - 1)
+                image.append(palette[index])
+            return image
+
+        def process():
+            palette = [0x000000, 0xffffff] + [0] * 254
+
+            # Default mode, 1 bpp 2x scaling
+            words = [0x0000ffff, 0x12345678] + [0] * 6
+            line = yield from next_line()
+            for i, w in enumerate(words):
+                yield from wb_write(wb, memory_map["line"] + 4 * i, w)
+            for _ in range(2):
+                yield from next_line()
+            self.assertEqual(shown[line + 2], expected(words, palette, 0, 2))
+
+            for bpp_log2, scale in [(1, 1), (2, 3), (3, 1), (3, 4)]:
+                words = [(0x9e3779b9 * (i + 1) * (bpp_log2 + scale)) & 0xffffffff for i in range(8)]
+                line = yield from next_line()
+                yield from wb_write(wb, memory_map["control"], (scale << 8) | bpp_log2)
+                for i, w in enumerate(words):
+                    yield from wb_write(wb, memory_map["line"] + 4 * i, w)
+                for i in range(1 << (1 << min(bpp_log2, 2))):
+                    palette[i] = (0x10101 * (i + 1) * (bpp_log2 + 7)) & 0xffffff
+                    yield from wb_write(wb, memory_map["palette"] + 4 * i, palette[i])
+                for _ in range(2):
+                    yield from next_line()
+                self.assertEqual(shown[line + 2], expected(words, palette, bpp_log2, scale))
+
+            # The front bank stays displayed while the back bank is written, and
+            # is kept when nothing is written
+            old = expected(words, palette, bpp_log2, scale)
+            words = [~w & 0xffffffff for w in words]
+            line = yield from next_line()
+            for i, w in enumerate(words):
+                yield from wb_write(wb, memory_map["line"] + 4 * i, w)
+            for _ in range(3):
+                yield from next_line()
+            self.assertEqual(shown[line + 1], old)
+            self.assertEqual(shown[line + 2], expected(words, palette, bpp_log2, scale))
+            self.assertEqual(shown[line + 3], expected(words, palette, bpp_log2, scale))
+
+        sim.add_sync_process(video_process)
+        sim.add_sync_process(process)
+        with sim.write_vcd("scanline.vcd"):
+            sim.run()
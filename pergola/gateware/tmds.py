@@ -55,6 +55,16 @@ License from the original source:
 """
 
 
+# Control period characters q_out[9:0] as in the DVI 1.0 specification, indexed by
+# the 2-bit control value `c` = {C1, C0}. HDMI uses the same characters.
+TMDS_CONTROL_TOKENS = [
+    0b1101010100,
+    0b0010101011,
+    0b0101010100,
+    0b1010101011,
+]
+
+
 class TMDSEncoder(Elaboratable):
     def __init__(self, data, c, blank, encoded):
         assert(data.shape().width == 8)
@@ -120,14 +130,9 @@ class TMDSEncoder(Elaboratable):
 
         with m.If(self.blank):
             with m.Switch(self.c):
-                with m.Case(0b11):
-                    m.d.sync += self.encoded.eq(0b1101010100)
-                with m.Case(0b01):
-                    m.d.sync += self.encoded.eq(0b0010101011)
-                with m.Case(0b10):
-                    m.d.sync += self.encoded.eq(0b0101010100)
-                with m.Case(0b0):
-                    m.d.sync += self.encoded.eq(0b1010101011)
+                for c, token in enumerate(TMDS_CONTROL_TOKENS):
+                    with m.Case(c):
+                        m.d.sync += self.encoded.eq(token)
             m.d.sync += disparity.eq(0)
 
         with m.Else():
@@ -209,18 +214,10 @@ class TMDSDecoder(Elaboratable):
             ))
 
         with m.Switch(data_in):
-            with m.Case(0b1101010100):
-                m.d.sync += c.eq(0b11)
-                m.d.sync += active_data.eq(0)
-            with m.Case(0b0010101011):
-                m.d.sync += c.eq(0b01)
-                m.d.sync += active_data.eq(0)
-            with m.Case(0b0101010100):
-                m.d.sync += c.eq(0b10)
-                m.d.sync += active_data.eq(0)
-            with m.Case(0b1010101011):
-                m.d.sync += c.eq(0b00)
-                m.d.sync += active_data.eq(0)
+            for token_c, token in enumerate(TMDS_CONTROL_TOKENS):
+                with m.Case(token):
+                    m.d.sync += c.eq(token_c)
+                    m.d.sync += active_data.eq(0)
             with m.Default():
                 m.d.sync += c.eq(0b00)
                 m.d.sync += active_data.eq(1)
@@ -1,4 +1,8 @@
 from nmigen import *
+from nmigen.back.pysim import Simulator
+
+from .bus.buswrapper import BusWrapper
+from ..util.test import FHDLTestCase
 
 
 """
@@ -153,22 +157,48 @@ class VGAOutputSubtarget(Elaboratable):
         return m
 
 class DynamicVGAOutputSubtarget(VGAOutputSubtarget):
-    def __init__(self, output, r=None, g=None, b=None):
+    """
+    VGAOutputSubtarget with the timing in registers that can be changed at runtime,
+    e.g. through `bus`.
+
+    Writes go to the timing registers (h_front, ..., vs_polarity), which are only
+    shadows. Writing to apply copies them to a pending timing, where the end of line,
+    sync start and sync end thresholds are computed from them. The pending timing is
+    taken over as a whole at the start of the next frame, so the counters only
+    compare against registered values and never see a half updated timing, however
+    the registers are written.
+
+    vga_parameters: Reset values of the timing registers, optional
+
+    bus:            BusWrapper with the timing registers
+                    0: h_front  1: h_sync  2: h_back  3: h_active
+                    4: v_front  5: v_sync  6: v_back  7: v_active
+                    8: hs_polarity  9: vs_polarity (1: active high, the default)
+                    10: apply, write only, any value
+    """
+
+    APPLY = 10
+
+    def __init__(self, output, vga_parameters=None, r=None, g=None, b=None):
 
         self.output = output
+        self.vga_parameters = params = vga_parameters
+
+        def reg(name, width=12):
+            return Signal(width, name=name, reset=getattr(params, name) if params else 0)
 
-        self.h_front = Signal(8)
-        self.h_sync = Signal(8)
-        self.h_back = Signal(8)
-        self.h_active = Signal(12)
+        self.h_front = reg("h_front")
+        self.h_sync = reg("h_sync")
+        self.h_back = reg("h_back")
+        self.h_active = reg("h_active")
 
-        self.v_front = Signal(8)
-        self.v_sync = Signal(8)
-        self.v_back = Signal(8)
-        self.v_active = Signal(12)
+        self.v_front = reg("v_front")
+        self.v_sync = reg("v_sync")
+        self.v_back = reg("v_back")
+        self.v_active = reg("v_active")
 
-        self.h_total = self.h_front + self.h_sync + self.h_back + self.h_active
-        self.v_total = self.v_front + self.v_sync + self.v_back + self.v_active
+        self.hs_polarity = Signal(reset=1)
+        self.vs_polarity = Signal(reset=1)
 
         self.h_ctr = Signal(12)
         self.v_ctr = Signal(12)
@@ -180,3 +210,242 @@ class DynamicVGAOutputSubtarget(VGAOutputSubtarget):
         self.b = b
 
         self.reset = Signal()
+
+        self.bus = BusWrapper(
+            address_width=4,
+            signals_rw=[
+                self.h_front, self.h_sync, self.h_back, self.h_active,
+                self.v_front, self.v_sync, self.v_back, self.v_active,
+                self.hs_polarity, self.vs_polarity,
+            ],
+        )
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.output = output = VGAOutput(self.output)
+        m.submodules.bus = self.bus
+
+        params = self.vga_parameters
+
+        # Thresholds as functions of either VGAParameters or the timing registers
+        thresholds = [
+            ("h_last",       lambda t: t.h_active + t.h_front + t.h_sync + t.h_back - 1),
+            ("h_sync_start", lambda t: t.h_active + t.h_front),
+            ("h_sync_end",   lambda t: t.h_active + t.h_front + t.h_sync),
+            ("v_last",       lambda t: t.v_active + t.v_front + t.v_sync + t.v_back - 1),
+            ("v_sync_start", lambda t: t.v_active + t.v_front),
+            ("v_sync_end",   lambda t: t.v_active + t.v_front + t.v_sync),
+            ("h_active",     lambda t: t.h_active),
+            ("v_active",     lambda t: t.v_active),
+        ]
+
+        # `pending` is computed from the registers when apply is written, `active` is
+        # in use and updated at the start of a frame
+        bus = self.bus
+        apply = Signal()
+        m.d.comb += apply.eq(bus.cs & bus.we & (bus.addr == self.APPLY))
+
+        pending = []
+        active = []
+        for name, f in thresholds:
+            reset = f(params) if params else 0
+            pending.append(Signal(12, name=f"{name}_pending", reset=reset))
+            active.append(Signal(12, name=name, reset=reset))
+            with m.If(apply):
+                m.d.sync += pending[-1].eq(f(self))
+        for polarity in [self.hs_polarity, self.vs_polarity]:
+            pending.append(Signal(name=f"{polarity.name}_pending", reset=1))
+            active.append(Signal(name=polarity.name, reset=1))
+            with m.If(apply):
+                m.d.sync += pending[-1].eq(polarity)
+
+        (h_last_r, h_sync_start_r, h_sync_end_r, v_last_r, v_sync_start_r, v_sync_end_r,
+         h_active, v_active, hs_polarity, vs_polarity) = active
+
+        def load():
+            return [a.eq(p) for a, p in zip(active, pending)]
+
+        # Active high syncs, inverted at the output if needed
+        hs = Signal()
+        vs = Signal()
+
+        m.d.comb += [
+            output.blank.eq(~((self.h_ctr < h_active) & (self.v_ctr < v_active))),
+            output.hs.eq(hs ^ ~hs_polarity),
+            output.vs.eq(vs ^ ~vs_polarity),
+        ]
+
+        with m.If(self.h_ctr == h_last_r):
+            with m.If(self.v_ctr == v_last_r):
+                m.d.sync += self.v_ctr.eq(0)
+                m.d.sync += load()
+            with m.Else():
+                m.d.sync += self.v_ctr.eq(self.v_ctr + 1)
+            m.d.sync += self.h_ctr.eq(0)
+        with m.Else():
+            m.d.sync += self.h_ctr.eq(self.h_ctr + 1)
+        with m.If(self.h_ctr == 0):
+            m.d.sync += self.h_en.eq(1),
+        with m.Elif(self.h_ctr == h_active):
+            m.d.sync += self.h_en.eq(0),
+        with m.Elif(self.h_ctr == h_sync_start_r):
+            m.d.sync += hs.eq(1)
+        with m.Elif(self.h_ctr == h_sync_end_r):
+            m.d.sync += hs.eq(0)
+        with m.If(self.v_ctr == 0):
+            m.d.sync += self.v_en.eq(1)
+        with m.Elif(self.v_ctr == v_active):
+            m.d.sync += self.v_en.eq(0)
+        with m.Elif(self.v_ctr == v_sync_start_r):
+            m.d.sync += vs.eq(1)
+        with m.Elif(self.v_ctr == v_sync_end_r):
+            m.d.sync += vs.eq(0)
+
+        if not type(None) in [type(x) for x in [self.r, self.g, self.b]]:
+            with m.If(self.v_en & self.h_en):
+                m.d.sync += output.r.eq(self.r)
+                m.d.sync += output.g.eq(self.g)
+                m.d.sync += output.b.eq(self.b)
+            with m.Else():
+                m.d.sync += output.r.eq(0),
+                m.d.sync += output.g.eq(0),
+                m.d.sync += output.b.eq(0),
+
+        with m.If(self.reset):
+            m.d.sync += self.h_en.eq(0),
+            m.d.sync += self.v_en.eq(0),
+            m.d.sync += self.h_ctr.eq(0)
+            m.d.sync += self.v_ctr.eq(0)
+            m.d.sync += load()
+
+        return m
+
+
+class DynamicVGAOutputSubtargetTest(FHDLTestCase):
+
+    params_a = VGAParameters(h_front=3, h_sync=5, h_back=7, h_active=20,
+                             v_front=1, v_sync=2, v_back=3, v_active=6)
+    params_b = VGAParameters(h_front=2, h_sync=4, h_back=6, h_active=16,
+                             v_front=2, v_sync=1, v_back=2, v_active=4)
+
+    registers = ["h_front", "h_sync", "h_back", "h_active",
+                 "v_front", "v_sync", "v_back", "v_active"]
+
+    def frame_len(self, p):
+        return ((p.h_front + p.h_sync + p.h_back + p.h_active) *
+                (p.v_front + p.v_sync + p.v_back + p.v_active))
+
+    def check_switch(self, name, writes):
+        """Switches from params_a to params_b with `writes`, a generator that gets a
+        function to write a register and one to step a cycle. The output has to match
+        the static generator with params_a until the next frame start, and the one with
+        params_b from there on."""
+        params_a = self.params_a
+        params_b = self.params_b
+
+        m = Module()
+
+        layout = [('hs', 1), ('vs', 1), ('blank', 1)]
+        outputs = {}
+        for static, params in (("a", params_a), ("b", params_b)):
+            outputs[static] = Record(layout, name=f"static_{static}")
+            m.submodules[f"static_{static}"] = VGAOutputSubtarget(outputs[static], params)
+        static_b = m.submodules["static_b"]
+
+        dynamic_output = Record(layout, name="dynamic")
+        m.submodules.dynamic = dynamic = DynamicVGAOutputSubtarget(dynamic_output, params_a)
+        bus = dynamic.bus
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def sample(record):
+            return ((yield record.hs), (yield record.vs), (yield record.blank))
+
+        def step():
+            # Every cycle before the switch matches the old timing
+            self.assertEqual((yield from sample(dynamic_output)),
+                             (yield from sample(outputs["a"])))
+            yield
+
+        def write(addr, data):
+            yield bus.cs.eq(1)
+            yield bus.we.eq(1)
+            yield bus.addr.eq(addr)
+            yield bus.write_data.eq(data)
+            yield from step()
+            yield bus.cs.eq(0)
+
+        def frame_start():
+            return ((yield dynamic.h_ctr) == 0) & ((yield dynamic.v_ctr) == 0)
+
+        def process():
+            # Same output as the static generator with the reset values
+            for i in range(2 * self.frame_len(params_a)):
+                yield from step()
+
+            yield from writes(dynamic, write, step)
+
+            # The new timing is used from the next frame on
+            while not (yield from frame_start()):
+                yield from step()
+
+            dynamic_trace = []
+            for i in range(2 * self.frame_len(params_b)):
+                dynamic_trace.append((yield from sample(dynamic_output)))
+                yield
+
+            while (yield static_b.h_ctr) != 0 or (yield static_b.v_ctr) != 0:
+                yield
+            static_trace = []
+            for i in range(2 * self.frame_len(params_b)):
+                static_trace.append((yield from sample(outputs["b"])))
+                yield
+
+            self.assertEqual(dynamic_trace, static_trace)
+
+        sim.add_sync_process(process)
+        with sim.write_vcd(f"vga_dynamic_{name}.vcd"):
+            sim.run()
+
+    def test_dynamic_timing(self):
+        # All registers and apply in the middle of the frame
+        def writes(dynamic, write, step):
+            for i in range(7):
+                yield from step()
+            for addr, name in enumerate(self.registers):
+                yield from write(addr, getattr(self.params_b, name))
+            yield from write(DynamicVGAOutputSubtarget.APPLY, 1)
+
+        self.check_switch("middle", writes)
+
+    def test_frame_boundary(self):
+        # Registers written one at a time across a frame boundary, with one of them in the
+        # last cycle of the frame, and apply in the last cycle of a later frame
+        params_a = self.params_a
+        h_last = params_a.h_front + params_a.h_sync + params_a.h_back + params_a.h_active - 1
+        v_last = params_a.v_front + params_a.v_sync + params_a.v_back + params_a.v_active - 1
+
+        def last_cycle(dynamic, step):
+            while ((yield dynamic.h_ctr) != h_last) | ((yield dynamic.v_ctr) != v_last):
+                yield from step()
+
+        def writes(dynamic, write, step):
+            for addr in [3, 0, 1, 2, 7]:
+                yield from write(addr, getattr(self.params_b, self.registers[addr]))
+                for i in range(5):
+                    yield from step()
+            yield from last_cycle(dynamic, step)
+            yield from write(4, self.params_b.v_front)
+            for addr in [5, 6]:
+                yield from write(addr, getattr(self.params_b, self.registers[addr]))
+            for i in range(self.frame_len(params_a) // 2):
+                yield from step()
+            yield from last_cycle(dynamic, step)
+            yield from write(DynamicVGAOutputSubtarget.APPLY, 1)
+
+            # Too late for the frame that starts now
+            for i in range(self.frame_len(params_a)):
+                yield from step()
+
+        self.check_switch("boundary", writes)
@@ -1,5 +1,8 @@
 from nmigen import *
+from nmigen.back.pysim import Simulator
 from .tmds import TMDSEncoder
+from .hdmi import DataIslandEncoder, avi_infoframe
+from ..util.test import FHDLTestCase
 
 """
 
@@ -63,7 +66,17 @@ class VGA2DVID(Elaboratable):
     out_b:     TMDS encoded output in shift clock domain
     out_clock: Clock output in shift clock domain
 
-    xdr:       Data rate. SDR=1, DDR=2, QDR=4, 7DR=7
+    packet_valid:  A HDMI packet is available, e.g. `r_rdy` of a SyncFIFO
+    packet_ready:  The packet is consumed, e.g. `r_en` of a SyncFIFO
+    packet_header: Packet header HB0..HB2
+    packet_data:   Packet body PB0..PB27
+
+    xdr:       Data rate. SDR=1, DDR=2, QDR=4, 7DR=7 (DVI only)
+    hdmi:      Send HDMI instead of DVI. Adds video preambles and guard bands, and
+               data islands with an AVI InfoFrame every frame and the packets from
+               the packet interface. Video is delayed by DataIslandEncoder.LOOKAHEAD
+               pixels, active video throughput is unchanged.
+    avi_infoframe: AVI InfoFrame to send in HDMI mode, see hdmi.avi_infoframe
 
     Clock domains
     sync:      Pixel clock
@@ -72,7 +85,11 @@ class VGA2DVID(Elaboratable):
     """
 
 
-    def __init__(self, in_r, in_g, in_b, in_blank, in_hsync, in_vsync, in_c1, in_c2, out_r, out_g, out_b, out_clock, xdr=1):
+    def __init__(self, in_r, in_g, in_b, in_blank, in_hsync, in_vsync, in_c1, in_c2, out_r, out_g, out_b, out_clock, xdr=1,
+                 hdmi=False, avi_infoframe=avi_infoframe()):
+        # The 7DR serializer has no data island support
+        assert(not (hdmi and xdr == 7))
+
         self.in_r = in_r
         self.in_g = in_g
         self.in_b = in_b
@@ -86,23 +103,72 @@ class VGA2DVID(Elaboratable):
         self.out_b = out_b
         self.out_clock = out_clock
         self.xdr = xdr
+        self.hdmi = hdmi
+        self.avi_infoframe = avi_infoframe
+
+        self.packet_valid = Signal()
+        self.packet_ready = Signal()
+        self.packet_header = Signal(24)
+        self.packet_data = Signal(28 * 8)
 
     def elaborate(self, platform):
         m = Module()
 
         xdr = self.xdr
 
+        in_r = self.in_r
+        in_g = self.in_g
+        in_b = self.in_b
+        in_blank = self.in_blank
+        in_c1 = self.in_c1
+        in_c2 = self.in_c2
+
         c0 = Signal(2)
-        m.d.comb += c0.eq(Cat(self.in_hsync, self.in_vsync))
 
-        if xdr == 1 or xdr == 2:
-            encoded_red = Signal(10)
-            encoded_green = Signal(10)
-            encoded_blue = Signal(10)
+        if self.hdmi:
+            m.submodules.data_island = di = DataIslandEncoder(avi_infoframe=self.avi_infoframe)
+            m.d.comb += [
+                di.in_blank.eq(self.in_blank),
+                di.in_hsync.eq(self.in_hsync),
+                di.in_vsync.eq(self.in_vsync),
+                di.packet_valid.eq(self.packet_valid),
+                self.packet_ready.eq(di.packet_ready),
+                di.packet_header.eq(self.packet_header),
+                di.packet_data.eq(self.packet_data),
+            ]
 
-            m.submodules.tmds_b = tmds_b = TMDSEncoder(data=self.in_b, c=c0,         blank=self.in_blank, encoded=encoded_blue)
-            m.submodules.tmds_g = tmds_g = TMDSEncoder(data=self.in_g, c=self.in_c1, blank=self.in_blank, encoded=encoded_green)
-            m.submodules.tmds_r = tmds_r = TMDSEncoder(data=self.in_r, c=self.in_c2, blank=self.in_blank, encoded=encoded_red)
+            # Delay the pixels to match the delayed timing
+            pixels = Cat(in_r, in_g, in_b, in_c1, in_c2)
+            for k in range(di.LOOKAHEAD):
+                pixels_r = Signal(len(pixels), name=f"pixels_d{k + 1}")
+                m.d.sync += pixels_r.eq(pixels)
+                pixels = pixels_r
+
+            in_r = pixels[0:8]
+            in_g = pixels[8:16]
+            in_b = pixels[16:24]
+            in_c1 = pixels[24:26]
+            in_c2 = pixels[26:28]
+            in_blank = di.blank
+            m.d.comb += c0.eq(Cat(di.hsync, di.vsync))
+        else:
+            m.d.comb += c0.eq(Cat(self.in_hsync, self.in_vsync))
+
+        def encode(name, data, c, lane):
+            encoded = Signal(10, name=f"encoded_{name}")
+            if not self.hdmi:
+                m.submodules[f"tmds_{name}"] = TMDSEncoder(data=data, c=c, blank=in_blank, encoded=encoded)
+                return encoded
+
+            tmds = Signal(10, name=f"tmds_{name}")
+            m.submodules[f"tmds_{name}"] = TMDSEncoder(data=data, c=c, blank=in_blank, encoded=tmds)
+            m.d.comb += encoded.eq(Mux(di.out_en[lane], di.out_d[lane], tmds))
+            return encoded
+
+        if xdr == 1 or xdr == 2:
+            encoded_blue  = encode("b", in_b, c0,    0)
+            encoded_green = encode("g", in_g, in_c1, 1)
+            encoded_red   = encode("r", in_r, in_c2, 2)
 
             shift_clock_initial = 0b0000011111
             C_shift_clock_initial = Const(0b0000011111)
@@ -139,17 +205,13 @@ class VGA2DVID(Elaboratable):
             m.d.shift += shift_clock.eq(Cat(shift_clock[xdr:], shift_clock[:xdr]))
 
         elif xdr == 4:
-            encoded_red = Signal(10)
-            encoded_green = Signal(10)
-            encoded_blue = Signal(10)
-
             encoded_red_r = Signal(10)
             encoded_green_r = Signal(10)
             encoded_blue_r = Signal(10)
 
-            m.submodules.tmds_b = tmds_b = TMDSEncoder(data=self.in_b, c=c0,  blank=self.in_blank, encoded=encoded_blue)
-            m.submodules.tmds_g = tmds_g = TMDSEncoder(data=self.in_g, c=self.in_c1, blank=self.in_blank, encoded=encoded_green)
-            m.submodules.tmds_r = tmds_r = TMDSEncoder(data=self.in_r, c=self.in_c2,   blank=self.in_blank, encoded=encoded_red)
+            encoded_blue  = encode("b", in_b, c0,    0)
+            encoded_green = encode("g", in_g, in_c1, 1)
+            encoded_red   = encode("r", in_r, in_c2, 2)
 
             shift_clock_initial = 0b00000111110000011111
             C_shift_clock_initial = Const(shift_clock_initial)
@@ -249,3 +311,107 @@ class VGA2DVID(Elaboratable):
 
         return m
 
+
+
+class VGA2DVIDTest(FHDLTestCase):
+
+    def test_hdmi_sync(self):
+        from .hdmi import TERC4_CHARACTERS, VIDEO_GUARD_BAND
+
+        # Control characters q_out[9:0] from the DVI 1.0 specification, indexed by {C1, C0}
+        control_tokens = [0b1101010100, 0b0010101011, 0b0101010100, 0b1010101011]
+
+        # Small video timing, the data islands overlap the hsync and vsync edges
+        h_active, h_front, h_sync, h_back = 32, 6, 20, 80
+        v_active, v_front, v_sync, v_back = 4, 1, 1, 1
+        h_total = h_active + h_front + h_sync + h_back
+        v_total = v_active + v_front + v_sync + v_back
+
+        timing = [(1, 0, 0)] * h_total
+        for frame in range(2):
+            for y in range(v_total):
+                for x in range(h_total):
+                    blank = int(x >= h_active or y >= v_active)
+                    hsync = int(h_active + h_front <= x < h_active + h_front + h_sync)
+                    vsync = int(v_active + v_front <= y < v_active + v_front + v_sync)
+                    timing.append((blank, hsync, vsync))
+
+        in_r = Signal(8)
+        in_g = Signal(8)
+        in_b = Signal(8)
+        in_blank = Signal()
+        in_hsync = Signal()
+        in_vsync = Signal()
+        out_r = Signal()
+        out_g = Signal()
+        out_b = Signal()
+
+        m = Module()
+        m.submodules.vga2dvid = VGA2DVID(
+            in_r=in_r, in_g=in_g, in_b=in_b,
+            in_blank=in_blank, in_hsync=in_hsync, in_vsync=in_vsync,
+            in_c1=Signal(2), in_c2=Signal(2),
+            out_r=out_r, out_g=out_g, out_b=out_b, out_clock=Signal(),
+            xdr=1, hdmi=True)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+        sim.add_clock(1/250e6, domain="shift")
+
+        def pixel_process():
+            for x, (blank, hsync, vsync) in enumerate(timing):
+                yield in_r.eq(x)
+                yield in_g.eq(x * 3)
+                yield in_b.eq(x * 7)
+                yield in_blank.eq(blank)
+                yield in_hsync.eq(hsync)
+                yield in_vsync.eq(vsync)
+                yield
+
+        lanes = [[], [], []]
+
+        def shift_process():
+            for _ in range(len(timing) * 10):
+                yield
+                for lane, out in zip(lanes, [out_b, out_g, out_r]):
+                    lane.append((yield out))
+
+        sim.add_sync_process(pixel_process)
+        sim.add_sync_process(shift_process, domain="shift")
+        sim.run()
+
+        def characters(bits, offset):
+            return [sum(b << i for i, b in enumerate(bits[n:n + 10]))
+                    for n in range(offset, len(bits) - 9, 10)]
+
+        # Find the character boundary like a sink would, by looking for control characters
+        offset = max(range(10), key=lambda o: sum(c in control_tokens for c in characters(lanes[0], o)))
+        chars = list(zip(*[characters(lane, offset) for lane in lanes]))
+
+        # Decode hsync/vsync like a spec compliant sink
+        hv = 0
+        video = False
+        islands = 0
+        decoded = []
+        for c0, c1, c2 in chars:
+            if c0 in control_tokens:
+                video = False
+                hv = control_tokens.index(c0)
+                # CTL0..CTL3 are 0 except in the preambles
+                self.assertIn(c1, control_tokens[:2])
+                self.assertIn(c2, control_tokens[:2])
+            elif (c0, c1, c2) == tuple(VIDEO_GUARD_BAND):
+                video = True
+            elif not video and c0 in TERC4_CHARACTERS:
+                hv = TERC4_CHARACTERS.index(c0) & 0b11
+                islands += 1
+            decoded.append(hv)
+
+        self.assertGreater(islands, 0)
+
+        # The decoded hsync/vsync match the input, skipping the first line after reset
+        expected = [hsync | (vsync << 1) for blank, hsync, vsync in timing]
+        delays = [d for d in range(64)
+                  if all(decoded[n + d] == expected[n]
+                         for n in range(h_total, len(decoded) - d))]
+        self.assertNotEqual(delays, [])
@@ -0,0 +1,330 @@
+from nmigen import *
+from nmigen.back.pysim import Simulator
+
+from .vga import VGAOutputSubtarget, DynamicVGAOutputSubtarget, VGAParameters
+from ..util.test import FHDLTestCase
+
+
+class VGATimingAnalyzer(Elaboratable):
+    """
+    Measures the video timing of a decoded DVI/HDMI stream, e.g. from DVID2VGA.
+
+    The measured values use the same conventions as VGAOutputSubtarget (lines
+    start with the active area, syncs are registered), so they can be written
+    to a DynamicVGAOutputSubtarget to generate a matching local timing.
+
+    de:             Data enable (~blank)
+    hsync, vsync:   Sync signals, any polarity. They are ignored while de is
+                    asserted since DVI does not transmit them during active video.
+
+    h_front, h_sync, h_back, h_active,
+    v_front, v_sync, v_back, v_active:
+                    Measured timing, updated at the start of every frame
+    hs_polarity, vs_polarity:
+                    1 if the sync is active high
+    locked:         The timing was the same in the last two frames
+    frame_start:    Strobe on the first active pixel of a frame
+    frame_end:      Strobe on the last pixel of a frame while locked. Resetting a
+                    generator with it starts its frame in lockstep with the input.
+
+    bus:            BusWrapper of a DynamicVGAOutputSubtarget, optional. While
+                    locked, the measured timing is written to it and applied
+                    after every frame start.
+    """
+
+    def __init__(self, de, hsync, vsync, bus=None):
+        self.de = de
+        self.hsync = hsync
+        self.vsync = vsync
+        self.bus = bus
+
+        self.h_front = Signal(12)
+        self.h_sync = Signal(12)
+        self.h_back = Signal(12)
+        self.h_active = Signal(12)
+        self.v_front = Signal(12)
+        self.v_sync = Signal(12)
+        self.v_back = Signal(12)
+        self.v_active = Signal(12)
+        self.hs_polarity = Signal()
+        self.vs_polarity = Signal()
+
+        self.locked = Signal()
+        self.frame_start = Signal()
+        self.frame_end = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        de = self.de
+
+        # Hold the syncs during active video
+        hs = Signal()
+        vs = Signal()
+        hs_r = Signal()
+        vs_r = Signal()
+        de_r = Signal()
+        m.d.comb += [
+            hs.eq(Mux(de, hs_r, self.hsync)),
+            vs.eq(Mux(de, vs_r, self.vsync)),
+        ]
+        m.d.sync += [
+            hs_r.eq(hs),
+            vs_r.eq(vs),
+            de_r.eq(de),
+        ]
+
+        de_rise = Signal()
+        de_fall = Signal()
+        m.d.comb += [
+            de_rise.eq(de & ~de_r),
+            de_fall.eq(~de & de_r),
+        ]
+
+        # Line length and hsync polarity from the lengths of both hsync phases,
+        # the shorter one is the sync pulse.
+        hs_edge_ctr = Signal(12)
+        hs_high = Signal(12)
+        hs_low = Signal(12)
+        h_total = Signal(12)
+        hs_polarity = Signal()
+
+        with m.If(hs != hs_r):
+            m.d.sync += hs_edge_ctr.eq(0)
+            with m.If(hs):
+                m.d.sync += hs_low.eq(hs_edge_ctr + 1)
+            with m.Else():
+                m.d.sync += hs_high.eq(hs_edge_ctr + 1)
+        with m.Else():
+            m.d.sync += hs_edge_ctr.eq(hs_edge_ctr + 1)
+
+        m.d.comb += [
+            h_total.eq(hs_high + hs_low),
+            hs_polarity.eq(hs_high < hs_low),
+        ]
+
+        # Horizontal position, aligned to the start of the active area
+        h_ctr = Signal(12)
+        h_pos = Signal(12)
+        line_end = Signal()
+        m.d.comb += [
+            h_pos.eq(Mux(de_rise, 0, h_ctr)),
+            line_end.eq(h_pos == h_total - 1),
+        ]
+        with m.If(line_end):
+            m.d.sync += h_ctr.eq(0)
+        with m.Else():
+            m.d.sync += h_ctr.eq(h_pos + 1)
+
+        # A frame starts with the first active line after a line without data
+        line_de = Signal()
+        prev_line_de = Signal()
+        frame_start = Signal()
+        m.d.comb += frame_start.eq(de_rise & ~prev_line_de)
+        with m.If(line_end):
+            m.d.sync += [
+                prev_line_de.eq(line_de | de),
+                line_de.eq(0),
+            ]
+        with m.Elif(de):
+            m.d.sync += line_de.eq(1)
+
+        # Vertical position in lines, reset at the frame start
+        v_ctr = Signal(12)
+        v_total = Signal(12)
+        with m.If(frame_start):
+            m.d.sync += [
+                v_ctr.eq(0),
+                v_total.eq(v_ctr),
+            ]
+        with m.Elif(line_end):
+            m.d.sync += v_ctr.eq(v_ctr + 1)
+
+        # vsync polarity from the lengths of both vsync phases in lines
+        vs_edge_ctr = Signal(12)
+        vs_high = Signal(12)
+        vs_low = Signal(12)
+        vs_polarity = Signal()
+        with m.If(vs != vs_r):
+            m.d.sync += vs_edge_ctr.eq(0)
+            with m.If(vs):
+                m.d.sync += vs_low.eq(vs_edge_ctr)
+            with m.Else():
+                m.d.sync += vs_high.eq(vs_edge_ctr)
+        with m.Elif(line_end):
+            m.d.sync += vs_edge_ctr.eq(vs_edge_ctr + 1)
+        m.d.comb += vs_polarity.eq(vs_high < vs_low)
+
+        # Positions of the edges. The generator registers the syncs, so the hsync
+        # edge is seen one pixel after the position where it is set.
+        hs_active = Signal()
+        hs_active_r = Signal()
+        vs_active = Signal()
+        vs_active_r = Signal()
+        m.d.comb += [
+            hs_active.eq(hs ^ ~hs_polarity),
+            hs_active_r.eq(hs_r ^ ~hs_polarity),
+            vs_active.eq(vs ^ ~vs_polarity),
+            vs_active_r.eq(vs_r ^ ~vs_polarity),
+        ]
+
+        h_active = Signal(12)
+        h_sync_start = Signal(12)
+        h_sync_end = Signal(12)
+        v_active = Signal(12)
+        v_sync_start = Signal(12)
+        v_sync_end = Signal(12)
+
+        with m.If(de_fall):
+            m.d.sync += [
+                h_active.eq(h_pos),
+                v_active.eq(v_ctr + 1),
+            ]
+        with m.If(hs_active & ~hs_active_r):
+            m.d.sync += h_sync_start.eq(h_pos - 1)
+        with m.If(~hs_active & hs_active_r):
+            m.d.sync += h_sync_end.eq(h_pos - 1)
+        with m.If(vs_active & ~vs_active_r):
+            m.d.sync += v_sync_start.eq(v_ctr)
+        with m.If(~vs_active & vs_active_r):
+            m.d.sync += v_sync_end.eq(v_ctr)
+
+        measured = [
+            (self.h_front,      h_sync_start - h_active),
+            (self.h_sync,       h_sync_end - h_sync_start),
+            (self.h_back,       h_total - h_sync_end),
+            (self.h_active,     h_active),
+            (self.v_front,      v_sync_start - v_active),
+            (self.v_sync,       v_sync_end - v_sync_start),
+            (self.v_back,       v_ctr - v_sync_end),
+            (self.v_active,     v_active),
+            (self.hs_polarity,  hs_polarity),
+            (self.vs_polarity,  vs_polarity),
+        ]
+
+        # Take over the timing of the frame that just ended
+        same = Signal()
+        m.d.comb += same.eq(Cat(*[out == value[:len(out)] for out, value in measured]).all())
+        with m.If(frame_start):
+            m.d.sync += [out.eq(value) for out, value in measured]
+            m.d.sync += self.locked.eq(same)
+
+        m.d.comb += [
+            self.frame_start.eq(frame_start),
+            self.frame_end.eq(self.locked & line_end & (v_ctr == v_total - 1)),
+        ]
+
+        if self.bus is not None:
+            # Write all registers, one per cycle, and apply them after a frame start
+            bus = self.bus
+            assert(len(measured) == DynamicVGAOutputSubtarget.APPLY)
+            outputs = Array([out for out, _ in measured] + [Const(1)])
+            write_addr = Signal(range(len(outputs) + 1), reset=len(outputs))
+            with m.If(frame_start & same):
+                m.d.sync += write_addr.eq(0)
+            with m.Elif(write_addr != len(outputs)):
+                m.d.sync += write_addr.eq(write_addr + 1)
+                m.d.comb += [
+                    bus.cs.eq(1),
+                    bus.we.eq(1),
+                    bus.addr.eq(write_addr),
+                    bus.write_data.eq(outputs[write_addr]),
+                ]
+
+        return m
+
+
+class VGATimingAnalyzerTest(FHDLTestCase):
+
+    params = VGAParameters(h_front=3, h_sync=5, h_back=7, h_active=20,
+                           v_front=2, v_sync=3, v_back=4, v_active=6)
+
+    def _frames(self, n):
+        p = self.params
+        return n * ((p.h_front + p.h_sync + p.h_back + p.h_active) *
+                    (p.v_front + p.v_sync + p.v_back + p.v_active))
+
+    def _measure(self, hs_polarity, vs_polarity):
+        import random
+
+        random.seed(hs_polarity * 2 + vs_polarity)
+        params = self.params
+
+        m = Module()
+
+        output = Record([('hs', 1), ('vs', 1), ('blank', 1)])
+        m.submodules.vga = VGAOutputSubtarget(output, params)
+
+        # Garbage on the syncs during active video, like a TMDS decoder would output
+        noise = Signal(2)
+        de = Signal()
+        hsync = Signal()
+        vsync = Signal()
+        m.d.comb += [
+            de.eq(~output.blank),
+            hsync.eq(Mux(de, noise[0], output.hs ^ ~hs_polarity)),
+            vsync.eq(Mux(de, noise[1], output.vs ^ ~vs_polarity)),
+        ]
+
+        m.submodules.analyzer = analyzer = VGATimingAnalyzer(de, hsync, vsync)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def process():
+            for i in range(self._frames(4)):
+                yield noise.eq(random.getrandbits(2))
+                yield
+            self.assertEqual((yield analyzer.locked), 1)
+            self.assertEqual((yield analyzer.hs_polarity), hs_polarity)
+            self.assertEqual((yield analyzer.vs_polarity), vs_polarity)
+            for name in ["h_front", "h_sync", "h_back", "h_active",
+                         "v_front", "v_sync", "v_back", "v_active"]:
+                self.assertEqual((yield getattr(analyzer, name)), getattr(params, name), name)
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("vga_analyzer.vcd"):
+            sim.run()
+
+    def test_positive_syncs(self):
+        self._measure(hs_polarity=1, vs_polarity=1)
+
+    def test_negative_syncs(self):
+        self._measure(hs_polarity=0, vs_polarity=0)
+
+    def test_mixed_syncs(self):
+        self._measure(hs_polarity=0, vs_polarity=1)
+
+    def test_genlock(self):
+        m = Module()
+
+        output = Record([('hs', 1), ('vs', 1), ('blank', 1)])
+        m.submodules.vga = vga = VGAOutputSubtarget(output, self.params)
+
+        # Starts with an unrelated timing and follows the input once locked
+        local_output = Record([('hs', 1), ('vs', 1), ('blank', 1)])
+        m.submodules.local = local = DynamicVGAOutputSubtarget(local_output, VGAParameters(
+            h_front=1, h_sync=2, h_back=3, h_active=10,
+            v_front=1, v_sync=1, v_back=1, v_active=3))
+
+        m.submodules.analyzer = analyzer = VGATimingAnalyzer(
+            ~output.blank, output.hs, output.vs, bus=local.bus)
+        m.d.comb += local.reset.eq(analyzer.frame_end)
+
+        sim = Simulator(m)
+        sim.add_clock(1/25e6, domain="sync")
+
+        def process():
+            for i in range(self._frames(4)):
+                yield
+            for i in range(self._frames(2)):
+                self.assertEqual((yield local.h_ctr), (yield vga.h_ctr))
+                self.assertEqual((yield local.v_ctr), (yield vga.v_ctr))
+                self.assertEqual((yield local_output.hs), (yield output.hs))
+                self.assertEqual((yield local_output.vs), (yield output.vs))
+                self.assertEqual((yield local_output.blank), (yield output.blank))
+                yield
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("vga_analyzer_genlock.vcd"):
+            sim.run()
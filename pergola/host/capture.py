@@ -0,0 +1,100 @@
+"""
+Captures a frame from the dvid-overlay applet and saves it as a PNG.
+
+    python -m pergola.host.capture /dev/ttyUSB0 frame.png --x 0 --y 0 --shift 3
+
+Needs pyserial.
+"""
+
+import argparse
+import struct
+import time
+import zlib
+
+from ..gateware.capture import CAPTURE_MAGIC
+from .uartbridge import UARTBridgeClient
+
+
+# Address of FrameCapture in dvid-overlay
+CAPTURE_BASE = 0x0100_0000
+
+
+def decode_capture(data):
+    """
+    Decodes the stream of FrameCapture, returns (width, height, pixels) with RGB332 pixels.
+    """
+    if data[:3] != CAPTURE_MAGIC:
+        raise ValueError("Bad capture header")
+    width, height = struct.unpack(">HH", data[3:7])
+
+    pixels = []
+    for i in range(7, len(data), 2):
+        count = data[i]
+        if count == 0:
+            break
+        pixels += [data[i + 1]] * count
+
+    if len(pixels) != width * height:
+        raise ValueError(f"Got {len(pixels)} pixels, expected {width * height}")
+
+    return width, height, pixels
+
+
+def rgb332_to_rgb888(p):
+    r = (p >> 5) & 0x7
+    g = (p >> 2) & 0x7
+    b = p & 0x3
+    return ((r << 5) | (r << 2) | (r >> 1), (g << 5) | (g << 2) | (g >> 1), b * 0x55)
+
+
+def write_png(filename, width, height, pixels):
+    """
+    Writes 8-bit RGB pixels, given as a list of (r, g, b) in raster order.
+    """
+    def chunk(kind, payload):
+        return (struct.pack(">I", len(payload)) + kind + payload +
+                struct.pack(">I", zlib.crc32(kind + payload) & 0xffffffff))
+
+    raw = b"".join(b"\x00" + bytes(c for p in pixels[y * width:(y + 1) * width] for c in p)
+                   for y in range(height))
+
+    with open(filename, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        f.write(chunk(b"IDAT", zlib.compress(raw)))
+        f.write(chunk(b"IEND", b""))
+
+
+def capture(client, x=0, y=0, shift=0, base=CAPTURE_BASE, timeout=30):
+    client.write(base + 0x4, (y << 16) | x)
+    client.write(base + 0x8, shift)
+    client.write(base + 0x0, 1)
+
+    data = bytearray()
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        data += client.serial.read(max(1, client.serial.in_waiting))
+        # The stream ends with a zero count after the header
+        if len(data) > 7 and len(data) % 2 == 0 and data[-1] == 0:
+            return decode_capture(bytes(data))
+    raise TimeoutError("Capture did not complete")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Captures a frame from dvid-overlay")
+    parser.add_argument("port", help="Serial port")
+    parser.add_argument("output", help="PNG file")
+    parser.add_argument("--baudrate", default=115200, type=int)
+    parser.add_argument("--x", default=0, type=int, help="Left edge of the region")
+    parser.add_argument("--y", default=0, type=int, help="Top edge of the region")
+    parser.add_argument("--shift", default=0, type=int,
+                        help="Take every 2**shift'th pixel, i.e. downscale")
+    args = parser.parse_args()
+
+    client = UARTBridgeClient(args.port, baudrate=args.baudrate)
+    width, height, pixels = capture(client, args.x, args.y, args.shift)
+    write_png(args.output, width, height, [rgb332_to_rgb888(p) for p in pixels])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+"""
+Multiplies random int8 matrices on the matmul applet and reports the throughput.
+
+    python -m pergola.host.matmul /dev/ttyUSB0 --baudrate 115200 --size 16 --count 16
+
+Needs pyserial and numpy.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from ..gateware.math.accelerator import MATMUL_MAGIC
+
+
+def pack_request(A, B):
+    """
+    Returns the request for A @ B, int8 matrices.
+    """
+    (m, k), (k2, n) = A.shape, B.shape
+    if k != k2:
+        raise ValueError(f"Cannot multiply {A.shape} by {B.shape}")
+    return (bytes([MATMUL_MAGIC, m, k, n]) +
+            np.asarray(A, dtype=np.int8).tobytes() + np.asarray(B, dtype=np.int8).tobytes())
+
+
+def unpack_response(data, m, n):
+    """
+    Returns the m x n int32 result from a response.
+    """
+    if len(data) != 4 * m * n:
+        raise ValueError(f"Got {len(data)} bytes, expected {4 * m * n}")
+    return np.frombuffer(data, dtype=">i4").reshape((m, n)).astype(np.int32)
+
+
+class MatMulClient:
+    """
+    Host side of MatMulAccelerator.
+
+    window: Requests in flight. The next request is sent while the previous one is
+            computed and its result is received, so the link is busy in both directions.
+            The accelerator buffers two requests.
+    """
+
+    def __init__(self, port, baudrate=115200, timeout=5, window=2):
+        import serial
+
+        self.serial = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+        self.window = window
+
+    def multiply(self, A, B):
+        return self.multiply_batch([(A, B)])[0]
+
+    def multiply_batch(self, pairs):
+        results = []
+        sent = 0
+        while len(results) < len(pairs):
+            while sent < len(pairs) and sent - len(results) < self.window:
+                self.serial.write(pack_request(*pairs[sent]))
+                sent += 1
+
+            A, B = pairs[len(results)]
+            size = 4 * A.shape[0] * B.shape[1]
+            data = self.serial.read(size)
+            if len(data) != size:
+                raise TimeoutError(f"Got {len(data)} of {size} bytes of result {len(results)}")
+            results.append(unpack_response(data, A.shape[0], B.shape[1]))
+        return results
+
+
+def main():
+    from ..gateware.math.gemm import TiledMatMul
+
+    parser = argparse.ArgumentParser(description="Benchmarks the matmul applet")
+    parser.add_argument("port", help="Serial port")
+    parser.add_argument("--baudrate", default=115200, type=int, help="Baudrate of the UART")
+    parser.add_argument("--size", default=16, type=int, help="Size of the square matrices")
+    parser.add_argument("--count", default=16, type=int, help="Number of multiplications")
+    parser.add_argument("--window", default=2, type=int, help="Requests in flight")
+    parser.add_argument("--rows", default=4, type=int, help="Rows of the array, as built")
+    parser.add_argument("--cols", default=4, type=int, help="Columns of the array, as built")
+    parser.add_argument("--clock", default=16e6, type=float, help="Clock of the array in Hz")
+    args = parser.parse_args()
+
+    n = args.size
+    rng = np.random.default_rng()
+    pairs = [(rng.integers(-128, 128, size=(n, n)), rng.integers(-128, 128, size=(n, n)))
+             for _ in range(args.count)]
+
+    client = MatMulClient(args.port, args.baudrate, window=args.window)
+    start = time.time()
+    results = client.multiply_batch(pairs)
+    elapsed = time.time() - start
+
+    errors = sum(not np.array_equal(C, A @ B) for C, (A, B) in zip(results, pairs))
+
+    macs = args.count * n ** 3
+    cycles = TiledMatMul(args.rows, args.cols, 8, 32, n, n, n).cycles(n, n, n)
+    # Request and response overlap, the slower direction limits
+    link_bytes = max(4 + 2 * n * n, 4 * n * n)
+
+    print(f"{args.count} multiplications of {n} x {n}, {errors} wrong")
+    print(f"Achieved:           {macs / elapsed / 1e6:10.3f} MMAC/s")
+    print(f"Link limit:         {n ** 3 * args.baudrate / 10 / link_bytes / 1e6:10.3f} MMAC/s")
+    print(f"Array, this size:   {n ** 3 * args.clock / cycles / 1e6:10.3f} MMAC/s")
+    print(f"Array peak:         {args.rows * args.cols * args.clock / 1e6:10.3f} MMAC/s")
+
+
+if __name__ == "__main__":
+    main()
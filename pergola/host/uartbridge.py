@@ -0,0 +1,28 @@
+import struct
+
+from ..gateware.bus.uartbridge import UARTBridgeCommand
+
+
+class UARTBridgeClient:
+    """
+    Host side of UARTBridge. Needs pyserial.
+    """
+
+    def __init__(self, port, baudrate=115200, timeout=1):
+        import serial
+
+        self.serial = serial.Serial(port, baudrate=baudrate, timeout=timeout)
+
+    def write(self, addr, value):
+        self.serial.write(struct.pack(">BII", UARTBridgeCommand.WRITE, addr, value))
+
+    def write_block(self, addr, values):
+        self.serial.write(b"".join(struct.pack(">BII", UARTBridgeCommand.WRITE, addr + 4 * i, v)
+                                   for i, v in enumerate(values)))
+
+    def read(self, addr):
+        self.serial.write(struct.pack(">BI", UARTBridgeCommand.READ, addr))
+        data = self.serial.read(4)
+        if len(data) != 4:
+            raise TimeoutError(f"No reply when reading 0x{addr:08x}")
+        return struct.unpack(">I", data)[0]
@@ -50,7 +50,25 @@ from nmigen.back import rtlil
 from nmigen._toolchain import require_tool
 
 
-__all__ = ["FHDLTestCase"]
+__all__ = ["FHDLTestCase", "wb_write"]
+
+
+def wb_write(wb, addr, data):
+    """
+    Simulator process step that writes `data` to `addr` on the Wishbone bus `wb`,
+    waits for ack and leaves the bus idle for a cycle.
+    """
+    yield wb.cyc.eq(1)
+    yield wb.stb.eq(1)
+    yield wb.we.eq(1)
+    yield wb.adr.eq(addr)
+    yield wb.dat_w.eq(data)
+    yield
+    while not (yield wb.ack):
+        yield
+    yield wb.cyc.eq(0)
+    yield wb.stb.eq(0)
+    yield
 
 
 class FHDLTestCase(unittest.TestCase):